@@ -0,0 +1,215 @@
+"""Headless HTTP/WebSocket API over ChatService.
+
+Run: python api_server.py [--port 8765] [--model ./models/...gguf] [--batch-slots 4]
+
+With --batch-slots, sessions on the default model share one continuous batching
+InferenceServer instead of taking turns on the model.
+
+    GET    /api/characters                      list characters
+    POST   /api/sessions                        {"character", "user_persona"?} -> session
+    GET    /api/sessions/<id>                   messages, stats, emotion
+    DELETE /api/sessions/<id>
+    POST   /api/sessions/<id>/messages          {"text", sampling...} -> finished reply
+    WS     /api/sessions/<id>/stream            send {"text", sampling...}, receive
+                                                {"event", "text"} ... {"event": "done"}
+    POST   /api/sessions/<id>/save              {"name"?}
+    POST   /api/sessions/<id>/load              {"name"}
+    POST   /api/image                           raw image body -> {"message"}
+    POST   /api/transcribe                      raw audio body -> {"text"}
+    POST   /api/tts                             {"text", "voice"?, "pitch"?, "rate"?} -> audio/mpeg
+"""
+import json
+import asyncio
+import argparse
+
+import tornado.web
+import tornado.websocket
+
+from chat_service import ChatService
+from model_pool import ModelPool
+
+DEFAULT_MODEL_PATH = "./models/L3-8B-Stheno-v3.2-Q4_K_M.gguf"
+SAMPLING_KEYS = ("temperature", "top_p", "min_p", "repetition_penalty", "top_k")
+
+def sampling_args(body):
+    return {key: body[key] for key in SAMPLING_KEYS if key in body}
+
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def json_body(self):
+        try:
+            return json.loads(self.request.body or b"{}")
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, "Invalid JSON")
+
+    def session(self, session_id):
+        try:
+            return self.service.get_session(session_id)
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown session")
+
+    async def blocking(self, fn, *args, **kwargs):
+        # Model calls block for seconds, keep the IOLoop free for other clients
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: fn(*args, **kwargs))
+
+class CharactersHandler(BaseHandler):
+    def get(self):
+        self.write({"characters": self.service.list_characters()})
+
+class SessionsHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        try:
+            session = await self.blocking(self.service.create_session, body["character"], body.get("user_persona"))
+        except KeyError:
+            raise tornado.web.HTTPError(400, "Missing character")
+        except FileNotFoundError as e:
+            raise tornado.web.HTTPError(404, str(e))
+        self.write(session.summary())
+
+class SessionHandler(BaseHandler):
+    def get(self, session_id):
+        self.write(self.session(session_id).summary())
+
+    async def delete(self, session_id):
+        if not await self.blocking(self.service.close_session, session_id):
+            raise tornado.web.HTTPError(404, "Unknown session")
+        self.set_status(204)
+
+class MessagesHandler(BaseHandler):
+    async def post(self, session_id):
+        self.session(session_id)
+        body = self.json_body()
+        if not body.get("text"):
+            raise tornado.web.HTTPError(400, "Missing text")
+        reply = await self.blocking(self.service.reply, session_id, body["text"], body.get("memory_k", 3), **sampling_args(body))
+        self.write(reply)
+
+class SaveHandler(BaseHandler):
+    async def post(self, session_id):
+        self.session(session_id)
+        name = await self.blocking(self.service.save_session, session_id, self.json_body().get("name"))
+        self.write({"name": name})
+
+class LoadHandler(BaseHandler):
+    async def post(self, session_id):
+        self.session(session_id)
+        try:
+            session = await self.blocking(self.service.load_session, session_id, self.json_body()["name"])
+        except (KeyError, FileNotFoundError):
+            raise tornado.web.HTTPError(404, "Unknown saved session")
+        self.write(session.summary())
+
+class ImageHandler(BaseHandler):
+    async def post(self):
+        message = await self.blocking(self.service.describe_image, self.request.body)
+        self.write({"message": message})
+
+class TranscribeHandler(BaseHandler):
+    async def post(self):
+        text = await self.blocking(self.service.transcribe, self.request.body)
+        self.write({"text": text})
+
+class TTSHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        audio = await self.blocking(
+            self.service.speak,
+            body.get("text", ""),
+            voice=body.get("voice", "en-US-AriaNeural"),
+            pitch=body.get("pitch", "+0Hz"),
+            rate=body.get("rate", "+0%")
+        )
+        if not audio:
+            raise tornado.web.HTTPError(500, "TTS failed")
+        self.set_header("Content-Type", "audio/mpeg")
+        self.write(audio)
+
+class StreamHandler(tornado.websocket.WebSocketHandler):
+    """Streams thought/speech/mood events of each reply as JSON messages."""
+
+    def initialize(self, service):
+        self.service = service
+        self.busy = False
+
+    def open(self, session_id):
+        try:
+            self.service.get_session(session_id)
+        except KeyError:
+            self.close(code=4004, reason="Unknown session")
+            return
+        self.session_id = session_id
+
+    async def on_message(self, message):
+        try:
+            body = json.loads(message)
+        except json.JSONDecodeError:
+            return self.write_message({"event": "error", "text": "Invalid JSON"})
+        if not body.get("text"):
+            return self.write_message({"event": "error", "text": "Missing text"})
+        if self.busy:
+            return self.write_message({"event": "error", "text": "A reply is still streaming"})
+
+        self.busy = True
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def produce():
+            # Runs in a worker thread, hands every event to the IOLoop as it arrives
+            try:
+                for event in self.service.chat(self.session_id, body["text"], body.get("memory_k", 3), **sampling_args(body)):
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, ("error", str(e)))
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        worker = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                kind, text = event
+                await self.write_message({"event": kind, "text": text})
+            await worker
+            session = self.service.get_session(self.session_id)
+            await self.write_message({"event": "done", "emotion": session.current_emotion, "message": session.messages[-1]})
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        finally:
+            self.busy = False
+
+def make_app(service):
+    args = {"service": service}
+    return tornado.web.Application([
+        (r"/api/characters", CharactersHandler, args),
+        (r"/api/sessions", SessionsHandler, args),
+        (r"/api/sessions/(\w+)", SessionHandler, args),
+        (r"/api/sessions/(\w+)/messages", MessagesHandler, args),
+        (r"/api/sessions/(\w+)/stream", StreamHandler, args),
+        (r"/api/sessions/(\w+)/save", SaveHandler, args),
+        (r"/api/sessions/(\w+)/load", LoadHandler, args),
+        (r"/api/image", ImageHandler, args),
+        (r"/api/transcribe", TranscribeHandler, args),
+        (r"/api/tts", TTSHandler, args),
+    ])
+
+async def main():
+    parser = argparse.ArgumentParser(description="WaifuChat headless API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--max-models", type=int, default=2)
+    parser.add_argument("--batch-slots", type=int, default=0, help="Chats decoded together on the default model (0: off)")
+    parser.add_argument("--slot-ctx", type=int, default=4096, help="Context size of each batch slot")
+    args = parser.parse_args()
+
+    service = ChatService(args.model, pool=ModelPool(max_models=args.max_models), batch_slots=args.batch_slots, slot_ctx=args.slot_ctx)
+    make_app(service).listen(args.port, address=args.host)
+    print(f"WaifuChat API listening on http://{args.host}:{args.port}/api")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,8 +4,17 @@ import os
 import signal
 import sys
 import json
-from brain import WaifuAI
+from brain import WaifuAI, THOUGHT_START, THOUGHT_TEXT, THOUGHT_END, SPEECH_TEXT
+from stream_renderer import RenderScheduler
+from speech_pipeline import SpeechPipeline
+from draft_model import DRAFT_MODES, DRAFT_MODEL_PATH
+from model_pool import ModelPool, scan_models, model_path_for
+from chat_service import ChatService, ChatSession
+from asset_cache import AssetCache
+from audio_store import clip_key
+from chat_view import render_history, reset_history_view, rerun_view, record_render
 from character_manager import CharacterManager
+from memory_manager import MemoryManager
 from voice_manager import VoiceManager
 from vision_manager import VisionManager
 from hearing_manager import HearingManager
@@ -23,6 +32,7 @@ except ValueError:
 
 # Page Config
 st.set_page_config(page_title="WaifuChat Local", page_icon="💖", layout="wide")
+run_started = time.perf_counter()
 
 # Custom CSS for chat and thoughts
 st.markdown("""
@@ -156,12 +166,42 @@ st.markdown("""
 
 # Model Path
 MODEL_PATH = "./models/L3-8B-Stheno-v3.2-Q4_K_M.gguf"
+SESSIONS_PER_PAGE = 50 # Sessions offered per page in the Load list
+
+@st.cache_resource
+def get_model_pool():
+    """One pool for the whole process, so every browser tab shares the loaded models.
+
+    Each session still gets its own WaifuAI (persona, history, prompt cache) on top.
+    """
+    return ModelPool(max_models=2)
+
+@st.cache_resource
+def get_chat_service():
+    """Turn, save and load logic shared with api_server, on the same model pool."""
+    return ChatService(MODEL_PATH, pool=get_model_pool())
+
+def chat_session():
+    """This tab's chat as a ChatSession for ChatService; messages and persona are shared, not copied."""
+    return ChatSession(
+        None, st.session_state.char_mgr, st.session_state.waifu, st.session_state.user_persona,
+        messages=st.session_state.messages, current_emotion=st.session_state.current_emotion
+    )
+
+@st.cache_resource
+def get_asset_cache():
+    """Resized backgrounds and avatars, encoded once per file version for all sessions."""
+    return AssetCache()
 
 # Initialize Session State
 if "waifu" not in st.session_state:
     st.session_state.waifu = None
+if "model_pool" not in st.session_state:
+    st.session_state.model_pool = get_model_pool()
+if "memory_mgr" not in st.session_state:
+    st.session_state.memory_mgr = MemoryManager()
 if "char_mgr" not in st.session_state:
-    st.session_state.char_mgr = CharacterManager()
+    st.session_state.char_mgr = CharacterManager(memory_mgr=st.session_state.memory_mgr)
 if "voice_mgr" not in st.session_state:
     st.session_state.voice_mgr = VoiceManager()
 if "vision_mgr" not in st.session_state:
@@ -184,51 +224,6 @@ if "tts_enabled" not in st.session_state:
 if "user_persona" not in st.session_state:
     st.session_state.user_persona = {"name": "User", "description": ""}
 
-# Background Injection
-bg_image = st.session_state.char_mgr.get_background_image()
-current_hour = st.session_state.char_mgr.get_time()
-
-# Determine Time Overlay
-# Default (Day)
-overlay_color = "rgba(0, 0, 0, 0.5)" 
-
-if 5 <= current_hour < 8: # Dawn
-    overlay_color = "rgba(255, 200, 150, 0.4)"
-elif 8 <= current_hour < 17: # Day
-    overlay_color = "rgba(0, 0, 0, 0.3)"
-elif 17 <= current_hour < 20: # Sunset
-    overlay_color = "rgba(255, 100, 50, 0.3)"
-else: # Night
-    overlay_color = "rgba(10, 10, 40, 0.85)"
-
-if bg_image:
-    # Convert local path to a format we can display (base64 is safest for local files in streamlit)
-    import base64
-    def get_base64_of_bin_file(bin_file):
-        with open(bin_file, 'rb') as f:
-            data = f.read()
-        return base64.b64encode(data).decode()
-
-    bg_base64 = get_base64_of_bin_file(bg_image)
-    
-    st.markdown(
-        f"""
-        <style>
-        .stApp {{
-            background-image: linear-gradient({overlay_color}, {overlay_color}), url("data:image/png;base64,{bg_base64}");
-            background-size: cover;
-            background-position: center;
-            background-attachment: fixed;
-            transition: background-image 1s ease-in-out;
-        }}
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
-else:
-    # No image, just use color overlay on default dark theme
-    pass
-
 # Sidebar - Settings
 with st.sidebar:
     st.title("⚙️ Waifu Settings")
@@ -258,12 +253,16 @@ with st.sidebar:
         # Load new character config
         config = st.session_state.char_mgr.load_character(selected_char)
         st.session_state.current_char = selected_char
+        st.session_state.char_mgr.build_memory_index()
         st.session_state.messages = [] # Clear chat on switch
+        reset_history_view()
         st.session_state.current_emotion = "neutral"
         
         # Update AI Brain if loaded
         if st.session_state.waifu:
             st.session_state.waifu.clear_history()
+            with st.spinner("Switching model..."):
+                st.session_state.waifu.switch_model(model_path_for(config, MODEL_PATH))
             st.session_state.waifu.set_persona(
                 config["name"], 
                 config["description"], 
@@ -313,6 +312,13 @@ with st.sidebar:
                 edit_scenario = st.text_area("Scenario", value=current_config.get("scenario", ""), height=80)
                 edit_dialogue = st.text_area("Example Dialogue", value=current_config.get("example_dialogue", ""), height=100)
                 
+                # Model pin (empty = default model)
+                model_options = [""] + list(scan_models())
+                current_model = current_config.get("model", "")
+                if current_model not in model_options:
+                    model_options.append(current_model)
+                edit_model = st.selectbox("Model", model_options, index=model_options.index(current_model), format_func=lambda m: m or "Default")
+                
                 # Simple Avatar Map Editor (JSON text)
                 current_map_str = json.dumps(current_config.get("avatar_emotion_map", {}), indent=2, ensure_ascii=False)
                 edit_map_str = st.text_area("Avatar Map (JSON)", value=current_map_str, height=150)
@@ -370,12 +376,15 @@ with st.sidebar:
                             "background_image": edit_bg,
                             "lorebook": current_config.get("lorebook", {})
                         }
+                        if edit_model:
+                            new_config["model"] = edit_model
                         st.session_state.char_mgr.save_character(edit_name, new_config)
                         st.success(f"Updated {edit_name}!")
                         
                         # Reload to apply immediately
                         st.session_state.char_mgr.load_character(edit_name)
                         if st.session_state.waifu:
+                             st.session_state.waifu.switch_model(model_path_for(new_config, MODEL_PATH))
                              st.session_state.waifu.set_persona(
                                  edit_name, 
                                  edit_desc, 
@@ -404,6 +413,8 @@ with st.sidebar:
                 if col_add.button("➕"):
                     if new_lore_key and new_lore_content:
                         st.session_state.char_mgr.update_lore_entry(new_lore_key, new_lore_content)
+                        if st.session_state.waifu:
+                            st.session_state.waifu.update_lore_entry(new_lore_key, new_lore_content)
                         st.success(f"Added '{new_lore_key}'")
                         time.sleep(1)
                         st.rerun()
@@ -417,6 +428,8 @@ with st.sidebar:
                         c2.text(content)
                         if c3.button("🗑️", key=f"del_lore_{key}"):
                             st.session_state.char_mgr.delete_lore_entry(key)
+                            if st.session_state.waifu:
+                                st.session_state.waifu.delete_lore_entry(key)
                             st.rerun()
                 else:
                     st.caption("No lore entries yet.")
@@ -512,31 +525,58 @@ with st.sidebar:
     
     # Save
     new_save_name = st.text_input("Save Name (Optional)", placeholder="My Chat 1")
+    save_ai_state = st.checkbox("Also save AI state (instant resume, large file)", value=False)
     if st.button("Save Current Session"):
         if st.session_state.messages:
-            filename = st.session_state.char_mgr.save_session(
-                st.session_state.messages, 
-                new_save_name if new_save_name else None,
-                st.session_state.user_persona
-            )
+            save_ai_state = save_ai_state and st.session_state.waifu is not None
+            with st.spinner("Saving AI state..." if save_ai_state else "Saving..."):
+                filename = get_chat_service().save(chat_session(), new_save_name if new_save_name else None, save_state=save_ai_state)
             st.success(f"Saved to {filename}")
+            
+            state_path = st.session_state.char_mgr.get_session_state_path(filename)
+            if save_ai_state and state_path and os.path.exists(state_path):
+                st.caption(f"AI state saved ({os.path.getsize(state_path) // (1024 * 1024)} MB)")
         else:
             st.warning("Nothing to save yet.")
             
     # Load
-    saved_sessions = st.session_state.char_mgr.list_sessions()
+    session_query = st.text_input("Search Sessions", placeholder="Name or last line...")
+    session_total = st.session_state.char_mgr.count_sessions(session_query)
+    session_page = 0
+    if session_total > SESSIONS_PER_PAGE:
+        session_page = st.number_input(
+            f"Page (of {(session_total - 1) // SESSIONS_PER_PAGE + 1})", min_value=1,
+            max_value=(session_total - 1) // SESSIONS_PER_PAGE + 1, value=1
+        ) - 1
+    saved_sessions = {
+        info["name"]: info for info in st.session_state.char_mgr.list_session_info(
+            limit=SESSIONS_PER_PAGE, offset=session_page * SESSIONS_PER_PAGE, query=session_query
+        )
+    }
     if saved_sessions:
-        session_to_load = st.selectbox("Load Session", saved_sessions)
+        session_to_load = st.selectbox(
+            "Load Session", list(saved_sessions),
+            format_func=lambda name: f"{name} ({saved_sessions[name]['message_count']} msgs)"
+        )
+        if saved_sessions[session_to_load]["preview"]:
+            st.caption(saved_sessions[session_to_load]["preview"])
         if st.button("Load"):
-            loaded_msgs, loaded_user = st.session_state.char_mgr.load_session(session_to_load)
-            st.session_state.messages = loaded_msgs
-            st.session_state.user_persona = loaded_user
-            st.session_state.waifu.history = loaded_msgs
+            session = get_chat_service().load(chat_session(), session_to_load)
+            st.session_state.messages = session.messages
+            st.session_state.user_persona = session.user_persona
+            reset_history_view()
             st.success("Session Loaded!")
             st.rerun()
+    elif session_query:
+        st.info("No sessions match.")
     else:
         st.info("No saved sessions for this character.")
 
+    if st.button("🧹 Clean Up Voice Clips", help="Deletes voice clips that no saved session uses"):
+        with st.spinner("Checking saved sessions..."):
+            removed, freed = st.session_state.char_mgr.gc_audio(live_messages=st.session_state.messages)
+        st.caption(f"Removed {removed} clips ({freed // 1024} KB)")
+
     # --- Diary Actions ---
     st.divider()
     st.subheader("📔 Diary & Dreams")
@@ -586,8 +626,78 @@ with st.sidebar:
     min_p = st.slider("Min-P", 0.0, 1.0, 0.05)
     top_k = st.slider("Top-K", 0, 100, 40)
     
+    with st.expander("🧠 Long-term Memory"):
+        memory_k = st.slider("Memories recalled per turn", 0, 10, 3)
+        memory_budget = st.slider("Memory Token Budget", 0, 1500, 400, step=50)
+        if st.session_state.waifu:
+            st.session_state.waifu.memory_token_budget = memory_budget
+    
+    with st.expander("📖 World Info Injection"):
+        lore_budget = st.slider("Lore Token Budget", 0, 2000, 800, step=50)
+        lore_depth = st.slider("Recursion Depth", 0, 3, 1, help="How many times injected entries are scanned for further keywords")
+        lore_dedup = st.slider("Skip if injected in last N turns", 0, 10, 4)
+        if st.session_state.waifu:
+            injector = st.session_state.waifu.lore_injector
+            injector.token_budget = lore_budget
+            injector.recursion_depth = lore_depth
+            injector.dedup_turns = lore_dedup
+            if st.session_state.waifu.last_lore_keys:
+                st.caption("Last injected: " + ", ".join(st.session_state.waifu.last_lore_keys))
+    
+    with st.expander("🚀 Speculative Decoding"):
+        draft_labels = {"off": "Off", "prompt_lookup": "Prompt Lookup (n-grams from chat)", "draft_model": "Small Draft Model"}
+        draft_mode = st.selectbox("Drafting", DRAFT_MODES, format_func=draft_labels.get, help="Guessed tokens are checked by the main model in one batch")
+        draft_tokens = st.slider("Tokens drafted per step", 1, 16, 10 if draft_mode == "prompt_lookup" else 4)
+        draft_path = DRAFT_MODEL_PATH
+        if draft_mode == "draft_model":
+            draft_path = st.text_input("Draft Model Path", value=DRAFT_MODEL_PATH, help="Must share the main model's tokenizer (Llama 3)")
+        if st.session_state.waifu:
+            waifu = st.session_state.waifu
+            if draft_mode != "off" and not waifu.speculative:
+                st.caption("The model has to be reloaded with speculative decoding support.")
+                if st.button("Reload Brain"):
+                    st.session_state.restore_history = waifu.history
+                    st.session_state.waifu = None
+                    waifu.close()
+                    st.rerun()
+            elif not waifu.set_draft_mode(draft_mode, draft_tokens, draft_path):
+                st.error("Could not enable drafting, check the console.")
+            gen = waifu.last_generation_stats
+            if gen:
+                st.caption(f"Last reply: {gen['tokens']} tokens, {gen['tokens_per_sec']:.1f} tok/s")
+                if "drafted" in gen:
+                    st.caption(f"Accepted {gen['accepted']} of {gen['drafted']} drafted tokens ({gen['acceptance_rate']:.0%})")
+    
+    with st.expander("⚡ Streaming"):
+        render_fps = st.slider("Screen Updates per Second", 1, 60, 12, help="Streamed tokens are batched into this many redraws")
+        render_chars = st.slider("Redraw after N new characters", 20, 1000, 200, step=20)
+    
+    with st.expander("📦 Models"):
+        pool = st.session_state.model_pool
+        pool.max_models = st.slider("Models kept loaded", 1, 4, pool.max_models)
+        ram_gb = st.slider("RAM budget (GB, 0 = no limit)", 0, 128, 0)
+        pool.ram_budget_bytes = ram_gb * 1024 ** 3 or None
+        report = pool.report()
+        st.caption(f"{report['hits']} hits / {report['misses']} loads ({report['hit_rate']:.0%} hit rate), {report['evictions']} evicted, {report['load_seconds']:.1f}s loading")
+        for model in report["resident"]:
+            st.caption(f"• {model['model']}: ~{model['footprint'] / 1024 ** 3:.1f} GB, loaded in {model['load_seconds']:.1f}s, {model['users']} sessions, {model['queued']} waiting (max wait {model['max_wait_seconds']:.1f}s)")
+    
     with st.expander("🧠 Brain Scan (Debug)"):
         if st.session_state.waifu and st.session_state.waifu.last_prompt:
+            prefill = st.session_state.waifu.prompt_cache.last_stats
+            st.caption(f"Prompt: {prefill['prompt_tokens']} tokens ({prefill['cached_tokens']} cached, {prefill['evaluated_tokens']} evaluated)")
+            budget = st.session_state.waifu.last_budget
+            if budget:
+                st.caption(f"Context: {budget['n_ctx']} = system {budget['system']} + world info & memories {budget['context']} + new turn {budget['new_turn']} + reply {budget['response']} + history {budget['history']} + free {budget['free']}")
+            render_times = st.session_state.get("render_times", {})
+            if render_times:
+                st.caption("Render: " + ", ".join(f"{kind} {samples[-1]:.0f} ms (avg {sum(samples) / len(samples):.0f})" for kind, samples in render_times.items()))
+            render_stats = st.session_state.get("last_render_stats")
+            if render_stats:
+                st.caption(f"Stream: {render_stats['tokens']} tokens in {render_stats['elapsed']:.2f}s ({render_stats['tokens_per_sec']:.1f} tok/s), {render_stats['renders']} redraws for {render_stats['requests']} updates, {render_stats['render_time'] * 1000:.0f} ms rendering")
+            voice_stats = st.session_state.get("last_voice_stats")
+            if voice_stats and voice_stats["first_audio"] is not None:
+                st.caption(f"Voice: first audio after {voice_stats['first_audio']:.2f}s, {voice_stats['sentences']} sentences, {voice_stats['audio_seconds']:.1f}s of speech")
             st.text_area("Last Raw Prompt", value=st.session_state.waifu.last_prompt, height=300)
         else:
             st.caption("No prompt generated yet.")
@@ -614,6 +724,15 @@ with st.sidebar:
         with col_r:
             rate_val = st.slider("Speed (%)", -50, 50, 0, step=10)
             st.session_state.tts_rate = f"{rate_val:+d}%"
+        
+        st.session_state.tts_streaming = st.checkbox(
+            "Speak While Typing", value=st.session_state.get("tts_streaming", True),
+            help="Voices each sentence as soon as it is written instead of after the whole reply"
+        )
+        
+        tts_cache = st.session_state.voice_mgr.cache.report()
+        st.caption(f"Voice cache: {tts_cache['clips']} clips, {tts_cache['bytes'] // (1024 * 1024)} MB, "
+                   f"{tts_cache['hit_rate']:.0%} hits")
     else:
         # Defaults if disabled to avoid errors
         st.session_state.tts_voice = "en-US-AriaNeural"
@@ -621,20 +740,11 @@ with st.sidebar:
         st.session_state.tts_rate = "+0%"
         
     # --- Status & Living World (v1.3) ---
+    # The sidebar runs before the background and main_view, so changes made here are
+    # already drawn in the same run; these handlers don't need a second rerun
     st.divider()
     st.subheader("💗 Status")
     
-    # Get stats
-    current_stats = st.session_state.char_mgr.get_stats()
-    
-    # Affection Bar
-    st.write("Affection")
-    st.progress(current_stats.get("affection", 0) / 100.0)
-    
-    # Energy Bar
-    st.write("Energy")
-    st.progress(current_stats.get("energy", 100) / 100.0)
-    
     # Gifts
     st.caption("🎁 Give Gift")
     col_g1, col_g2 = st.columns([2, 1])
@@ -650,8 +760,6 @@ with st.sidebar:
         st.session_state.char_mgr.update_stats(effect["aff"], effect["nrg"])
         st.session_state.messages.append({"role": "system", "content": f"*{effect['msg']}*"})
         st.success(f"Gave {selected_gift}")
-        time.sleep(1)
-        st.rerun()
     
     # Location
     st.subheader("🗺️ Location")
@@ -664,382 +772,386 @@ with st.sidebar:
         st.session_state.char_mgr.set_location(new_loc)
         # Add a system message about travel
         st.session_state.messages.append({"role": "system", "content": f"*You traveled to the {new_loc}.*"})
-        st.rerun()
         
     # Time Control
     st.subheader("🕰️ Time")
     
-    current_time_int = st.session_state.char_mgr.get_time()
-    
-    # Format nicely (08:00 AM)
-    am_pm = "AM" if current_time_int < 12 else "PM"
-    disp_hour = current_time_int if current_time_int <= 12 else current_time_int - 12
-    if disp_hour == 0: disp_hour = 12
-    
-    st.write(f"**Clock: {disp_hour}:00 {am_pm}**")
+    # Filled in below the button, so the clock shows the hour after waiting
+    clock_placeholder = st.empty()
     
     if st.button("Wait 1 Hour (+Energy)"):
         # Advance time
-        new_time = (current_time_int + 1) % 24
+        new_time = (st.session_state.char_mgr.get_time() + 1) % 24
         st.session_state.char_mgr.set_time(new_time)
         
         # Restore energy
         st.session_state.char_mgr.update_stats(energy_delta=10)
         st.success("Time passes...")
-        time.sleep(0.5)
-        st.rerun()
+        
+    current_time_int = st.session_state.char_mgr.get_time()
+    
+    # Format nicely (08:00 AM)
+    am_pm = "AM" if current_time_int < 12 else "PM"
+    disp_hour = current_time_int if current_time_int <= 12 else current_time_int - 12
+    if disp_hour == 0: disp_hour = 12
+    
+    clock_placeholder.write(f"**Clock: {disp_hour}:00 {am_pm}**")
     
     # Clear Chat
     if st.button("Reset Chat"):
         st.session_state.messages = []
+        reset_history_view()
         st.session_state.waifu.clear_history()
         st.rerun()
 
+# Background Injection
+# Drawn after the sidebar, so travelling or waiting an hour there shows up in the same run
+bg_image = st.session_state.char_mgr.get_background_image()
+current_hour = st.session_state.char_mgr.get_time()
+
+# Determine Time Overlay
+# Default (Day)
+overlay_color = "rgba(0, 0, 0, 0.5)" 
+
+if 5 <= current_hour < 8: # Dawn
+    overlay_color = "rgba(255, 200, 150, 0.4)"
+elif 8 <= current_hour < 17: # Day
+    overlay_color = "rgba(0, 0, 0, 0.3)"
+elif 17 <= current_hour < 20: # Sunset
+    overlay_color = "rgba(255, 100, 50, 0.3)"
+else: # Night
+    overlay_color = "rgba(10, 10, 40, 0.85)"
+
+bg_url = get_asset_cache().background_url(bg_image) if bg_image else None
+if bg_url:
+    # Served from static/, so the page only carries the URL and the browser caches the image
+    st.markdown(
+        f"""
+        <style>
+        .stApp {{
+            background-image: linear-gradient({overlay_color}, {overlay_color}), url("{bg_url}");
+            background-size: cover;
+            background-position: center;
+            background-attachment: fixed;
+            transition: background-image 1s ease-in-out;
+        }}
+        </style>
+        """,
+        unsafe_allow_html=True
+    )
+else:
+    # No image, just use color overlay on default dark theme
+    pass
+
 # Main Layout
-col1, col2 = st.columns([1, 3])
+# Avatar and chat are one fragment: sending, editing or regenerating a message only
+# re-renders these two columns, not the sidebar and background
+@st.fragment
+def main_view():
+    view_started = time.perf_counter()
+    col1, col2 = st.columns([1, 3])
 
-# Left Column: Avatar
-with col1:
-    # Get current avatar based on emotion
-    avatar_result = st.session_state.char_mgr.get_avatar_for_emotion(st.session_state.current_emotion)
+    # Left Column: Avatar
+    with col1:
+        # Get current avatar based on emotion
+        avatar_result = st.session_state.char_mgr.get_avatar_for_emotion(st.session_state.current_emotion)
     
-    if os.path.exists(avatar_result) and (avatar_result.endswith(".png") or avatar_result.endswith(".jpg") or avatar_result.endswith(".jpeg")):
-        # It's an image file
-        st.image(avatar_result, width=300)
-    else:
-        # It's an emoji
-        st.markdown(f'<div class="big-avatar">{avatar_result}</div>', unsafe_allow_html=True)
+        if os.path.exists(avatar_result) and (avatar_result.endswith(".png") or avatar_result.endswith(".jpg") or avatar_result.endswith(".jpeg")):
+            # It's an image file
+            avatar_url = get_asset_cache().avatar_url(avatar_result)
+            st.markdown(f'<div class="big-avatar"><img src="{avatar_url}"></div>', unsafe_allow_html=True)
+        else:
+            # It's an emoji
+            st.markdown(f'<div class="big-avatar">{avatar_result}</div>', unsafe_allow_html=True)
+        
+        st.markdown(f"<h3 style='text-align: center;'>{st.session_state.current_char}</h3>", unsafe_allow_html=True)
+        st.markdown(f"<p style='text-align: center; color: #888;'>Current Mood: {st.session_state.current_emotion}</p>", unsafe_allow_html=True)
         
-    st.markdown(f"<h3 style='text-align: center;'>{st.session_state.current_char}</h3>", unsafe_allow_html=True)
-    st.markdown(f"<p style='text-align: center; color: #888;'>Current Mood: {st.session_state.current_emotion}</p>", unsafe_allow_html=True)
+        # Stats live next to the avatar so they refresh with the chat view after every reply
+        current_stats = st.session_state.char_mgr.get_stats()
+        st.write("Affection")
+        st.progress(current_stats.get("affection", 0) / 100.0)
+        st.write("Energy")
+        st.progress(current_stats.get("energy", 100) / 100.0)
 
-# Right Column: Chat
-with col2:
-    # Initialize AI if not ready
-    if st.session_state.waifu is None:
-        if os.path.exists(MODEL_PATH):
-            with st.spinner("Loading AI Brain (this takes a moment)..."):
-                try:
-                    st.session_state.waifu = WaifuAI(MODEL_PATH)
-                    # Load initial character
-                    config = st.session_state.char_mgr.load_character(selected_char)
-                    st.session_state.waifu.set_persona(
-                        config["name"], 
-                        config["description"], 
-                        config["scenario"], 
-                        config["example_dialogue"],
-                        user_name=st.session_state.user_persona["name"],
-                        lorebook=config.get("lorebook", {}),
-                        past_events=st.session_state.char_mgr.get_recent_diary_entries(),
-                        stats=st.session_state.char_mgr.get_stats(),
-                        location=st.session_state.char_mgr.get_location(),
-                        current_time_str=f"{st.session_state.char_mgr.get_time()}:00"
-                    )
+    # Right Column: Chat
+    with col2:
+        # Initialize AI if not ready
+        if st.session_state.waifu is None:
+            # Load initial character
+            config = st.session_state.char_mgr.load_character(selected_char)
+            model_path = model_path_for(config, MODEL_PATH)
+            if os.path.exists(model_path):
+                with st.spinner("Loading AI Brain (this takes a moment)..."):
+                    try:
+                        st.session_state.waifu = WaifuAI(model_path, speculative=draft_mode != "off", pool=st.session_state.model_pool)
+                        st.session_state.waifu.set_persona(
+                            config["name"], 
+                            config["description"], 
+                            config["scenario"], 
+                            config["example_dialogue"],
+                            user_name=st.session_state.user_persona["name"],
+                            lorebook=config.get("lorebook", {}),
+                            past_events=st.session_state.char_mgr.get_recent_diary_entries(),
+                            stats=st.session_state.char_mgr.get_stats(),
+                            location=st.session_state.char_mgr.get_location(),
+                            current_time_str=f"{st.session_state.char_mgr.get_time()}:00"
+                        )
+                        st.session_state.waifu.set_draft_mode(draft_mode, draft_tokens, draft_path)
+                    
+                        # Reloaded for speculative decoding, keep the conversation
+                        if "restore_history" in st.session_state:
+                            st.session_state.waifu.history = st.session_state.pop("restore_history")
                     
-                    # Check for offline progression (Initial Load)
-                    offline_report = st.session_state.char_mgr.process_offline_time()
-                    if offline_report:
-                        st.toast(f"While you were gone: {offline_report}", icon="🕰️")
-                        # Inject as system context
-                        st.session_state.messages.append({"role": "system", "content": f"*[System: While the user was away, you {offline_report}]*"})
+                        # Check for offline progression (Initial Load)
+                        offline_report = st.session_state.char_mgr.process_offline_time()
+                        if offline_report:
+                            st.toast(f"While you were gone: {offline_report}", icon="🕰️")
+                            # Inject as system context
+                            st.session_state.messages.append({"role": "system", "content": f"*[System: While the user was away, you {offline_report}]*"})
                         
-                    st.success("Connected!")
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Failed to load model: {e}")
-        else:
-            st.warning("Please download the model first using download_model.py")
-            st.stop()
-
-    if "editing_msg" not in st.session_state:
-        st.session_state.editing_msg = None # {index: int, content: str}
-    if "should_continue" not in st.session_state:
-        st.session_state.should_continue = False
-
-    # Display Chat History
-    for i, message in enumerate(st.session_state.messages):
-        with st.chat_message(message["role"]):
-            if st.session_state.editing_msg and st.session_state.editing_msg["index"] == i:
-                # Edit Mode
-                new_content = st.text_area("Edit Message", value=st.session_state.editing_msg["content"], key=f"edit_area_{i}")
-                col_save, col_cancel = st.columns([1, 1])
-                if col_save.button("Save", key=f"save_{i}"):
-                    st.session_state.messages[i]["content"] = new_content
-                    # If it was an AI message, we might want to strip thoughts if editing speech only?
-                    # For simplicity, we overwrite the whole content.
-                    st.session_state.waifu.edit_message(i, new_content)
-                    st.session_state.editing_msg = None
-                    st.rerun()
-                if col_cancel.button("Cancel", key=f"cancel_{i}"):
-                    st.session_state.editing_msg = None
-                    st.rerun()
+                        st.success("Connected!")
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Failed to load model: {e}")
             else:
-                # View Mode
-                if message["role"] == "assistant":
-                    # Check for thoughts
-                    content = message["content"]
-                    thought = None
-                    speech = content
-                    
-                    if "<thought>" in content and "</thought>" in content:
-                        start = content.find("<thought>") + len("<thought>")
-                        end = content.find("</thought>")
-                        thought = content[start:end].strip()
-                        speech = content[end+len("</thought>"):].strip()
-                    
-                    if thought:
-                        with st.expander("💭 Inner Thoughts"):
-                            st.markdown(f"*{thought}*")
-                    st.markdown(speech)
-                    
-                    # Audio Playback (if saved in session state or just generated)
-                    if "audio" in message:
-                        import base64
-                        # Decode base64 to bytes for st.audio
-                        try:
-                            audio_bytes = base64.b64decode(message["audio"])
-                            st.audio(audio_bytes, format="audio/mp3")
-                        except Exception:
-                            # Fallback if it was somehow stored raw or corrupted
-                            pass
-                    
-                    # Edit / Regenerate Tools
-                    col_tools1, col_tools2, col_tools3 = st.columns([1, 1, 8])
-                    with col_tools1:
-                        if i == len(st.session_state.messages) - 1: # Only last message
-                            if st.button("🔄", key=f"regen_{i}", help="Regenerate Last Response"):
-                                st.session_state.messages.pop()
-                                st.session_state.waifu.regenerate_last()
-                                st.session_state.should_regenerate = True
-                                st.rerun()
-                    with col_tools2:
-                         if st.button("✏️", key=f"edit_btn_{i}", help="Edit Message"):
-                             st.session_state.editing_msg = {"index": i, "content": message["content"]}
-                             st.rerun()
+                st.warning("Please download the model first using download_model.py")
+                st.stop()
 
-                else:
-                    # User Message
-                    st.markdown(message["content"])
-                    col_user_edit, _ = st.columns([1, 9])
-                    with col_user_edit:
-                         if st.button("✏️", key=f"edit_user_{i}", help="Edit Message"):
-                             st.session_state.editing_msg = {"index": i, "content": message["content"]}
-                             st.rerun()
+        if "editing_msg" not in st.session_state:
+            st.session_state.editing_msg = None # {index: int, content: str}
+        if "should_continue" not in st.session_state:
+            st.session_state.should_continue = False
 
-    # Chat Input Logic
+        # Display Chat History
+        render_history(st.session_state.messages)
+
+        # Chat Input Logic
     
-    # Audio Input (Hearing)
-    audio_val = st.audio_input("🎤 Speak to her")
+        # Audio Input (Hearing)
+        audio_val = st.audio_input("🎤 Speak to her")
     
-    # Logic to handle audio input
-    # We need to ensure we only transcribe NEW audio. 
-    # st.audio_input returns the buffer.
+        # Logic to handle audio input
+        # We need to ensure we only transcribe NEW audio. 
+        # st.audio_input returns the buffer.
     
-    if "last_audio_id" not in st.session_state:
-        st.session_state.last_audio_id = None
+        if "last_audio_id" not in st.session_state:
+            st.session_state.last_audio_id = None
         
-    if audio_val:
-        # Use the buffer ID or similar as a unique tracker? 
-        # Or just the object identity if it changes?
-        # Streamlit re-creates the object on new recording.
+        if audio_val:
+            # Use the buffer ID or similar as a unique tracker? 
+            # Or just the object identity if it changes?
+            # Streamlit re-creates the object on new recording.
         
-        if audio_val != st.session_state.last_audio_id:
-            with st.spinner("Listening..."):
-                transcribed_text = st.session_state.hearing_mgr.transcribe(audio_val)
-                if transcribed_text:
-                    # Treat as user input
-                    # We inject it into the chat logic below by setting a temporary variable
-                    # that overrides the text input
-                    st.session_state.audio_transcription = transcribed_text
-                    st.session_state.last_audio_id = audio_val
-                    st.rerun()
+            if audio_val != st.session_state.last_audio_id:
+                with st.spinner("Listening..."):
+                    transcribed_text = st.session_state.hearing_mgr.transcribe(audio_val)
+                    if transcribed_text:
+                        # Treat as user input
+                        # We inject it into the chat logic below by setting a temporary variable
+                        # that overrides the text input
+                        st.session_state.audio_transcription = transcribed_text
+                        st.session_state.last_audio_id = audio_val
+                        rerun_view()
     
-    # Image Input (Vision)
-    with st.expander("📷 Show her something (Send Image)"):
-        uploaded_vision_image = st.file_uploader("Upload Image", type=["png", "jpg", "jpeg"], key="vision_uploader")
-        if uploaded_vision_image and st.button("Send Image"):
-            with st.spinner("Analyzing image..."):
-                from PIL import Image
-                image = Image.open(uploaded_vision_image)
+        # Image Input (Vision)
+        with st.expander("📷 Show her something (Send Image)"):
+            uploaded_vision_image = st.file_uploader("Upload Image", type=["png", "jpg", "jpeg"], key="vision_uploader")
+            if uploaded_vision_image and st.button("Send Image"):
+                with st.spinner("Analyzing image..."):
+                    from PIL import Image
+                    image = Image.open(uploaded_vision_image)
                 
-                # 1. Get Caption
-                caption = st.session_state.vision_mgr.caption_image(image)
+                    # 1. Get Caption
+                    caption = st.session_state.vision_mgr.caption_image(image)
                 
-                # 2. Add to chat as user message with special formatting
-                user_msg_content = f"[User showed an image: {caption}]"
+                    # 2. Add to chat as user message with special formatting
+                    user_msg_content = f"[User showed an image: {caption}]"
                 
-                # 3. Append to history
-                st.session_state.messages.append({"role": "user", "content": user_msg_content})
+                    # 3. Append to history
+                    st.session_state.messages.append({"role": "user", "content": user_msg_content})
                 
-                # 4. Display immediately (we can't easily show the image inside the chat bubble in this loop, 
-                # but we can show the text representation. 
-                # Ideally, we'd store the image data in the message to render it, 
-                # but for now text is enough for the AI.)
+                    # 4. Display immediately (we can't easily show the image inside the chat bubble in this loop, 
+                    # but we can show the text representation. 
+                    # Ideally, we'd store the image data in the message to render it, 
+                    # but for now text is enough for the AI.)
                 
-                # Let's try to store a small thumbnail or base64 if we want to render it later.
-                # For now, let's just trigger the response.
-                st.success(f"Sent: {caption}")
-                st.session_state.should_regenerate = False # Ensure we don't regen previous
-                # Rerun to show the new message and trigger AI
-                st.rerun()
+                    # Let's try to store a small thumbnail or base64 if we want to render it later.
+                    # For now, let's just trigger the response.
+                    st.success(f"Sent: {caption}")
+                    st.session_state.should_regenerate = False # Ensure we don't regen previous
+                    # Rerun to show the new message and trigger AI
+                    rerun_view()
 
-    # Continue Button (centered below chat)
-    col_cont, _ = st.columns([1, 4])
-    with col_cont:
-        if st.button("🗣️ Let her speak"):
-            st.session_state.should_continue = True
-            st.rerun()
+        # Continue Button (centered below chat)
+        col_cont, _ = st.columns([1, 4])
+        with col_cont:
+            if st.button("🗣️ Let her speak"):
+                st.session_state.should_continue = True
+                rerun_view()
 
-    if "audio_transcription" in st.session_state and st.session_state.audio_transcription:
-        # Override user input with transcription
-        user_input = st.session_state.audio_transcription
-        # Clear it so we don't loop
-        del st.session_state.audio_transcription
-    else:
-        user_input = st.chat_input("Say something...")
+        if "audio_transcription" in st.session_state and st.session_state.audio_transcription:
+            # Override user input with transcription
+            user_input = st.session_state.audio_transcription
+            # Clear it so we don't loop
+            del st.session_state.audio_transcription
+        else:
+            user_input = st.chat_input("Say something...")
     
-    if user_input or st.session_state.should_regenerate or st.session_state.should_continue or (st.session_state.messages and st.session_state.messages[-1]["content"].startswith("[User showed an image:")):
-        # Handle Regeneration
-        if st.session_state.should_regenerate:
-            # Get the last user message
-            if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
-                user_input = st.session_state.messages[-1]["content"]
-                # We don't append it again because it's already in history
-            else:
-                st.error("Cannot regenerate: No user message found to respond to.")
-                st.session_state.should_regenerate = False
-                st.stop()
+        if user_input or st.session_state.should_regenerate or st.session_state.should_continue or (st.session_state.messages and st.session_state.messages[-1]["content"].startswith("[User showed an image:")):
+            new_message = False # Whether ChatService adds user_input to the chat
+            # Handle Regeneration
+            if st.session_state.should_regenerate:
+                # Get the last user message
+                if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+                    user_input = st.session_state.messages[-1]["content"]
+                    # We don't append it again because it's already in history
+                else:
+                    st.error("Cannot regenerate: No user message found to respond to.")
+                    st.session_state.should_regenerate = False
+                    st.stop()
         
-        # Handle Continue
-        elif st.session_state.should_continue:
-            # We treat this as a system push
-            # But we need to trick the 'user' input logic or just skip to generation
-            # Actually, the logic below expects a user message to be appended if we are not regenerating.
-            # So we append a system note disguised as user role for the prompt? 
-            # Or better: We append a system message, and then the AI responds to the history.
+            # Handle Continue
+            elif st.session_state.should_continue:
+                # We treat this as a system push
+                # But we need to trick the 'user' input logic or just skip to generation
+                # Actually, the logic below expects a user message to be appended if we are not regenerating.
+                # So we append a system note disguised as user role for the prompt? 
+                # Or better: We append a system message, and then the AI responds to the history.
             
-            user_input = "(The user listens intently...)"
-            # Note: We used to append this to messages, but the logic below 
-            # `if user_input or ...` enters this block.
+                user_input = "(The user listens intently...)"
+                # Note: We used to append this to messages, but the logic below 
+                # `if user_input or ...` enters this block.
             
-            # If we just appended it in the button click, we wouldn't need this block.
-            # But the button click just sets the flag and reruns.
+                # If we just appended it in the button click, we wouldn't need this block.
+                # But the button click just sets the flag and reruns.
             
-            st.session_state.messages.append({"role": "system", "content": user_input})
-            with st.chat_message("system"):
-                st.markdown(f"*{user_input}*")
+                st.session_state.messages.append({"role": "system", "content": user_input})
+                with st.chat_message("system"):
+                    st.markdown(f"*{user_input}*")
                 
-        elif st.session_state.messages and st.session_state.messages[-1]["content"].startswith("[User showed an image:"):
-             # Image was just sent, so we don't need to append anything new.
-             # Just set user_input to the image caption for context if needed, 
-             # but the loop below uses history anyway.
-             user_input = st.session_state.messages[-1]["content"]
-             pass
+            elif st.session_state.messages and st.session_state.messages[-1]["content"].startswith("[User showed an image:"):
+                 # Image was just sent, so we don't need to append anything new.
+                 # Just set user_input to the image caption for context if needed, 
+                 # but the loop below uses history anyway.
+                 user_input = st.session_state.messages[-1]["content"]
+                 pass
                 
-        else:
-            # Normal user input (Text)
-            # Only append if it wasn't an image send (which appends its own message)
-            # Wait, if we sent an image, `user_input` (chat_input) is likely None.
-            # So we only enter here if `user_input` is NOT None.
+            else:
+                # Normal user input (Text)
+                # ChatService adds it to the chat (an image send already added its own message)
+                # Wait, if we sent an image, `user_input` (chat_input) is likely None.
+                # So we only enter here if `user_input` is NOT None.
             
-            st.session_state.messages.append({"role": "user", "content": user_input})
-            with st.chat_message("user"):
-                st.markdown(user_input)
+                new_message = True
+                with st.chat_message("user"):
+                    st.markdown(user_input)
 
-        # Reset flags
-        st.session_state.should_regenerate = False
-        st.session_state.should_continue = False
+            # Reset flags
+            st.session_state.should_regenerate = False
+            st.session_state.should_continue = False
 
-        # Generate response
-        with st.chat_message("assistant"):
-            response_placeholder = st.empty()
-            thought_placeholder = st.empty()
+            # Generate response
+            with st.chat_message("assistant"):
+                response_placeholder = st.empty()
+                thought_placeholder = st.empty()
             
-            full_response = ""
-            is_thinking = False
+                speech_text = ""
+                thought_content = ""
             
-            # Generator
-            for chunk in st.session_state.waifu.generate_response(
-                user_input, 
-                temperature=temp,
-                repetition_penalty=rep_pen,
-                min_p=min_p,
-                top_k=top_k
-            ):
-                full_response += chunk
+                tts_voice = st.session_state.get("tts_voice", "en-US-AriaNeural")
+                tts_pitch = st.session_state.get("tts_pitch", "+0Hz")
+                tts_rate = st.session_state.get("tts_rate", "+0%")
                 
-                # Real-time thought parsing
-                if "<thought>" in full_response and not is_thinking:
-                    is_thinking = True
-                    thought_placeholder.markdown("💭 *Thinking...*")
-                
-                if "</thought>" in full_response and is_thinking:
-                    is_thinking = False
-                    # Extract thought
-                    start = full_response.find("<thought>") + len("<thought>")
-                    end = full_response.find("</thought>")
-                    thought_content = full_response[start:end].strip()
+                # Voice each sentence while the rest is still being generated
+                voice = None
+                voice_placeholder = st.empty()
+                if st.session_state.tts_enabled and st.session_state.get("tts_streaming", True):
+                    voice_mgr = st.session_state.voice_mgr
+                    voice = SpeechPipeline(submit=lambda sentence: voice_mgr.submit_audio(sentence, voice=tts_voice, pitch=tts_pitch, rate=tts_rate))
                     
-                    # Update Emotion State
-                    # Simple heuristic: Check thought for emotion keywords
-                    emotion_found = False
-                    config = st.session_state.char_mgr.character_config
-                    if "avatar_emotion_map" in config:
-                        for emotion_key in config["avatar_emotion_map"]:
-                            if emotion_key in thought_content.lower():
-                                st.session_state.current_emotion = emotion_key
-                                emotion_found = True
-                                break
-                    if not emotion_found:
-                        st.session_state.current_emotion = "neutral"
+                # Generator (parsed into thought/speech events as it streams); ChatService
+                # recalls memories, and updates stats, emotion and the chat when it is done
+                session = chat_session()
+                renderer = RenderScheduler(fps=render_fps, max_pending_chars=render_chars)
+                for kind, text in get_chat_service().run_turn(
+                    session,
+                    user_input, 
+                    memory_k=memory_k,
+                    add_user_message=new_message,
+                    temperature=temp,
+                    repetition_penalty=rep_pen,
+                    min_p=min_p,
+                    top_k=top_k
+                ):
+                    if kind == THOUGHT_START:
+                        thought_content = ""
+                        renderer.request(lambda: thought_placeholder.markdown("💭 *Thinking...*"), force=True)
                     
-                    thought_placeholder.empty()
-                    with thought_placeholder.expander("💭 Inner Thoughts", expanded=True):
-                        st.markdown(f"*{thought_content}*")
+                    elif kind == THOUGHT_TEXT:
+                        thought_content += text
+                    
+                    elif kind == THOUGHT_END:
+                        thought_content = thought_content.strip()
+                    
+                        # Tag transition, draw pending speech and the thought right away
+                        renderer.flush()
+                        thought_placeholder.empty()
+                        with thought_placeholder.expander("💭 Inner Thoughts", expanded=True):
+                            st.markdown(f"*{thought_content}*")
                 
-                # Display speech
-                if not is_thinking and "</thought>" in full_response:
-                     speech_part = full_response.split("</thought>")[-1]
-                     response_placeholder.markdown(speech_part + "▌")
-                elif not is_thinking and "<thought>" not in full_response:
-                     response_placeholder.markdown(full_response + "▌")
+                    elif kind == SPEECH_TEXT:
+                        # Display speech
+                        speech_text += text
+                        renderer.request(lambda: response_placeholder.markdown(speech_text + "▌"), chars=len(text))
+                        if voice:
+                            voice.feed(text)
+                            
+                    # Play the next sentence once it is synthesized and the previous one has finished
+                    if voice:
+                        for clip in voice.due():
+                            voice_placeholder.audio(clip, format="audio/mp3", autoplay=True)
+                    
+                st.session_state.last_render_stats = renderer.finish(tokens=st.session_state.waifu.last_parse.chunks)
 
-            # Final cleanup
-            final_thought, final_speech, final_mood = st.session_state.waifu.get_last_thought_and_response()
-            
-            # Analyze Sentiment & Update Stats
-            aff_delta, en_delta = st.session_state.waifu.analyze_sentiment(user_input)
-            new_stats = st.session_state.char_mgr.update_stats(aff_delta, en_delta)
-            
-            # Update Emotion based on Model Output
-            if final_mood and final_mood != "neutral":
-                 st.session_state.current_emotion = final_mood
+                # Final cleanup
+                final_thought, final_speech, final_mood = st.session_state.waifu.get_last_thought_and_response()
+                st.session_state.current_emotion = session.current_emotion
                  
-            response_placeholder.markdown(final_speech)
+                response_placeholder.markdown(final_speech)
+                if not final_thought:
+                    # A thought cut off before </thought> ends up as speech
+                    thought_placeholder.empty()
             
-            # Audio Generation
-            audio_b64 = None
-            if st.session_state.tts_enabled:
-                with st.spinner("Generating Voice..."):
-                    # Use final_speech (stripped of thoughts)
-                    audio_b64 = st.session_state.voice_mgr.get_audio_base64(
-                        final_speech,
-                        voice=st.session_state.get("tts_voice", "en-US-AriaNeural"),
-                        pitch=st.session_state.get("tts_pitch", "+0Hz"),
-                        rate=st.session_state.get("tts_rate", "+0%")
-                    )
-                    if audio_b64:
-                        import base64
-                        # Decode base64 to bytes for st.audio
-                        try:
-                            audio_bytes = base64.b64decode(audio_b64)
+                # Audio Generation
+                audio_bytes = None
+                if voice:
+                    voice.close()
+                    with st.spinner("Speaking..."):
+                        # Stay until the last sentence has played, the rerun below would cut it off
+                        voice.play_remaining(lambda clip: voice_placeholder.audio(clip, format="audio/mp3", autoplay=True))
+                    audio_bytes = voice.audio() or None
+                    st.session_state.last_voice_stats = voice.stats()
+                elif st.session_state.tts_enabled:
+                    with st.spinner("Generating Voice..."):
+                        # Use final_speech (stripped of thoughts)
+                        audio_bytes = st.session_state.voice_mgr.get_audio_bytes(final_speech, voice=tts_voice, pitch=tts_pitch, rate=tts_rate)
+                        if audio_bytes:
                             st.audio(audio_bytes, format="audio/mp3")
-                        except Exception:
-                            pass
+                            
+                audio_ref = None
+                if audio_bytes:
+                    # Stored once as raw bytes, the message only keeps the reference
+                    audio_ref = st.session_state.char_mgr.audio_store().put(
+                        clip_key(final_speech, tts_voice, tts_pitch, tts_rate), audio_bytes
+                    )
             
-            msg_data = {"role": "assistant", "content": full_response}
-            if audio_b64:
-                msg_data["audio"] = audio_b64
+                # The reply is already in the chat, the voice clip goes with it
+                if audio_ref:
+                    st.session_state.messages[-1]["audio_ref"] = audio_ref
                 
-            st.session_state.messages.append(msg_data)
-            st.rerun() # Rerun to update the avatar in the left column
+                rerun_view() # Rerun to update the avatar in the left column
+    record_render("chat view", view_started)
+
+main_view()
+record_render("full run", run_started)
@@ -0,0 +1,94 @@
+"""Display-sized copies of backgrounds and avatars, served as static files.
+
+Each image is resized and recompressed to WebP once, keyed by its path, mtime and
+target size, and written to static/cache/. Streamlit serves that folder at
+app/static/ (enableStaticServing in .streamlit/config.toml), so a page only carries
+the URL and the browser caches the image itself.
+"""
+import os
+import glob
+import shutil
+import hashlib
+import threading
+
+STATIC_DIR = "./static"
+CACHE_DIR = os.path.join(STATIC_DIR, "cache")
+CACHE_URL = "app/static/cache"
+
+BACKGROUND_SIZE = (1920, 1080)
+AVATAR_SIZE = (440, 440) # .big-avatar is 220px, twice that for HiDPI screens
+
+class AssetCache:
+    def __init__(self, cache_dir=CACHE_DIR, url_prefix=CACHE_URL, quality=82):
+        self.cache_dir = cache_dir
+        self.url_prefix = url_prefix
+        self.quality = quality
+        self.urls = {} # (path, mtime, size) -> url
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "encoded": 0, "bytes_in": 0, "bytes_out": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def url_for(self, path, max_size):
+        """Returns the URL of a display-sized copy of an image, or None if it doesn't exist."""
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        key = (os.path.abspath(path), mtime, tuple(max_size))
+        with self.lock:
+            url = self.urls.get(key)
+            if url:
+                self.stats["hits"] += 1
+                return url
+
+            # One name per source and size; the mtime suffix changes the URL when the image does
+            stem = hashlib.sha1(f"{key[0]}|{max_size[0]}x{max_size[1]}".encode("utf-8")).hexdigest()[:16]
+            name = f"{stem}-{int(mtime * 1000)}"
+            existing = [p for p in glob.glob(os.path.join(self.cache_dir, name + ".*")) if not p.endswith(".tmp")]
+            if existing:
+                filename = os.path.basename(existing[0])
+            else:
+                filename = self._encode(path, name, max_size)
+                self._remove_stale(stem, filename)
+
+            url = f"{self.url_prefix}/{filename}"
+            self.urls[key] = url
+            return url
+
+    def _encode(self, path, name, max_size):
+        """Writes the resized copy and returns its file name. Falls back to copying the original."""
+        self.stats["encoded"] += 1
+        self.stats["bytes_in"] += os.path.getsize(path)
+        try:
+            from PIL import Image
+            filename = name + ".webp"
+            out_path = os.path.join(self.cache_dir, filename)
+            with Image.open(path) as img:
+                img.thumbnail(max_size, Image.LANCZOS)
+                has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+                img = img.convert("RGBA" if has_alpha else "RGB")
+                img.save(out_path + ".tmp", "WEBP", quality=self.quality, method=4)
+        except Exception as e:
+            print(f"Error resizing {path}: {e}")
+            filename = name + os.path.splitext(path)[1].lower()
+            out_path = os.path.join(self.cache_dir, filename)
+            shutil.copyfile(path, out_path + ".tmp")
+
+        os.replace(out_path + ".tmp", out_path)
+        self.stats["bytes_out"] += os.path.getsize(out_path)
+        return filename
+
+    def _remove_stale(self, stem, keep):
+        for old in glob.glob(os.path.join(self.cache_dir, stem + "-*")):
+            if os.path.basename(old) != keep:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def background_url(self, path):
+        return self.url_for(path, BACKGROUND_SIZE)
+
+    def avatar_url(self, path):
+        return self.url_for(path, AVATAR_SIZE)
@@ -0,0 +1,75 @@
+import os
+import time
+import hashlib
+
+def clip_key(text, voice, pitch, rate):
+    """Address of the clip TTS makes for these settings; the same line always maps to the same file."""
+    return hashlib.sha256("\0".join((text, voice, pitch, rate)).encode("utf-8")).hexdigest()[:32]
+
+def bytes_key(data):
+    """Address for clips whose TTS settings are unknown (old saves with inline audio)."""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+class AudioStore:
+    """Content-addressed TTS clips as raw MP3 files, characters/<name>/audio/<key>.mp3.
+
+    Messages keep only the key ("audio_ref"). A clip is written once and read only
+    when a message's player is opened; gc() removes clips no session refers to.
+    """
+
+    def __init__(self, audio_dir):
+        self.audio_dir = audio_dir
+
+    def path(self, key):
+        return os.path.join(self.audio_dir, key + ".mp3")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data):
+        """Stores a clip under key unless it is already there. Returns key."""
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        if not os.path.exists(self.audio_dir):
+            os.makedirs(self.audio_dir)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        """Returns the clip's bytes, or None if it was collected."""
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def gc(self, referenced, min_age_seconds=3600):
+        """Deletes clips not in `referenced`. Returns (clips removed, bytes freed).
+
+        Clips younger than min_age_seconds stay, they may belong to a chat that is
+        not saved yet.
+        """
+        if not os.path.exists(self.audio_dir):
+            return 0, 0
+
+        removed = freed = 0
+        cutoff = time.time() - min_age_seconds
+        for name in os.listdir(self.audio_dir):
+            key, ext = os.path.splitext(name)
+            path = os.path.join(self.audio_dir, name)
+            if ext != ".mp3" or key in referenced:
+                continue
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
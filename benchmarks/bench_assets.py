@@ -0,0 +1,65 @@
+"""Per-run cost of the background image: base64 data URI vs asset_cache URL.
+
+Writes a ~4 MB PNG, then times what each script run does and how many bytes of it
+go to the browser. The old way reads and encodes the file on every run; AssetCache
+resizes it once and afterwards only returns the URL.
+Run from the repo root: python benchmarks/bench_assets.py
+"""
+import os
+import sys
+import time
+import zlib
+import base64
+import struct
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from asset_cache import AssetCache
+
+RUNS = 20
+
+def write_png(path, width, height):
+    """Noisy RGB PNG without needing Pillow, so it compresses about as badly as a photo."""
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    raw = b"".join(b"\x00" + pixels[y].tobytes() for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+def old_run(path):
+    with open(path, "rb") as f:
+        data = base64.b64encode(f.read()).decode()
+    return f'url("data:image/png;base64,{data}")'
+
+def main():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "background.png")
+    write_png(path, 1200, 1200)
+    cache = AssetCache(cache_dir=os.path.join(tmp, "cache"), url_prefix="app/static/cache")
+
+    start = time.perf_counter()
+    cache.background_url(path)
+    first = (time.perf_counter() - start) * 1000
+
+    rows = []
+    for name, run in (("base64 per run", lambda: old_run(path)), ("asset cache", lambda: f'url("{cache.background_url(path)}")')):
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            css = run()
+        rows.append((name, (time.perf_counter() - start) * 1000 / RUNS, len(css)))
+
+    print(f"source {os.path.getsize(path) / 1e6:.1f} MB, cached copy {cache.stats['bytes_out'] / 1e6:.2f} MB, "
+          f"first encode {first:.0f} ms")
+    print(f"{'':<16} {'ms/run':>8} {'bytes/run':>10}")
+    for name, ms, size in rows:
+        print(f"{name:<16} {ms:>8.2f} {size:>10}")
+
+if __name__ == "__main__":
+    main()
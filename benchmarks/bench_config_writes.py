@@ -0,0 +1,73 @@
+"""Hammers CharacterManager stats updates and counts config.json writes.
+
+Before the write-behind ConfigStore every update rewrote config.json; now updates are
+coalesced and written by a timer. The check at the end fails if the file on disk does
+not match the stats in memory after a flush, or if a temp file was left behind.
+Run from the repo root: python benchmarks/bench_config_writes.py
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import character_manager
+from character_manager import CharacterManager
+from config_store import ConfigStore
+
+UPDATES = 2000
+THREADS = 4
+FLUSH_INTERVAL = 0.05
+
+def main():
+    character_manager.CHARACTERS_DIR = tempfile.mkdtemp()
+    store = ConfigStore(flush_interval=FLUSH_INTERVAL)
+    char_mgr = CharacterManager(config_store=store)
+    char_mgr.save_character("Bench", {"name": "Bench", "description": "", "scenario": "", "example_dialogue": ""})
+    char_mgr.load_character("Bench")
+    config_path = os.path.join(character_manager.CHARACTERS_DIR, "Bench", "config.json")
+
+    # What every update used to cost: a full rewrite of config.json
+    start = time.perf_counter()
+    for _ in range(200):
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(char_mgr.character_config, f, indent=4, ensure_ascii=False)
+    old_ms = (time.perf_counter() - start) * 1000 / 200
+
+    writes_before = store.stats["writes"]
+    lock = threading.Lock() # update_stats is read-modify-write, like a session's turns
+
+    def hammer(n):
+        for i in range(n):
+            with lock:
+                char_mgr.update_stats(1 if i % 2 else -1, -1 if i % 3 else 1)
+            char_mgr.set_time(i)
+            time.sleep(0.0005)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=hammer, args=(UPDATES // THREADS,)) for _ in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    char_mgr.flush()
+
+    writes = store.stats["writes"] - writes_before
+    mutations = UPDATES * 2
+    print(f"{mutations} mutations in {elapsed:.2f}s from {THREADS} threads")
+    print(f"  before: {mutations} writes, ~{old_ms:.2f} ms each")
+    print(f"  after:  {writes} writes ({mutations / max(writes, 1):.0f} mutations per write)")
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        on_disk = json.load(f)
+    assert on_disk["stats"] == char_mgr.get_stats(), "config.json is behind memory after flush"
+    assert on_disk["current_time"] == char_mgr.get_time()
+    assert not os.path.exists(config_path + ".tmp"), "temp file left behind"
+    assert writes <= elapsed / FLUSH_INTERVAL + 2, "writes were not coalesced"
+    print("ok")
+
+if __name__ == "__main__":
+    main()
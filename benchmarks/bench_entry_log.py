@@ -0,0 +1,54 @@
+"""Cost of a diary append and of reading the recent entries vs diary length.
+
+Compares the old whole-file JSON array (load, append, rewrite) with EntryLog.
+Run from the repo root: python benchmarks/bench_entry_log.py
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from entry_log import EntryLog
+
+SIZES = [100, 1000, 10000, 50000]
+RUNS = 20
+
+def make_entry(i):
+    return {"date": f"2025-01-01 {i % 24:02d}:00", "content": f"Entry {i}. Today we talked for a long time about the stars. " * 4}
+
+def old_append(path, entry):
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    entries.append(entry)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2, ensure_ascii=False)
+
+def old_recent(path, limit=3):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)[-limit:]
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+    return (time.perf_counter() - start) * 1000 / RUNS
+
+def main():
+    tmp = tempfile.mkdtemp()
+    print(f"{'entries':>8} {'json append':>12} {'log append':>11} {'json recent':>12} {'log recent':>11}  (ms)")
+    for n in SIZES:
+        entries = [make_entry(i) for i in range(n)]
+        json_path = os.path.join(tmp, f"diary{n}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=2, ensure_ascii=False)
+        log = EntryLog(os.path.join(tmp, f"diary{n}.jsonl"))
+        log.rewrite(entries)
+
+        print(f"{n:>8} {timed(lambda: old_append(json_path, make_entry(n))):>12.2f} "
+              f"{timed(lambda: log.append([make_entry(n)])):>11.2f} "
+              f"{timed(lambda: old_recent(json_path)):>12.2f} {timed(lambda: log.tail(3)):>11.2f}")
+
+if __name__ == "__main__":
+    main()
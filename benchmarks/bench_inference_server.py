@@ -0,0 +1,91 @@
+"""Load generator for inference_server: time to first token and throughput vs concurrent users.
+
+Every simulated user is a WaifuAI session chatting through InferenceServer.chat().
+With one slot the server serializes like a single Llama does; with one slot per user
+requests are batched together.
+
+By default a fake batch backend is used that costs a fixed time per step (like a GPU):
+    python benchmarks/bench_inference_server.py
+With a real model:
+    python benchmarks/bench_inference_server.py --model ./models/L3-8B-Stheno-v3.2-Q4_K_M.gguf
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from brain import WaifuAI
+from model_pool import ModelPool
+from inference_server import InferenceServer, LlamaBatchBackend
+from fake_llama import FakeLlama, FakeBatchBackend
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+async def user(server, waifu, turns, ttfts):
+    for turn in range(turns):
+        sent = time.perf_counter()
+        first = None
+        async for _ in server.chat(waifu, f"Tell me about your day, part {turn}.", temperature=0.8):
+            if first is None:
+                first = time.perf_counter()
+                ttfts.append(first - sent)
+
+async def run(make_backend, pool, model_path, slot_ctx, users, slots, turns, max_tokens):
+    backend = make_backend(slots)
+    server = InferenceServer(backend)
+    await server.start()
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        sessions = []
+        for i in range(users):
+            waifu = WaifuAI(model_path, context_size=slot_ctx, pool=pool)
+            waifu.prefill_enabled = False
+            waifu.max_response_tokens = max_tokens
+            waifu.set_persona(f"Character{i}", "A cheerful companion who loves long walks. " * 10, "At home.", "", current_time_str="12:00")
+            sessions.append(waifu)
+
+    ttfts = []
+    start = time.perf_counter()
+    await asyncio.gather(*(user(server, waifu, turns, ttfts) for waifu in sessions))
+    wall = time.perf_counter() - start
+    report = server.report()
+    await server.stop()
+    for waifu in sessions:
+        waifu.close()
+
+    tokens = report["generated_tokens"]
+    print(f"{users:>5} {slots:>5} {percentile(ttfts, 50) * 1000:>9.0f} {percentile(ttfts, 99) * 1000:>9.0f} "
+          f"{tokens / wall:>9.1f} {report['avg_batch_tokens']:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="GGUF to benchmark instead of the fake backend")
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    slot_ctx = 2048
+    if args.model:
+        model_path = args.model
+        pool = ModelPool(max_models=1)
+        entry = pool.acquire(model_path, n_ctx=slot_ctx, n_gpu_layers=-1, logits_all=False)
+        make_backend = lambda slots: LlamaBatchBackend(entry.llm, n_slots=slots, slot_ctx=slot_ctx)
+    else:
+        model_path = os.path.join(tempfile.mkdtemp(), "fake.gguf")
+        open(model_path, "wb").close()
+        pool = ModelPool(max_models=1, loader=lambda path, **kwargs: FakeLlama(path, n_ctx=kwargs["n_ctx"], weights_mb=1))
+        make_backend = lambda slots: FakeBatchBackend(n_slots=slots, slot_ctx=slot_ctx)
+
+    print(f"{'users':>5} {'slots':>5} {'p50 ttft':>9} {'p99 ttft':>9} {'tok/s':>9} {'avg batch':>10}")
+    for users in (1, 4, 8, 16):
+        for slots in sorted({1, users}):
+            asyncio.run(run(make_backend, pool, model_path, slot_ctx, users, slots, args.turns, args.max_tokens))
+
+if __name__ == "__main__":
+    main()
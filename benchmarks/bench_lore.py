@@ -0,0 +1,61 @@
+"""Per-turn lorebook scan time against lorebook size.
+
+Compares the old substring scan (every keyword tested with `in`) with LoreMatcher.
+Run from the repo root: python benchmarks/bench_lore.py
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from lorebook import LoreMatcher
+
+SIZES = [100, 1000, 5000, 20000]
+TURNS = 20
+
+def make_word(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 10)))
+
+def make_lorebook(size, rng):
+    lorebook = {}
+    while len(lorebook) < size:
+        name = " ".join(make_word(rng) for _ in range(rng.randint(1, 2))).title()
+        lorebook[name] = f"Lore about {name}."
+    return lorebook
+
+def make_turn(lorebook, rng, words=400):
+    keys = list(lorebook)
+    text = [make_word(rng) for _ in range(words)]
+    for _ in range(5):
+        text.insert(rng.randrange(len(text)), rng.choice(keys).split(",")[0])
+    return " ".join(text)
+
+def naive_scan(lorebook, text):
+    text = text.lower()
+    return [k for k in lorebook if k.lower() in text]
+
+def timed(fn, turns):
+    start = time.perf_counter()
+    for turn in turns:
+        fn(turn)
+    return (time.perf_counter() - start) / len(turns) * 1000
+
+def main():
+    rng = random.Random(42)
+    print(f"{'entries':>8} {'build ms':>10} {'substring ms/turn':>18} {'matcher ms/turn':>16}")
+    for size in SIZES:
+        lorebook = make_lorebook(size, rng)
+        turns = [make_turn(lorebook, rng) for _ in range(TURNS)]
+
+        start = time.perf_counter()
+        matcher = LoreMatcher(lorebook)
+        matcher.scan("")
+        build_ms = (time.perf_counter() - start) * 1000
+
+        naive_ms = timed(lambda t: naive_scan(lorebook, t), turns)
+        matcher_ms = timed(matcher.scan, turns)
+        print(f"{size:>8} {build_ms:>10.1f} {naive_ms:>18.3f} {matcher_ms:>16.3f}")
+
+if __name__ == "__main__":
+    main()
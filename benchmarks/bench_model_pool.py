@@ -0,0 +1,68 @@
+"""Model pool hit rate, load time and evictions for a random character-switching workload.
+
+Pass tiny GGUF files (e.g. stories260K.gguf copies) to load real models:
+    python benchmarks/bench_model_pool.py models/tiny-a.gguf models/tiny-b.gguf models/tiny-c.gguf
+Without arguments, placeholder files and a loader that sleeps in proportion to the
+file size are used, which is enough to exercise the LRU and budget logic.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from model_pool import ModelPool
+
+SWITCHES = 200
+
+class FakeLlama:
+    def __init__(self, model_path, **kwargs):
+        time.sleep(os.path.getsize(model_path) / (1024 ** 3)) # ~1s per GB
+        self.model_path = model_path
+
+def make_placeholders(folder, sizes_mb):
+    paths = []
+    for i, size in enumerate(sizes_mb):
+        path = os.path.join(folder, f"fake-{i}.gguf")
+        with open(path, "wb") as f:
+            f.truncate(size * 1024 * 1024)
+        paths.append(path)
+    return paths
+
+def run(paths, loader, max_models, ram_budget_bytes, n_ctx):
+    rng = random.Random(42)
+    pool = ModelPool(max_models=max_models, ram_budget_bytes=ram_budget_bytes, loader=loader)
+    # Characters favour a few models, like a real roster does
+    weights = [1.0 / (i + 1) for i in range(len(paths))]
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for _ in range(SWITCHES):
+            entry = pool.acquire(rng.choices(paths, weights)[0], n_ctx=n_ctx)
+            pool.release(entry)
+    elapsed = time.perf_counter() - start
+
+    report = pool.report()
+    print(f"max_models={max_models} budget={'-' if not ram_budget_bytes else f'{ram_budget_bytes // 1024 ** 2} MB'}: "
+          f"hit rate {report['hit_rate']:.0%}, {report['misses']} loads, {report['evictions']} evictions, "
+          f"{report['load_seconds']:.2f}s loading, {elapsed:.2f}s total, "
+          f"resident {report['resident_bytes'] // 1024 ** 2} MB")
+
+def main():
+    if len(sys.argv) > 1:
+        paths = sys.argv[1:]
+        loader = ModelPool().loader
+    else:
+        paths = make_placeholders(tempfile.mkdtemp(), [40, 60, 80, 100])
+        loader = FakeLlama
+    n_ctx = 256
+
+    for max_models in (1, 2, 3):
+        run(paths, loader, max_models, None, n_ctx)
+    total = sum(os.path.getsize(p) for p in paths)
+    run(paths, loader, len(paths), total // 2, n_ctx)
+
+if __name__ == "__main__":
+    main()
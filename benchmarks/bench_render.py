@@ -0,0 +1,78 @@
+"""Render time of the chat view against session length, checked against a budget.
+
+Runs the chat history rendering from chat_view headlessly with Streamlit's AppTest:
+once as a full page run, once as a click inside the main_view fragment, and once as
+loading a page of older messages. Every reply carries voice audio, which is only
+decoded for the newest message or when played. With paging, all three should stay
+flat as the session grows. AppTest reruns the whole script for clicks inside a
+fragment, so the fragment path is timed on a page holding only the main_view body,
+which is what a fragment rerun executes in the app.
+Run from the repo root: python benchmarks/bench_render.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from streamlit.testing.v1 import AppTest
+from chat_view import HISTORY_PAGE_SIZE
+
+SESSION_LENGTHS = [10, 50, 150, 300]
+RUNS = 3
+RENDER_BUDGET_MS = 250 # Per interaction
+
+def chat_page():
+    import os
+    import sys
+    import base64
+    import streamlit as st
+    sys.path.insert(0, os.getcwd())
+    from chat_view import render_history
+
+    n = int(os.environ["BENCH_MESSAGES"])
+    fragment_only = os.environ.get("BENCH_FRAGMENT_ONLY") == "1"
+    if "messages" not in st.session_state:
+        audio = base64.b64encode(bytes(40 * 1024)).decode("utf-8") # A few seconds of MP3
+        st.session_state.messages = []
+        for i in range(n):
+            st.session_state.messages.append({"role": "user", "content": f"Message {i}, how are you today?"})
+            st.session_state.messages.append({"role": "assistant", "content": f"<thought>She smiles.</thought>I'm fine, thanks for asking! ({i}) [Mood: happy]", "audio": audio})
+        st.session_state.editing_msg = None
+        st.session_state.should_regenerate = False
+
+    # Stand-in for the sidebar work a full run also does; a fragment rerun skips it
+    if not fragment_only:
+        with st.sidebar:
+            for i in range(40):
+                st.slider(f"Setting {i}", 0, 100, 50)
+
+    @st.fragment
+    def main_view():
+        render_history(st.session_state.messages)
+        st.button("Ping", key="ping")
+
+    main_view()
+
+def timed_run(action):
+    start = time.perf_counter()
+    action()
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    print(f"{'messages':>8} {'full run ms':>12} {'fragment ms':>12} {'older page ms':>14} {'budget':>7}")
+    for n in SESSION_LENGTHS:
+        os.environ["BENCH_MESSAGES"] = str(n // 2)
+        os.environ["BENCH_FRAGMENT_ONLY"] = "0"
+        at = AppTest.from_function(chat_page, default_timeout=120)
+        full = min(timed_run(at.run) for _ in range(RUNS))
+
+        os.environ["BENCH_FRAGMENT_ONLY"] = "1"
+        at = AppTest.from_function(chat_page, default_timeout=120)
+        at.run()
+        click = min(timed_run(lambda: at.button(key="ping").click().run()) for _ in range(RUNS))
+        older = timed_run(lambda: at.button(key="history_older").click().run()) if n > HISTORY_PAGE_SIZE else 0.0
+        verdict = "ok" if max(click, older) <= RENDER_BUDGET_MS else "over"
+        print(f"{n:>8} {full:>12.0f} {click:>12.0f} {older:>14.0f} {verdict:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Listing and searching saved sessions: directory scan vs the SQLite session index.
+
+Saves N sessions for one character, then times the old list_sessions (glob + stat +
+sort every file), a listing that also needs message counts and previews (parsing every
+file), and the same through CharacterManager's index, paged and searched.
+Run from the repo root: python benchmarks/bench_session_index.py
+"""
+import os
+import sys
+import glob
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import character_manager
+from character_manager import CharacterManager
+from config_store import ConfigStore
+
+SIZES = [100, 1000, 5000]
+RUNS = 5
+PAGE = 50
+
+def old_list(history_dir):
+    files = glob.glob(os.path.join(history_dir, "*.jsonl"))
+    files.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.basename(f) for f in files]
+
+def old_list_with_info(char_mgr, history_dir):
+    return [(name, char_mgr.load_session(os.path.splitext(name)[0] + ".json")[0][-1:]) for name in old_list(history_dir)]
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+    return (time.perf_counter() - start) * 1000 / RUNS
+
+def main():
+    print(f"{'sessions':>8} {'scan list':>10} {'scan+parse':>11} {'index page':>11} {'index search':>13} (ms)")
+    for n in SIZES:
+        character_manager.CHARACTERS_DIR = tempfile.mkdtemp()
+        char_mgr = CharacterManager(config_store=ConfigStore())
+        char_mgr.save_character("Bench", {"name": "Bench"})
+        char_mgr.load_character("Bench")
+        history_dir = os.path.join(character_manager.CHARACTERS_DIR, "Bench", "history")
+        for i in range(n):
+            history = []
+            for turn in range(20):
+                history.append({"role": "user", "content": f"Session {i} turn {turn}: how was your day?"})
+                history.append({"role": "assistant", "content": f"<thought>Happy.</thought>It was lovely, thanks! [Mood: happy] #{i}"})
+            char_mgr.save_session(history, f"session_{i:05d}")
+
+        scan = timed(lambda: old_list(history_dir))
+        parse = timed(lambda: old_list_with_info(char_mgr, history_dir)) if n <= 1000 else float("nan")
+        page = timed(lambda: char_mgr.list_session_info(limit=PAGE, offset=PAGE))
+        search = timed(lambda: char_mgr.list_session_info(limit=PAGE, query=f"#{n // 2}"))
+        assert char_mgr.count_sessions() == n
+        assert char_mgr.list_session_info(query=f"lovely, thanks! #{n // 2}")[0]["name"] == f"session_{n // 2:05d}.json"
+        print(f"{n:>8} {scan:>10.1f} {parse:>11.1f} {page:>11.2f} {search:>13.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Many chat sessions sharing one model through the process-wide ModelPool.
+
+Each simulated session is its own WaifuAI (persona, history, prompt cache) on a
+shared FakeLlama, chatting from its own thread like Streamlit sessions do. Reports
+memory against the number of sessions, queue wait times, and fails if the model was
+ever used by two threads at once.
+Run from the repo root: python benchmarks/bench_shared_sessions.py
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from brain import WaifuAI
+from model_pool import ModelPool
+from fake_llama import FakeLlama
+
+SESSION_COUNTS = [1, 4, 16, 64]
+TURNS = 3
+PERSONAS = 4 # Sessions talk to one of a few characters
+
+def run_session(waifu, turns, errors):
+    try:
+        for turn in range(turns):
+            for _ in waifu.generate_response(f"Hello, this is turn {turn}. How was your day?"):
+                pass
+    except Exception as e:
+        errors.append(e)
+
+def main():
+    model_path = os.path.join(tempfile.mkdtemp(), "fake.gguf")
+    open(model_path, "wb").close()
+
+    print(f"{'sessions':>8} {'wall s':>8} {'turns/s':>8} {'memory MB':>10} {'max wait s':>11} {'errors':>7}")
+    tracemalloc.start()
+    for count in SESSION_COUNTS:
+        pool = ModelPool(max_models=1, loader=lambda path, **kwargs: FakeLlama(path, n_ctx=kwargs["n_ctx"]))
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            sessions = []
+            for i in range(count):
+                waifu = WaifuAI(model_path, context_size=4096, pool=pool)
+                waifu.max_response_tokens = 32
+                waifu.set_persona(f"Character{i % PERSONAS}", "A cheerful companion. " * 20, "At home.", "", current_time_str="12:00")
+                sessions.append(waifu)
+
+            errors = []
+            threads = [threading.Thread(target=run_session, args=(waifu, TURNS, errors)) for waifu in sessions]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - start
+
+        memory = (tracemalloc.get_traced_memory()[0] - baseline) / 1024 ** 2
+        entry = next(iter(pool.models.values()))
+        print(f"{count:>8} {wall:>8.2f} {count * TURNS / wall:>8.1f} {memory:>10.1f} {entry.lock.max_wait_seconds:>11.2f} {len(errors):>7}")
+        for e in errors[:3]:
+            print(f"  error: {e}")
+
+        for waifu in sessions:
+            waifu.close()
+        del sessions, waifu, entry, pool
+
+if __name__ == "__main__":
+    main()
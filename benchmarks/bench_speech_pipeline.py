@@ -0,0 +1,79 @@
+"""Time to first audio: voicing the finished reply vs SpeechPipeline's sentence streaming.
+
+A reply is streamed token by token at a fixed rate (thought first, then speech, then
+the mood tag) through brain.StreamParser, and voiced by VoiceManager with the offline
+FakeTTSBackend (a fixed request latency plus time per character).
+Run from the repo root: python benchmarks/bench_speech_pipeline.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from brain import StreamParser, SPEECH_TEXT
+from speech_pipeline import SpeechPipeline
+from tts_cache import TTSCache
+from voice_manager import VoiceManager
+from fake_tts import FakeTTSBackend
+
+SECONDS_PER_TOKEN = 0.03 # ~33 tok/s
+
+REPLY = ("<thought>He looks tired today, I should cheer him up.</thought>"
+         "Welcome back! I was starting to wonder where you went. "
+         "I made some tea earlier, it's still warm if you want some. "
+         "*She pats the cushion next to her.* Come sit with me and tell me everything about your day. "
+         "Was work as busy as you expected, or did they finally give you a break? [Mood: happy]")
+
+def tokens(text):
+    # Roughly four characters per token
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+def make_voice_mgr():
+    # Fresh empty cache, so every sentence is really synthesized
+    return VoiceManager(cache=TTSCache(tempfile.mkdtemp()), backend=FakeTTSBackend())
+
+def after_reply():
+    start = time.perf_counter()
+    parser = StreamParser()
+    for token in tokens(REPLY):
+        time.sleep(SECONDS_PER_TOKEN)
+        parser.feed(token)
+    parser.close()
+    make_voice_mgr().get_audio_bytes(parser.speech)
+    return time.perf_counter() - start
+
+def pipelined():
+    voice_mgr = make_voice_mgr()
+    pipeline = SpeechPipeline(submit=voice_mgr.submit_audio)
+    parser = StreamParser()
+    first = None
+    for token in tokens(REPLY):
+        time.sleep(SECONDS_PER_TOKEN)
+        for kind, text in parser.feed(token):
+            if kind == SPEECH_TEXT:
+                pipeline.feed(text)
+        if pipeline.due() and first is None:
+            first = time.perf_counter() - pipeline.started
+    for kind, text in parser.close():
+        if kind == SPEECH_TEXT:
+            pipeline.feed(text)
+    pipeline.close()
+    while first is None:
+        if pipeline.due():
+            first = time.perf_counter() - pipeline.started
+        time.sleep(0.01)
+    return first, pipeline
+
+def main():
+    generation = len(tokens(REPLY)) * SECONDS_PER_TOKEN
+    print(f"reply: {len(tokens(REPLY))} tokens, ~{generation:.2f}s to generate")
+    print(f"voice after reply:  first audio at {after_reply():.2f}s")
+    first, pipeline = pipelined()
+    pipeline.play_remaining(lambda clip: None, poll_seconds=0.01)
+    print(f"sentence streaming: first audio at {first:.2f}s ({pipeline.stats()['sentences']} sentences, "
+          f"played out by {time.perf_counter() - pipeline.started:.2f}s)")
+    print("sentences:", *pipeline.sentences, sep="\n  ")
+
+if __name__ == "__main__":
+    main()
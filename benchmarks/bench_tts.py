@@ -0,0 +1,84 @@
+"""TTS call overhead and concurrency: the old per-call event loop + temp file path vs
+VoiceManager's background loop with in-memory buffers.
+
+Both use the offline FakeTTSBackend. The old path is reproduced as it was: find or make
+an event loop, run_until_complete, write the MP3 to a NamedTemporaryFile, read it back,
+delete it and base64-encode it. Calls come from fresh threads, like Streamlit reruns.
+Run from the repo root: python benchmarks/bench_tts.py
+"""
+import os
+import sys
+import time
+import base64
+import asyncio
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tts_cache import TTSCache
+from voice_manager import VoiceManager
+from fake_tts import FakeTTSBackend
+
+CALLS = 200
+SENTENCES = ["Welcome back, I was starting to wonder where you went.",
+             "I made some tea earlier, it's still warm if you want some.",
+             "Come sit with me and tell me everything about your day.",
+             "Was work as busy as you expected, or did they finally give you a break?",
+             "Either way, I'm really glad you're home now."]
+
+def legacy_get_audio_base64(backend, text):
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
+        temp_path = fp.name
+
+    async def save():
+        with open(temp_path, "wb") as f:
+            async for data in backend.stream(text, "en-US-AriaNeural", "+0Hz", "+0%"):
+                f.write(data)
+
+    loop.run_until_complete(save())
+    with open(temp_path, "rb") as f:
+        data = f.read()
+    os.remove(temp_path)
+    return base64.b64encode(data).decode()
+
+def in_thread(fn):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def make_voice_mgr(backend):
+    return VoiceManager(cache=TTSCache(tempfile.mkdtemp()), backend=backend)
+
+def main():
+    # Overhead: a backend that answers instantly
+    backend = FakeTTSBackend(latency=0, seconds_per_char=0)
+    voice_mgr = make_voice_mgr(backend)
+    old = timed(lambda: [in_thread(lambda: legacy_get_audio_base64(backend, f"Line {i}. " + SENTENCES[0])) for i in range(CALLS)])
+    new = timed(lambda: [in_thread(lambda: voice_mgr.get_audio_bytes(f"Line {i}. " + SENTENCES[0])) for i in range(CALLS)])
+    print(f"overhead per call:  old {old / CALLS * 1000:.2f} ms, new {new / CALLS * 1000:.2f} ms")
+
+    # A reply's sentences, with service latency: the old path runs them one by one
+    backend = FakeTTSBackend()
+    old = timed(lambda: [legacy_get_audio_base64(backend, s) for s in SENTENCES])
+    voice_mgr = make_voice_mgr(backend)
+    new = timed(lambda: [f.result() for f in [voice_mgr.submit_audio(s) for s in SENTENCES]])
+    print(f"{len(SENTENCES)} sentences:        old {old:.2f} s sequential, new {new:.2f} s submitted together")
+
+    hit = timed(lambda: voice_mgr.get_audio_bytes(SENTENCES[0]))
+    print(f"cached sentence:    {hit * 1000:.2f} ms, {backend.requests} backend requests in total")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Stand-in for llama_cpp.Llama used by the benchmarks.
+
+It implements the parts of the Llama API that WaifuAI and PromptCache use, spends time
+in proportion to the tokens evaluated and generated, and raises if two threads are
+inside it at once, so benchmarks can check that access is serialized.
+"""
+import time
+import threading
+import numpy as np
+
+class FakeState:
+    def __init__(self, input_ids, n_tokens):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.scores = np.zeros((0, 0), dtype=np.float32)
+        self.seed = 0
+        # About what an 8B model's KV cache takes per token, scaled down 1000x
+        self.llama_state = bytes(128 * n_tokens)
+        self.llama_state_size = len(self.llama_state)
+
+class FakeLlama:
+    def __init__(self, model_path=None, n_ctx=8192, prompt_seconds_per_token=0.0002,
+                 seconds_per_token=0.004, weights_mb=64, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.prompt_seconds_per_token = prompt_seconds_per_token
+        self.seconds_per_token = seconds_per_token
+        self.weights = np.ones(weights_mb * 1024 * 1024 // 4, dtype=np.float32)
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc) # Whole buffer, like llama_cpp.Llama
+        self.n_tokens = 0
+        self.draft_model = None
+        self.evaluated_tokens = 0
+        self._busy = threading.Lock()
+
+    def _enter(self):
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("FakeLlama used by two threads at once")
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return 32000
+
+    def token_eos(self):
+        return 2
+
+    def tokenize(self, text, add_bos=True, special=False):
+        # Roughly four bytes per token
+        return [hash(text[i:i + 4]) % 32000 + 3 for i in range(0, len(text), 4)]
+
+    def detokenize(self, tokens):
+        return b"".join(b"word " for _ in tokens)
+
+    def eval(self, tokens):
+        self._enter()
+        try:
+            self._eval(tokens)
+        finally:
+            self._busy.release()
+
+    def _eval(self, tokens):
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError("context full")
+        time.sleep(len(tokens) * self.prompt_seconds_per_token)
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        self.evaluated_tokens += len(tokens)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def save_state(self):
+        return FakeState(self.input_ids.copy(), self.n_tokens)
+
+    def load_state(self, state):
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = state.n_tokens
+
+    def __call__(self, prompt, max_tokens=16, stream=False, **kwargs):
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt.encode("utf-8"))
+        if stream:
+            return self._stream(prompt, max_tokens)
+        text = "".join(chunk["choices"][0]["text"] for chunk in self._stream(prompt, max_tokens))
+        return {"choices": [{"text": text}]}
+
+    def _stream(self, prompt, max_tokens):
+        self._enter()
+        try:
+            # Reuse the matching prefix like llama-cpp-python does
+            n = 0
+            for a, b in zip(self._input_ids.tolist(), prompt):
+                if a != b:
+                    break
+                n += 1
+            self.n_tokens = min(n, len(prompt) - 1)
+            self._eval(prompt[self.n_tokens:])
+            for i in range(max_tokens):
+                time.sleep(self.seconds_per_token)
+                self.input_ids[self.n_tokens] = 7
+                self.n_tokens += 1
+                yield {"choices": [{"text": f"word{i} "}]}
+        finally:
+            self._busy.release()
+
+    def close(self):
+        self.weights = None
+
+class FakeBatchBackend:
+    """Stand-in for inference_server.LlamaBatchBackend.
+
+    A decode costs a fixed step time plus a little per token, like a GPU where reading
+    the weights dominates, so batching many sequences is nearly free. It checks that
+    every sequence is fed contiguous positions.
+    """
+
+    def __init__(self, n_slots=4, slot_ctx=4096, n_batch=512, step_seconds=0.02, seconds_per_token=0.0002, n_vocab=32000):
+        self.n_slots = n_slots
+        self.slot_ctx = slot_ctx
+        self.n_batch = n_batch
+        self.step_seconds = step_seconds
+        self.seconds_per_token = seconds_per_token
+        self.n_vocab = n_vocab
+        self.stop_tokens = {2}
+        self.lengths = [0] * n_slots
+        self.rng = np.random.default_rng(0)
+
+    def detokenize(self, token):
+        return b"word "
+
+    def clear(self, seq_id, start=0):
+        self.lengths[seq_id] = min(self.lengths[seq_id], start)
+
+    def decode(self, entries):
+        n = sum(len(tokens) for _, tokens, _, _ in entries)
+        if n > self.n_batch:
+            raise ValueError("batch too large")
+        time.sleep(self.step_seconds + n * self.seconds_per_token)
+        logits = []
+        for seq_id, tokens, start, want_logits in entries:
+            if start != self.lengths[seq_id]:
+                raise ValueError(f"sequence {seq_id} fed position {start}, expected {self.lengths[seq_id]}")
+            self.lengths[seq_id] += len(tokens)
+            if want_logits:
+                row = self.rng.standard_normal(self.n_vocab).astype(np.float32)
+                row[list(self.stop_tokens)] = -100.0
+                logits.append(row)
+            else:
+                logits.append(None)
+        return logits
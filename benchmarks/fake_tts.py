@@ -0,0 +1,25 @@
+"""Offline stand-in for voice_manager.EdgeTTSBackend used by the benchmarks.
+
+Like the online service it answers after a request latency and then streams MP3-sized
+chunks at a steady rate, so synthesis time grows with the length of the text.
+"""
+import asyncio
+
+from speech_pipeline import MP3_BYTES_PER_SECOND
+
+class FakeTTSBackend:
+    def __init__(self, latency=0.25, seconds_per_char=0.004, chars_per_second_spoken=15, chunk_bytes=4096):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+        self.chars_per_second_spoken = chars_per_second_spoken
+        self.chunk_bytes = chunk_bytes
+        self.requests = 0
+
+    async def stream(self, text, voice, pitch, rate):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        size = int(len(text) / self.chars_per_second_spoken * MP3_BYTES_PER_SECOND)
+        chunks = max(1, size // self.chunk_bytes)
+        for i in range(chunks):
+            await asyncio.sleep(len(text) * self.seconds_per_char / chunks)
+            yield bytes(size // chunks if i < chunks - 1 else size - size // chunks * (chunks - 1))
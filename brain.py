@@ -1,63 +1,303 @@
 import os
+import re
+import json
+import time
+import weakref
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from prompt_cache import PromptCache, model_fingerprint
+from lorebook import LoreMatcher, LoreInjector
+from draft_model import DRAFT_MODEL_PATH, GGUFDraftModel, DraftStats, make_draft_model
 try:
     from llama_cpp import Llama
 except ImportError:
     Llama = None
 
+# Events emitted by StreamParser
+THOUGHT_START = "thought_start"
+THOUGHT_TEXT = "thought_text"
+THOUGHT_END = "thought_end"
+SPEECH_TEXT = "speech_text"
+MOOD = "mood"
+
+# Where a reply ends (end of turn, or the model starting to speak for the user)
+STOP_STRINGS = ["<|eot_id|>", "User:"]
+
+MOOD_PATTERN = re.compile(r'\[Mood:\s*([a-zA-Z0-9_\s]+)\]', re.IGNORECASE)
+
+def _partial_suffix(text, tag):
+    """Length of the longest suffix of text that is a prefix of tag (a tag split across chunks)."""
+    for n in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:n]):
+            return n
+    return 0
+
+class StreamParser:
+    """Splits streamed model output into thought, speech and mood events as chunks arrive.
+
+    Each chunk is looked at once; only a possible partial tag at its end is held back
+    until the next chunk decides it. feed() and close() return lists of (event, text).
+    """
+
+    def __init__(self):
+        self.in_thought = False
+        self.buffer = ""
+        self.chunks = 0 # One per streamed token
+        self.raw = []
+        self.thought_parts = []
+        self.thought_opened = 0 # Index into thought_parts where the open thought began
+        self.speech_parts = []
+        self.mood = None
+
+    @property
+    def text(self):
+        return "".join(self.raw)
+
+    @property
+    def thought(self):
+        return "".join(self.thought_parts).strip()
+
+    @property
+    def speech(self):
+        return "".join(self.speech_parts).strip()
+
+    def _emit(self, events, kind, text=""):
+        if kind == THOUGHT_TEXT:
+            if not text:
+                return
+            self.thought_parts.append(text)
+        elif kind == SPEECH_TEXT:
+            if not text:
+                return
+            self.speech_parts.append(text)
+        elif kind == MOOD:
+            self.mood = text
+        events.append((kind, text))
+
+    def feed(self, chunk):
+        self.chunks += 1
+        self.raw.append(chunk)
+        self.buffer += chunk
+        events = []
+        self._scan(events)
+        return events
+
+    def _scan(self, events):
+        while self.buffer:
+            buf = self.buffer
+            if self.in_thought:
+                end = buf.find("</thought>")
+                if end >= 0:
+                    self._emit(events, THOUGHT_TEXT, buf[:end])
+                    self._emit(events, THOUGHT_END)
+                    self.buffer = buf[end + len("</thought>"):]
+                    self.in_thought = False
+                    continue
+                keep = _partial_suffix(buf, "</thought>")
+                self._emit(events, THOUGHT_TEXT, buf[:len(buf) - keep])
+                self.buffer = buf[len(buf) - keep:]
+                break
+                
+            start = buf.find("<thought>")
+            bracket = buf.find("[")
+            if start >= 0 and (bracket < 0 or start < bracket):
+                self._emit(events, SPEECH_TEXT, buf[:start])
+                self._emit(events, THOUGHT_START)
+                self.buffer = buf[start + len("<thought>"):]
+                self.in_thought = True
+                self.thought_opened = len(self.thought_parts)
+                continue
+                
+            if bracket >= 0:
+                self._emit(events, SPEECH_TEXT, buf[:bracket])
+                rest = buf[bracket:]
+                match = MOOD_PATTERN.match(rest)
+                if match:
+                    self._emit(events, MOOD, match.group(1).strip().lower())
+                    self.buffer = rest[match.end():]
+                    continue
+                # Hold back anything that may still turn into a mood tag
+                head = rest[:len("[mood:")].lower()
+                could_be_mood = "[mood:".startswith(head) or (head == "[mood:" and "]" not in rest and len(rest) < 64)
+                if could_be_mood:
+                    self.buffer = rest
+                    break
+                self._emit(events, SPEECH_TEXT, "[")
+                self.buffer = rest[1:]
+                continue
+                
+            keep = _partial_suffix(buf, "<thought>")
+            self._emit(events, SPEECH_TEXT, buf[:len(buf) - keep])
+            self.buffer = buf[len(buf) - keep:]
+            break
+
+    def close(self):
+        """Flushes whatever is still held back at the end of the stream."""
+        events = []
+        if self.in_thought:
+            # </thought> never came (e.g. the reply hit max_tokens), so say it rather than leave the reply blank
+            self.buffer = "".join(self.thought_parts[self.thought_opened:]) + self.buffer
+            del self.thought_parts[self.thought_opened:]
+            self.in_thought = False
+            self._scan(events)
+            self.in_thought = False
+        self._emit(events, SPEECH_TEXT, self.buffer)
+        self.buffer = ""
+        return events
+
+def parse_message(content):
+    """Parses a complete message into (thought, speech, mood)."""
+    parser = StreamParser()
+    parser.feed(content)
+    parser.close()
+    return parser.thought, parser.speech, parser.mood or "neutral"
+
 class WaifuAI:
-    def __init__(self, model_path, context_size=8192, n_gpu_layers=-1):
+    def __init__(self, model_path, context_size=8192, n_gpu_layers=-1, speculative=False, pool=None):
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Model not found at {model_path}. Please run download_model.py first.")
         
-        if Llama is None:
+        if Llama is None and pool is None:
             raise ImportError("llama_cpp library not installed.")
 
-        print(f"Loading model from {model_path}...")
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=context_size,
-            n_gpu_layers=n_gpu_layers, # -1 means all layers to GPU
-            verbose=False
-        )
-        self.history = []
+        self.context_size = context_size
+        self.n_gpu_layers = n_gpu_layers
+        self.speculative = speculative
+        self.pool = pool # Optional ModelPool shared with other WaifuAI instances
+        self._pooled = None
+        self._load_model(model_path)
+        
+        self.draft_mode = "off"
+        self.draft = None # DraftStats around the active drafter
+        self._draft_settings = None
+        self.last_generation_stats = None
+        self.prefill_enabled = True # Off when another engine (inference_server) evaluates prompts
+        self._history = []
+        self._history_tokens = 0 # Running sum of _message_tokens over the history, None when unknown
         self.system_prompt = ""
+        self.status_text = ""
+        self._segment_cache = OrderedDict() # input hash -> formatted persona segment
         self.last_prompt = "" # Debugging
+        self.last_parse = None # StreamParser of the last reply
         self.lorebook = {}
+        self._lorebook_snapshot = "{}" # The lorebook lore_matcher was built from, as sorted JSON
+        self.lore_matcher = LoreMatcher()
+        self.lore_injector = LoreInjector()
+        self.last_lore_keys = []
+        self.memory_token_budget = 400
+        self.max_response_tokens = 512
+        self.last_budget = {}
+        self._token_counts = {} # (role, content) -> tokens of the formatted turn
 
-    def set_persona(self, name, description, scenario, example_dialogue, user_name="User", lorebook=None, past_events=None, stats=None, location="Home", current_time_str=None):
-        self.lorebook = lorebook or {}
+    def _load_model(self, model_path):
+        load_kwargs = {
+            "n_ctx": self.context_size,
+            "n_gpu_layers": self.n_gpu_layers, # -1 means all layers to GPU
+            "logits_all": self.speculative # Drafted tokens are verified against the logits of every position
+        }
+        if self.pool is not None:
+            # Shared model: the pool's lock queues this session behind the others and
+            # the saved prompt states are shared between sessions
+            self._pooled = self.pool.acquire(model_path, **load_kwargs)
+            # Sessions that just go away (closed tab) still hand the model back
+            self._release = weakref.finalize(self, self.pool.release, self._pooled)
+            self.llm = self._pooled.llm
+            self.prompt_cache = PromptCache(self.llm, max_states=self._pooled.max_states, lock=self._pooled.lock, states=self._pooled.states)
+        else:
+            print(f"Loading model from {model_path}...")
+            self.llm = Llama(model_path=model_path, verbose=False, **load_kwargs)
+            self.prompt_cache = PromptCache(self.llm)
+        self.model_path = model_path
+        self._model_hash = None
+        self._cold = True # Nothing evaluated in this context yet, set_persona warms it up
+
+    def switch_model(self, model_path):
+        """Swaps in another GGUF, keeping the persona and history. Returns True if the model changed."""
+        if os.path.abspath(model_path) == os.path.abspath(self.model_path):
+            return False
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model not found at {model_path}.")
+            
+        # Load the new model before letting go of the old one, so a failed load keeps the chat working
+        old = (self.llm, self.prompt_cache, self._pooled, getattr(self, "_release", None), self.model_path, self._model_hash, self._cold)
+        try:
+            self._load_model(model_path)
+        except Exception as e:
+            self.llm, self.prompt_cache, self._pooled, self._release, self.model_path, self._model_hash, self._cold = old
+            print(f"Error loading model {model_path}, keeping {os.path.basename(self.model_path)}: {e}")
+            return False
+        old_pooled, old_release = old[2], old[3]
+        if old_pooled is not None:
+            old_release()
+        self._token_counts = {}
+        self._history_tokens = None # Counted again with the new tokenizer
+        self.lore_injector._token_counts = {}
         
-        # Format past events (diary entries)
-        past_events_text = ""
-        if past_events:
-            past_events_text = "\n### Past Events (Diary)\n"
-            for entry in past_events:
-                past_events_text += f"- [{entry['date']}] {entry['content']}\n"
+        # A drafter bound to the old model's vocabulary has to be set up again
+        if self._draft_settings:
+            settings, self._draft_settings = self._draft_settings, None
+            self.draft = None
+            self.draft_mode = "off"
+            self.set_draft_mode(*settings)
+        # The caller sets the persona for the new model next, which warms it up
+        return True
+
+    def close(self):
+        """Gives the model back to the pool (or drops it) so it can be unloaded."""
+        if self._pooled is not None:
+            self._release()
+            self._pooled = None
+        self.llm = None
+
+    def set_persona(self, name, description, scenario, example_dialogue, user_name="User", lorebook=None, past_events=None, stats=None, location="Home", current_time_str=None):
+        lorebook = lorebook or {}
+        # The caller may hand back the same dict after editing it, so compare with a snapshot
+        snapshot = json.dumps(lorebook, sort_keys=True)
+        if snapshot != self._lorebook_snapshot:
+            self.lore_matcher = LoreMatcher(lorebook)
+            self._lorebook_snapshot = snapshot
+        self.lorebook = lorebook
         
-        # Format Stats
-        stats_text = ""
-        if stats:
-            stats_text = f"\n### Current Status\nLocation: {location}\nAffection: {stats.get('affection', 0)}/100\nEnergy: {stats.get('energy', 100)}/100\n"
+        # The system prompt only holds what stays the same for the whole session, so
+        # it remains a byte-identical prefix for the KV cache. Time, stats and location
+        # change every turn and go into a small status block next to the new message.
+        static_text = self._cached_segment(self._format_static_segment, name, description, scenario, example_dialogue, user_name)
+        diary_text = self._cached_segment(self._format_diary_segment, tuple((e['date'], e['content']) for e in past_events or []))
+        self.update_status(stats, location, current_time_str)
         
-        # Inject current time
-        from datetime import datetime
-        if current_time_str:
-            current_time = current_time_str
+        old_system_prompt = self.system_prompt
+        self.system_prompt = static_text + diary_text
+        if self.system_prompt != old_system_prompt or self._cold:
+            # Everything evaluated after the old system prompt is stale now
+            self.prompt_cache.invalidate(0)
+            self.warm_up()
+            self._cold = False
+
+    def _cached_segment(self, formatter, *inputs):
+        """Formats a prompt segment once per distinct input, keyed by a hash of the inputs."""
+        key = hashlib.sha1(repr((formatter.__name__,) + inputs).encode("utf-8")).hexdigest()
+        text = self._segment_cache.get(key)
+        if text is None:
+            text = formatter(*inputs)
+            self._segment_cache[key] = text
+            while len(self._segment_cache) > 32:
+                self._segment_cache.popitem(last=False)
         else:
-            current_time = datetime.now().strftime("%Y-%m-%d %I:%M %p")
-        
-        self.system_prompt = f"""You are an expert actor that can fully immerse yourself into any role given. You do not break character for any reason.
+            self._segment_cache.move_to_end(key)
+        return text
+
+    def _format_static_segment(self, name, description, scenario, example_dialogue, user_name):
+        return f"""You are an expert actor that can fully immerse yourself into any role given. You do not break character for any reason.
 Currently your role is {name}, which is described in detail below.
 As {name}, continue the exchange with {user_name}.
-Current Date/Time: {current_time}
-{stats_text}
 
 ### Character Description
 {description}
 
 ### Scenario
 {scenario}
-{past_events_text}
+
 ### Instructions
 1. Analyze the user's input ({user_name}) and your current emotional state.
 2. Output your internal thoughts in <thought> tags.
@@ -68,6 +308,107 @@ Current Date/Time: {current_time}
 {example_dialogue}
 """
 
+    def _format_diary_segment(self, past_events):
+        # Format past events (diary entries)
+        if not past_events:
+            return ""
+        past_events_text = "\n### Past Events (Diary)\n"
+        for date, content in past_events:
+            past_events_text += f"- [{date}] {content}\n"
+        return past_events_text
+
+    def update_status(self, stats=None, location="Home", current_time_str=None):
+        """Updates the time, stats and location block without touching the system prompt."""
+        # Inject current time
+        if current_time_str:
+            current_time = current_time_str
+        else:
+            current_time = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+        
+        # Format Stats
+        status_text = f"### Current Status\nCurrent Date/Time: {current_time}\n"
+        if stats:
+            status_text += f"Location: {location}\nAffection: {stats.get('affection', 0)}/100\nEnergy: {stats.get('energy', 100)}/100\n"
+        self.status_text = status_text
+
+    def warm_up(self):
+        """Evaluates the system prompt in the background so the first message only pays for itself."""
+        if not self.prefill_enabled:
+            return None
+        return self.prompt_cache.prefill_async(self._system_segment())
+
+    def _snapshot_tags(self):
+        """Identifies the model and context a state snapshot belongs to."""
+        if self._model_hash is None:
+            self._model_hash = model_fingerprint(self.model_path)
+        return {"model_hash": self._model_hash, "n_ctx": self.llm.n_ctx()}
+
+    def save_state_snapshot(self, path, max_bytes=None, tags=None):
+        """Saves the context state for the current system prompt and history to disk.
+
+        The history goes along as the model saw it (with its per-turn context blocks),
+        since a chat transcript alone doesn't rebuild the same prompt.
+        """
+        segments = self._build_prompt_segments("")[:len(self.history) + 1]
+        return self.prompt_cache.save_snapshot(segments, path, dict(self._snapshot_tags(), **(tags or {})), max_bytes, {"history": self.history})
+
+    def load_state_snapshot(self, path, tags=None):
+        """Restores a snapshot saved for this model, context size and tags, if there is one.
+
+        On success the history is replaced by the one saved with it. Returns False if the
+        snapshot is missing or stale, or doesn't cover the current system prompt and its history.
+        """
+        header = self.prompt_cache.load_snapshot(path, dict(self._snapshot_tags(), **(tags or {})))
+        if not header or "history" not in header:
+            return False
+            
+        history = header["history"]
+        tokens = []
+        for segment in [self._system_segment()] + [self._message_segment(m) for m in history]:
+            tokens.extend(self.prompt_cache.tokenize(segment))
+        # Everything the snapshot holds has to agree with the prompt rebuilt from it (the
+        # reply's closing tag was never evaluated, so it may end a little short)
+        with self.prompt_cache.lock:
+            covered = self.prompt_cache.cached_prefix_length(tokens) >= min(header["n_tokens"], len(tokens) - 1)
+        if not covered:
+            print(f"State snapshot {os.path.basename(path)} doesn't match the persona or history, ignoring it.")
+            return False
+        self.history = history
+        return True
+
+    def set_draft_mode(self, mode, num_pred_tokens=10, draft_model_path=DRAFT_MODEL_PATH):
+        """Switches speculative decoding between "off", "prompt_lookup" and "draft_model".
+
+        Needs a model loaded with speculative=True. Returns False if the mode could not be set.
+        """
+        settings = (mode, num_pred_tokens, draft_model_path)
+        if settings == self._draft_settings:
+            return True
+        if mode != "off" and not self.speculative:
+            print("Speculative decoding needs the model loaded with speculative=True.")
+            return False
+            
+        with self.prompt_cache.lock:
+            try:
+                # Keep an already loaded draft GGUF when only the draft length changes
+                if mode == "draft_model" and self.draft and isinstance(self.draft.draft, GGUFDraftModel) \
+                   and self.draft.draft.model_path == draft_model_path:
+                    self.draft.draft.num_pred_tokens = num_pred_tokens
+                    draft = DraftStats(self.draft.draft)
+                else:
+                    draft = make_draft_model(mode, num_pred_tokens, draft_model_path, context_size=self.llm.n_ctx())
+                    
+                if mode == "draft_model" and draft.draft.llm.n_vocab() != self.llm.n_vocab():
+                    raise ValueError("draft model has a different vocabulary")
+            except Exception as e:
+                print(f"Error setting up speculative decoding: {e}")
+                return False
+                
+            self.draft = draft
+            self.draft_mode = mode
+            self._draft_settings = settings
+        return True
+
     def analyze_sentiment(self, user_input):
         """Analyzes sentiment to update stats. Returns (affection_delta, energy_delta)."""
         # Simple keyword-based heuristic for speed (saving LLM calls)
@@ -114,12 +455,15 @@ Current Date/Time: {current_time}
         prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
         
         # Generate
-        output = self.llm(
-            prompt,
-            max_tokens=300,
-            stop=["<|eot_id|>"],
-            temperature=0.7
-        )
+        with self.prompt_cache.lock:
+            # The model may be shared, don't let a chat session's drafter guess a diary entry
+            self.llm.draft_model = None
+            output = self.llm(
+                prompt,
+                max_tokens=300,
+                stop=["<|eot_id|>"],
+                temperature=0.7
+            )
         
         return output['choices'][0]['text'].strip()
 
@@ -134,107 +478,321 @@ Current Date/Time: {current_time}
         prompt += f"<|start_header_id|>user<|end_header_id|>\n\nDiary Entry: {diary_entry}\n\nWhat do you dream about?<|eot_id|>"
         prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
         
-        output = self.llm(
-            prompt,
-            max_tokens=200,
-            stop=["<|eot_id|>"],
-            temperature=1.2 # High temp for creativity
-        )
+        with self.prompt_cache.lock:
+            self.llm.draft_model = None
+            output = self.llm(
+                prompt,
+                max_tokens=200,
+                stop=["<|eot_id|>"],
+                temperature=1.2 # High temp for creativity
+            )
         
         return output['choices'][0]['text'].strip()
 
+    def update_lore_entry(self, keyword, content):
+        """Adds or updates a lorebook entry without rebuilding the keyword index."""
+        self.lorebook[keyword] = content
+        self.lore_matcher.add(keyword, content)
+        self._lorebook_snapshot = json.dumps(self.lorebook, sort_keys=True)
+
+    def delete_lore_entry(self, keyword):
+        """Removes a lorebook entry from the keyword index."""
+        self.lorebook.pop(keyword, None)
+        self.lore_matcher.remove(keyword)
+        self._lorebook_snapshot = json.dumps(self.lorebook, sort_keys=True)
+
     def _get_active_lore(self, user_input):
-        """Scans input and recent history for lorebook keywords."""
+        """Picks the lorebook entries triggered by the input and recent history, within the lore token budget."""
+        self.last_lore_keys = []
         if not self.lorebook:
             return ""
             
-        # Context to scan: User input + last 2 messages
-        scan_text = user_input.lower()
-        for msg in self.history[-2:]:
-            scan_text += " " + msg['content'].lower()
-            
-        relevant_entries = []
-        for keyword, content in self.lorebook.items():
-            if keyword.lower() in scan_text:
-                relevant_entries.append(f"{keyword}: {content}")
+        # Context to scan: User input + last 2 messages, newest first
+        scan_texts = [user_input] + [msg['content'] for msg in reversed(self.history[-2:])]
+        
+        # Entries still visible in recent turns don't need to be injected again
+        recent_keys = set()
+        if self.lore_injector.dedup_turns > 0:
+            for msg in self.history[-2 * self.lore_injector.dedup_turns:]:
+                recent_keys.update(msg.get("lore_keys", []))
+        
+        keywords, relevant_entries, _ = self.lore_injector.select(
+            self.lore_matcher,
+            self.lorebook,
+            scan_texts,
+            lambda text: len(self.prompt_cache.tokenize(text)),
+            recent_keys
+        )
+        self.last_lore_keys = keywords
                 
         if not relevant_entries:
             return ""
             
         return "\n".join(relevant_entries)
 
-    def _trim_history(self, max_tokens=6000):
+    def _get_relevant_memories(self, memories):
+        """Formats recalled memories (best first) that aren't already in the prompt, within the memory token budget."""
+        if not memories:
+            return ""
+            
+        in_prompt = {msg['content'] for msg in self.history}
+        lines = []
+        used = 0
+        for memory in memories:
+            text = memory["text"]
+            if text in self.system_prompt or any(text in content for content in in_prompt):
+                continue
+            line = f"- [{memory['date']}] {text}" if memory.get("date") else f"- {text}"
+            cost = len(self.prompt_cache.tokenize(line))
+            if used + cost > self.memory_token_budget:
+                continue
+            lines.append(line)
+            used += cost
+        return "\n".join(lines)
+
+    def _message_tokens(self, msg):
+        """Returns the token count of a history message, chat template included."""
+        role = "user" if msg["role"] == "user" else "assistant"
+        key = (role, msg['content'], msg.get("context", ""))
+        count = self._token_counts.get(key)
+        if count is None:
+            count = len(self.prompt_cache.tokenize(self._message_segment(msg)))
+            self._token_counts[key] = count
+        return count
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, messages):
+        # Restored or loaded histories are counted once, on the next budget check
+        self._history = messages
+        self._history_tokens = None
+
+    @property
+    def history_tokens(self):
+        """Tokens the history takes up in the prompt, kept up to date as messages come and go."""
+        if self._history_tokens is None:
+            self._history_tokens = sum(self._message_tokens(m) for m in self._history)
+        return self._history_tokens
+
+    def get_context_budget(self, user_input="", turn_context=""):
+        """Breaks the context window down into system prompt, per-turn blocks, reply and history."""
+        n_ctx = self.llm.n_ctx()
+        system = len(self.prompt_cache.tokenize(self._system_segment()))
+        tail = [len(self.prompt_cache.tokenize(seg)) for seg in self._tail_segments(user_input, turn_context)]
+        context = sum(tail[:-1])
+        new_turn = tail[-1]
+        history = self.history_tokens
+        history_budget = n_ctx - system - context - new_turn - self.max_response_tokens
+        
+        return {
+            "n_ctx": n_ctx,
+            "system": system,
+            "context": context,
+            "new_turn": new_turn,
+            "response": self.max_response_tokens,
+            "history": history,
+            "history_budget": history_budget,
+            "free": history_budget - history
+        }
+
+    def _trim_history(self, max_tokens=None, low_water=0.75):
         """Trims history to fit within context window, keeping recent messages."""
-        # Simple heuristic: 1 token ~= 4 chars. 
-        # This is a rough estimation to avoid expensive tokenization on every turn.
-        current_est_tokens = sum(len(m['content']) for m in self.history) / 3
+        if max_tokens is None:
+            max_tokens = self.get_context_budget()["history_budget"]
+            
+        total = self.history_tokens
+        if total <= max_tokens:
+            return total
         
-        while current_est_tokens > max_tokens and len(self.history) > 2:
+        # Trimming shifts the whole history and invalidates the cached prefix, so
+        # trim well below the limit instead of one pair per turn.
+        target = max_tokens * low_water
+        cut = 0
+        while total > target and len(self.history) - cut > 2:
             # Remove the oldest pair of messages (User + AI)
-            self.history.pop(0) 
-            if self.history and self.history[0]['role'] == 'assistant':
-                 self.history.pop(0) # Ensure we start with user
-            current_est_tokens = sum(len(m['content']) for m in self.history) / 3
-
-    def generate_response(self, user_input, temperature=0.9, top_p=0.95, min_p=0.05, repetition_penalty=1.1, top_k=40):
-        # Trim history before generating
-        self._trim_history()
+            total -= self._message_tokens(self.history[cut])
+            cut += 1
+            if cut < len(self.history) and self.history[cut]['role'] == 'assistant':
+                total -= self._message_tokens(self.history[cut]) # Ensure we start with user
+                cut += 1
+        del self.history[:cut]
+        self._history_tokens = total
         
-        # Check for Lorebook entries
-        active_lore = self._get_active_lore(user_input)
-        current_system_prompt = self.system_prompt
+        # Forget counts for messages that are gone
+        if len(self._token_counts) > 2 * len(self.history):
+            live = {("user" if m["role"] == "user" else "assistant", m['content'], m.get("context", "")) for m in self.history}
+            self._token_counts = {k: v for k, v in self._token_counts.items() if k in live}
         
+        # History starts right after the system prompt segment
+        self.prompt_cache.invalidate(1)
+        return total
+
+    def _format_turn(self, role, content):
+        """Formats a single Llama 3 chat turn."""
+        return f"<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>"
+
+    def _current_status(self):
+        """Returns the status block if the model hasn't seen this exact status in the retained history."""
+        for msg in reversed(self.history):
+            if msg.get("status"):
+                return "" if msg["status"] == self.status_text else self.status_text
+        return self.status_text
+
+    def _turn_context(self, status_text="", active_lore="", memories_text=""):
+        """Combines the per-turn status, world info and recalled memories into one system block body."""
+        parts = []
+        if status_text:
+            parts.append(status_text.rstrip("\n"))
         if active_lore:
-            current_system_prompt += f"\n\n### Relevant World Info\n{active_lore}"
-        
-        # Construct the prompt using Llama 3 format
-        prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
-        prompt += current_system_prompt + "<|eot_id|>"
+            parts.append(f"### Relevant World Info\n{active_lore}")
+        if memories_text:
+            parts.append(f"### Memories\n{memories_text}")
+        return "\n\n".join(parts)
+
+    def _message_segment(self, msg):
+        """Formats a history message, with the context block that was injected for it."""
+        role = "user" if msg["role"] == "user" else "assistant"
+        segment = self._format_turn(role, msg['content'])
+        if msg.get("context"):
+            segment = self._format_turn("system", msg["context"]) + segment
+        return segment
+
+    def _system_segment(self):
+        return "<|begin_of_text|>" + self._format_turn("system", self.system_prompt)
+
+    def _tail_segments(self, user_input, turn_context=""):
+        """Per-turn segments that follow the history; the new user turn is always last."""
+        segments = []
+        if turn_context:
+            segments.append(self._format_turn("system", turn_context))
+            
+        segments.append(self._format_turn("user", user_input) + "<|start_header_id|>assistant<|end_header_id|>\n\n")
+        return segments
+
+    def _build_prompt_segments(self, user_input, turn_context=""):
+        """Builds the prompt as segments ordered from most to least stable.
+
+        The system prompt and history come first so they stay a byte-identical prefix
+        between turns; per-turn content (world info, memories, the new message) goes at the end.
+        """
+        segments = [self._system_segment()]
         
         for msg in self.history:
-            role = "user" if msg["role"] == "user" else "assistant"
-            prompt += f"<|start_header_id|>{role}<|end_header_id|>\n\n{msg['content']}<|eot_id|>"
-            
-        prompt += f"<|start_header_id|>user<|end_header_id|>\n\n{user_input}<|eot_id|>"
-        prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
+            segments.append(self._message_segment(msg))
+        
+        return segments + self._tail_segments(user_input, turn_context)
 
-        # Save for debugging
-        self.last_prompt = prompt
-
-        # Stream the response
-        stream = self.llm(
-            prompt,
-            max_tokens=512,
-            stop=["<|eot_id|>", "User:"],
-            stream=True,
-            temperature=temperature,
-            top_p=top_p,
-            min_p=min_p,
-            repeat_penalty=repetition_penalty,
-            top_k=top_k
-        )
+    def prepare_turn(self, user_input, memories=None):
+        """Builds the prompt tokens for a new user message.
+
+        Returns (prompt_tokens, turn); hand the turn to record_turn() with the reply.
+        """
+        with self.prompt_cache.lock:
+            # Check for Lorebook entries and recalled long-term memories
+            active_lore = self._get_active_lore(user_input)
+            status_text = self._current_status()
+            turn_context = self._turn_context(status_text, active_lore, self._get_relevant_memories(memories))
+        
+            # Trim history to what is left after the system prompt, turn context and reply
+            budget = self.get_context_budget(user_input, turn_context)
+            budget["history"] = self._trim_history(budget["history_budget"])
+            budget["free"] = budget["history_budget"] - budget["history"]
+            self.last_budget = budget
         
-        full_response = ""
-        for output in stream:
-            chunk = output['choices'][0]['text']
-            full_response += chunk
-            yield chunk
+            # Construct the prompt using Llama 3 format
+            segments = self._build_prompt_segments(user_input, turn_context)
+            prompt_tokens = self.prompt_cache.build(segments)
+
+            # Save for debugging
+            self.last_prompt = "".join(segments)
             
+        turn = {"user_input": user_input, "context": turn_context, "status": status_text, "lore_keys": self.last_lore_keys}
+        return prompt_tokens, turn
+
+    def record_turn(self, turn, full_response):
+        """Adds a finished exchange to the history."""
         # Update history with the full response (thoughts + speech)
-        self.history.append({"role": "user", "content": user_input})
-        self.history.append({"role": "assistant", "content": full_response})
+        # Status, world info and memories stay attached to their turn, so they remain part of
+        # the cached prefix and aren't injected again while that turn is in context
+        user_msg = {"role": "user", "content": turn["user_input"]}
+        if turn["context"]:
+            user_msg["context"] = turn["context"]
+        if turn["status"]:
+            user_msg["status"] = turn["status"]
+        if turn["lore_keys"]:
+            user_msg["lore_keys"] = turn["lore_keys"]
+        assistant_msg = {"role": "assistant", "content": full_response}
+        self.history.append(user_msg)
+        self.history.append(assistant_msg)
+        if self._history_tokens is not None:
+            self._history_tokens += self._message_tokens(user_msg) + self._message_tokens(assistant_msg)
+
+    def generate_response(self, user_input, temperature=0.9, top_p=0.95, min_p=0.05, repetition_penalty=1.1, top_k=40, memories=None, events=False):
+        """Streams the reply. Yields text chunks, or (event, text) tuples from StreamParser if events is True."""
+        with self.prompt_cache.lock:
+            prompt_tokens, turn = self.prepare_turn(user_input, memories)
+
+            # Stream the response (llama.cpp skips the already evaluated prefix)
+            # The model may be shared with other sessions, so attach this session's drafter
+            self.llm.draft_model = self.draft
+            if self.draft:
+                self.draft.reset()
+            started = time.perf_counter()
+            stream = self.llm(
+                prompt_tokens,
+                max_tokens=self.max_response_tokens,
+                stop=STOP_STRINGS,
+                stream=True,
+                temperature=temperature,
+                top_p=top_p,
+                min_p=min_p,
+                repeat_penalty=repetition_penalty,
+                top_k=top_k
+            )
+        
+            parser = StreamParser()
+            for output in stream:
+                chunk = output['choices'][0]['text']
+                parsed = parser.feed(chunk)
+                if events:
+                    yield from parsed
+                else:
+                    yield chunk
+                    
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            
+        stats = {"mode": self.draft_mode, "tokens": parser.chunks, "seconds": elapsed, "tokens_per_sec": parser.chunks / elapsed}
+        if self.draft:
+            stats.update(self.draft.summary(parser.chunks))
+        self.last_generation_stats = stats
+            
+        parsed = parser.close()
+        if events:
+            yield from parsed
+        self.last_parse = parser
+        self.record_turn(turn, parser.text)
 
     def regenerate_last(self):
         """Removes the last assistant message so it can be regenerated."""
         if self.history and self.history[-1]['role'] == 'assistant':
-            self.history.pop()
+            msg = self.history.pop()
+            if self._history_tokens is not None:
+                self._history_tokens -= self._message_tokens(msg)
             return True
         return False
         
     def edit_message(self, index, new_content):
         """Edits a message at a specific index."""
         if 0 <= index < len(self.history):
+            if self._history_tokens is not None:
+                self._history_tokens -= self._message_tokens(self.history[index])
             self.history[index]['content'] = new_content
+            if self._history_tokens is not None:
+                self._history_tokens += self._message_tokens(self.history[index])
+            self.prompt_cache.invalidate(index + 1)
             return True
         return False
 
@@ -243,27 +801,13 @@ Current Date/Time: {current_time}
         if not self.history:
             return None, None, "neutral"
             
+        # The streaming parser already split the reply while it was generated
         last_msg = self.history[-1]['content']
-        thought = ""
-        mood = "neutral"
-        speech = last_msg
-        
-        # Extract Thought
-        if "<thought>" in last_msg and "</thought>" in last_msg:
-            start = last_msg.find("<thought>") + len("<thought>")
-            end = last_msg.find("</thought>")
-            thought = last_msg[start:end].strip()
-            speech = last_msg[end+len("</thought>"):].strip()
-            
-        # Extract Mood (e.g., [Mood: Happy])
-        import re
-        mood_match = re.search(r'\[Mood:\s*([a-zA-Z0-9_\s]+)\]', speech, re.IGNORECASE)
-        if mood_match:
-            mood = mood_match.group(1).strip().lower()
-            # Remove the mood tag from speech so user doesn't see it
-            speech = speech.replace(mood_match.group(0), "").strip()
+        parser = self.last_parse
+        if parser is not None and parser.text == last_msg:
+            return parser.thought, parser.speech, parser.mood or "neutral"
             
-        return thought, speech, mood
+        return parse_message(last_msg)
 
     def clear_history(self):
         self.history = []
@@ -1,14 +1,27 @@
 import os
 import json
 import glob
+import base64
 from datetime import datetime
+from audio_store import AudioStore, bytes_key
+from config_store import get_config_store
+from entry_log import EntryLog
+from session_index import SessionIndex, session_preview
 
 CHARACTERS_DIR = "./characters"
 
+# LLM state snapshots stored next to sessions are large (hundreds of MB each)
+STATE_SNAPSHOT_MAX_BYTES = 2 * 1024 ** 3
+STATE_SNAPSHOT_BUDGET_BYTES = 4 * 1024 ** 3 # Per character
+
 class CharacterManager:
-    def __init__(self):
+    def __init__(self, memory_mgr=None, config_store=None):
         self.current_character = None
         self.character_config = {}
+        self.memory_mgr = memory_mgr # Optional MemoryManager, updated on every diary/dream/session save
+        self.config_store = config_store or get_config_store() # Stats/time/location changes are written behind
+        self.session_digests = {} # Session log path -> digests of what was last saved, to append only new messages
+        self._session_indexes = {} # Character -> SessionIndex, opened once
         
     def list_characters(self):
         """Returns a list of available character names based on folders."""
@@ -23,6 +36,9 @@ class CharacterManager:
     def load_character(self, name):
         """Loads the config for a specific character."""
         config_path = os.path.join(CHARACTERS_DIR, name, "config.json")
+        # Write out what is pending for the character we leave and the one we read
+        self.flush()
+        self.config_store.flush(config_path)
         if not os.path.exists(config_path):
             raise FileNotFoundError(f"Config not found for character: {name}")
             
@@ -44,27 +60,99 @@ class CharacterManager:
             os.makedirs(history_dir)
 
         config_path = os.path.join(char_dir, "config.json")
-        with open(config_path, "w", encoding="utf-8") as f:
-            json.dump(config_data, f, indent=4, ensure_ascii=False)
+        self.config_store.write_now(config_path, config_data)
             
         return True
 
-    def list_sessions(self):
-        """Lists saved sessions for the current character."""
+    def _save_config(self):
+        """Marks the current config changed; the config store writes it shortly after."""
+        config_path = os.path.join(CHARACTERS_DIR, self.current_character, "config.json")
+        self.config_store.mark_dirty(config_path, self.character_config)
+        return True
+
+    def flush(self):
+        """Writes the current config now if it has pending changes."""
+        if self.current_character:
+            self.config_store.flush(os.path.join(CHARACTERS_DIR, self.current_character, "config.json"))
+
+    def session_index(self):
+        """The current character's SessionIndex, built from the session files the first time.
+
+        None while the character has no history/ folder (nothing saved yet).
+        """
         if not self.current_character:
-            return []
+            return None
             
+        index = self._session_indexes.get(self.current_character)
+        if index is None:
+            history_dir = os.path.join(CHARACTERS_DIR, self.current_character, "history")
+            if not os.path.exists(history_dir):
+                return None
+            index = SessionIndex(history_dir)
+            if index.created:
+                self.reindex_sessions(index)
+            self._session_indexes[self.current_character] = index
+        return index
+
+    def reindex_sessions(self, index=None):
+        """Rebuilds the session index by reading every session file once."""
+        index = index or self.session_index()
+        if not index:
+            return
         history_dir = os.path.join(CHARACTERS_DIR, self.current_character, "history")
-        if not os.path.exists(history_dir):
-            return []
+        
+        # Sessions are .jsonl logs; older saves are still .json until saved again
+        names = {}
+        for f in glob.glob(os.path.join(history_dir, "*.json")) + glob.glob(os.path.join(history_dir, "*.jsonl")):
+            names.setdefault(os.path.splitext(os.path.basename(f))[0] + ".json", []).append(f)
             
-        files = glob.glob(os.path.join(history_dir, "*.json"))
-        # Return filenames sorted by modified time (newest first)
-        files.sort(key=os.path.getmtime, reverse=True)
-        return [os.path.basename(f) for f in files]
+        rows = []
+        for name, files in names.items():
+            try:
+                history, _ = self.load_session(name)
+            except (OSError, ValueError) as e:
+                print(f"Skipping session {name}: {e}")
+                continue
+            modified = max(os.path.getmtime(f) for f in files)
+            rows.append({
+                "name": name,
+                "created": modified,
+                "modified": modified,
+                "message_count": len(history),
+                "byte_size": sum(os.path.getsize(f) for f in files),
+                "preview": session_preview(history)
+            })
+        index.replace_all(rows)
+        return len(rows)
+
+    def list_sessions(self, limit=None, offset=0, query=None):
+        """Lists saved sessions for the current character (newest first), from the index."""
+        return [row["name"] for row in self.list_session_info(limit, offset, query)]
+
+    def list_session_info(self, limit=None, offset=0, query=None):
+        """Like list_sessions, with created/modified, message_count, byte_size and preview."""
+        index = self.session_index()
+        if not index:
+            return []
+        return index.list(limit=limit, offset=offset, query=query)
+
+    def count_sessions(self, query=None):
+        index = self.session_index()
+        return index.count(query) if index else 0
+
+    def _session_paths(self, session_name):
+        """Returns (log path, old .json path) of a session."""
+        history_dir = os.path.join(CHARACTERS_DIR, self.current_character, "history")
+        stem = os.path.splitext(session_name)[0]
+        return os.path.join(history_dir, stem + ".jsonl"), os.path.join(history_dir, stem + ".json")
 
     def save_session(self, history, session_name=None, user_persona=None):
-        """Saves the current chat history to a JSON file."""
+        """Saves the current chat history.
+
+        Stored as a JSON Lines log (the user persona, then one message per line), so
+        saving the same session again only appends the new messages. Inline base64
+        audio is moved to the audio store and replaced by its "audio_ref", in place.
+        """
         if not self.current_character:
             return None
             
@@ -80,16 +168,18 @@ class CharacterManager:
         if not session_name.endswith(".json"):
             session_name += ".json"
             
-        file_path = os.path.join(history_dir, session_name)
-        
-        data = {
-            "history": history,
-            "user_persona": user_persona or {"name": "User", "description": ""}
-        }
-        
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        for msg in history:
+            self._move_audio_to_store(msg)
+            
+        log_path, legacy_path = self._session_paths(session_name)
+        header = {"user_persona": user_persona or {"name": "User", "description": ""}}
+        log = EntryLog(log_path)
+        self.session_digests[log_path] = log.sync([header] + list(history), self.session_digests.get(log_path))
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path) # Migrated
+        self.session_index().upsert(session_name, len(history), os.path.getsize(log_path), session_preview(history))
             
+        self._remember(lambda mem: mem.add_session(self.current_character, session_name, history))
         return session_name
 
     def load_session(self, filename):
@@ -97,17 +187,85 @@ class CharacterManager:
         if not self.current_character:
             return [], {}
             
-        file_path = os.path.join(CHARACTERS_DIR, self.current_character, "history", filename)
-        if not os.path.exists(file_path):
+        log_path, legacy_path = self._session_paths(filename)
+        if os.path.exists(log_path):
+            entries = EntryLog(log_path).read_all()
+            if not entries:
+                return [], {"name": "User", "description": ""}
+            return entries[1:], entries[0].get("user_persona", {"name": "User", "description": ""})
+            
+        if not os.path.exists(legacy_path):
             raise FileNotFoundError(f"Session file not found: {filename}")
             
-        with open(file_path, "r", encoding="utf-8") as f:
+        with open(legacy_path, "r", encoding="utf-8") as f:
             data = json.load(f)
             # Handle backward compatibility with old saves (list only)
             if isinstance(data, list):
                 return data, {"name": "User", "description": ""}
             return data.get("history", []), data.get("user_persona", {"name": "User", "description": ""})
 
+    def audio_store(self):
+        """Content-addressed TTS clips of the current character."""
+        if not self.current_character:
+            return None
+        return AudioStore(os.path.join(CHARACTERS_DIR, self.current_character, "audio"))
+
+    def _move_audio_to_store(self, msg):
+        """Replaces a message's inline base64 "audio" (older saves) with an "audio_ref"."""
+        if "audio" not in msg:
+            return
+        try:
+            data = base64.b64decode(msg["audio"])
+        except (TypeError, ValueError):
+            return
+        msg["audio_ref"] = self.audio_store().put(bytes_key(data), data)
+        del msg["audio"]
+
+    def gc_audio(self, live_messages=(), min_age_seconds=3600):
+        """Deletes clips that no saved session (or live_messages) refers to. Returns (removed, bytes freed)."""
+        store = self.audio_store()
+        if not store:
+            return 0, 0
+            
+        referenced = {msg["audio_ref"] for msg in live_messages if "audio_ref" in msg}
+        for session_name in self.list_sessions():
+            try:
+                history, _ = self.load_session(session_name)
+            except (OSError, ValueError) as e:
+                # Can't tell what it uses, keep everything
+                print(f"Skipping audio cleanup, unreadable session {session_name}: {e}")
+                return 0, 0
+            referenced.update(msg["audio_ref"] for msg in history if "audio_ref" in msg)
+        return store.gc(referenced, min_age_seconds=min_age_seconds)
+
+    def get_session_state_path(self, session_name):
+        """Returns the path of the LLM state snapshot that belongs to a session file."""
+        if not self.current_character:
+            return None
+            
+        stem = session_name[:-len(".json")] if session_name.endswith(".json") else session_name
+        return os.path.join(CHARACTERS_DIR, self.current_character, "history", stem + ".state")
+
+    def prune_session_states(self, max_total_bytes=STATE_SNAPSHOT_BUDGET_BYTES, keep=None):
+        """Deletes the oldest state snapshots until the character's total fits the budget."""
+        if not self.current_character:
+            return 0
+            
+        history_dir = os.path.join(CHARACTERS_DIR, self.current_character, "history")
+        files = glob.glob(os.path.join(history_dir, "*.state"))
+        files.sort(key=os.path.getmtime, reverse=True)
+        
+        removed = 0
+        total = 0
+        for f in files:
+            size = os.path.getsize(f)
+            if total + size > max_total_bytes and f != keep:
+                os.remove(f)
+                removed += 1
+                continue
+            total += size
+        return removed
+
     def get_avatar_for_emotion(self, emotion_text):
         """Returns the avatar emoji/image path for a given emotion text."""
         if not self.character_config or "avatar_emotion_map" not in self.character_config:
@@ -190,14 +348,14 @@ class CharacterManager:
             self.character_config["location_images"] = {}
             
         self.character_config["location_images"][location] = filename
-        self.save_character(self.current_character, self.character_config)
+        self._save_config()
 
     def set_time(self, hour):
         """Sets the current time (0-23)."""
         if not self.character_config:
             return
         self.character_config["current_time"] = hour % 24
-        self.save_character(self.current_character, self.character_config)
+        self._save_config()
 
     def get_time(self):
         """Returns current time (0-23)."""
@@ -220,7 +378,7 @@ class CharacterManager:
         # Update last active timestamp
         self.character_config["last_active"] = datetime.now().timestamp()
         
-        self.save_character(self.current_character, self.character_config)
+        self._save_config()
         return stats
 
     def get_last_active(self):
@@ -297,7 +455,7 @@ class CharacterManager:
         if not self.character_config:
             return
         self.character_config["current_location"] = location_name
-        self.save_character(self.current_character, self.character_config)
+        self._save_config()
         
     def get_location(self):
         if not self.character_config:
@@ -319,7 +477,7 @@ class CharacterManager:
             self.character_config["lorebook"] = {}
             
         self.character_config["lorebook"][keyword] = content
-        return self.save_character(self.current_character, self.character_config)
+        return self._save_config()
 
     def delete_lore_entry(self, keyword):
         """Deletes a lorebook entry."""
@@ -328,31 +486,33 @@ class CharacterManager:
             
         if keyword in self.character_config["lorebook"]:
             del self.character_config["lorebook"][keyword]
-            return self.save_character(self.current_character, self.character_config)
+            return self._save_config()
         return False
 
+    def _entry_log(self, name):
+        """Append-only log of diary entries or dreams. Moves an old <name>.json array into it on first use."""
+        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
+        log = EntryLog(os.path.join(char_dir, name + ".jsonl"))
+        legacy_path = os.path.join(char_dir, name + ".json")
+        if not log.exists() and os.path.exists(legacy_path):
+            # Old arrays were saved newest first; the log keeps them oldest first for tail reads
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                log.rewrite(sorted(json.load(f), key=lambda x: x['date']))
+            os.replace(legacy_path, legacy_path + ".bak")
+        return log
+
     def save_diary_entry(self, entry_text):
         """Saves a new diary entry for the current character."""
         if not self.current_character:
             return False
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        diary_path = os.path.join(char_dir, "diary.json")
-        
-        entries = []
-        if os.path.exists(diary_path):
-            with open(diary_path, "r", encoding="utf-8") as f:
-                entries = json.load(f)
-                
         new_entry = {
             "date": datetime.now().strftime("%Y-%m-%d %H:%M"),
             "content": entry_text
         }
-        entries.append(new_entry)
-        
-        with open(diary_path, "w", encoding="utf-8") as f:
-            json.dump(entries, f, indent=2, ensure_ascii=False)
+        self._entry_log("diary").append([new_entry])
             
+        self._remember(lambda mem: mem.add_entry(self.current_character, "diary", new_entry))
         return True
 
     def get_recent_diary_entries(self, limit=3):
@@ -360,32 +520,15 @@ class CharacterManager:
         if not self.current_character:
             return []
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        diary_path = os.path.join(char_dir, "diary.json")
-        
-        if not os.path.exists(diary_path):
-            return []
-            
-        with open(diary_path, "r", encoding="utf-8") as f:
-            entries = json.load(f)
-            
-        # Get last N entries
-        recent = entries[-limit:]
-        return recent
+        # Reads only the last N entries of the log
+        return self._entry_log("diary").tail(limit)
 
     def get_all_diary_entries(self):
         """Returns all diary entries."""
         if not self.current_character:
             return []
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        diary_path = os.path.join(char_dir, "diary.json")
-        
-        if not os.path.exists(diary_path):
-            return []
-            
-        with open(diary_path, "r", encoding="utf-8") as f:
-            entries = json.load(f)
+        entries = self._entry_log("diary").read_all()
         
         # Sort by date descending (newest first)
         return sorted(entries, key=lambda x: x['date'], reverse=True)
@@ -395,22 +538,13 @@ class CharacterManager:
         if not self.current_character:
             return False
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        dream_path = os.path.join(char_dir, "dreams.json")
-        
-        dreams = []
-        if os.path.exists(dream_path):
-            with open(dream_path, "r", encoding="utf-8") as f:
-                dreams = json.load(f)
-                
         new_dream = {
             "date": datetime.now().strftime("%Y-%m-%d %H:%M"),
             "content": dream_text
         }
-        dreams.append(new_dream)
-        
-        with open(dream_path, "w", encoding="utf-8") as f:
-            json.dump(dreams, f, indent=2, ensure_ascii=False)
+        self._entry_log("dreams").append([new_dream])
+            
+        self._remember(lambda mem: mem.add_entry(self.current_character, "dream", new_dream))
         return True
 
     def get_all_dreams(self):
@@ -418,27 +552,52 @@ class CharacterManager:
         if not self.current_character:
             return []
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        dream_path = os.path.join(char_dir, "dreams.json")
-        
-        if not os.path.exists(dream_path):
-            return []
-            
-        with open(dream_path, "r", encoding="utf-8") as f:
-            dreams = json.load(f)
+        dreams = self._entry_log("dreams").read_all()
             
         return sorted(dreams, key=lambda x: x['date'], reverse=True)
 
+    def _remember(self, update):
+        """Applies an incremental update to the memory index, never failing the save itself."""
+        if not self.memory_mgr or not self.current_character:
+            return
+        try:
+            update(self.memory_mgr)
+        except Exception as e:
+            print(f"Memory index error: {e}")
+
+    def build_memory_index(self):
+        """Indexes what the current character has written so far.
+
+        Diary and dreams are indexed on the first run; sessions whenever the index is
+        behind their message count (e.g. a previous run was interrupted).
+        """
+        if not self.memory_mgr or not self.current_character:
+            return
+        if self.memory_mgr.is_empty(self.current_character):
+            for entry in sorted(self.get_all_diary_entries(), key=lambda x: x['date']):
+                self._remember(lambda mem: mem.add_entry(self.current_character, "diary", entry))
+            for dream in sorted(self.get_all_dreams(), key=lambda x: x['date']):
+                self._remember(lambda mem: mem.add_entry(self.current_character, "dream", dream))
+            
+        indexed = self.memory_mgr.indexed_sessions(self.current_character)
+        for info in reversed(self.list_session_info()):
+            session_name = info["name"]
+            if indexed.get(session_name) == info["message_count"]:
+                continue # Already up to date, don't read the file
+            try:
+                history, _ = self.load_session(session_name)
+            except (OSError, ValueError) as e:
+                print(f"Skipping session {session_name}: {e}")
+                continue
+            self._remember(lambda mem: mem.add_session(self.current_character, session_name, history))
+
     def save_diary(self, entries):
-        """Overwrites the diary with new entries."""
+        """Overwrites the diary with new entries (compacts the log)."""
         if not self.current_character:
             return False
             
-        char_dir = os.path.join(CHARACTERS_DIR, self.current_character)
-        diary_path = os.path.join(char_dir, "diary.json")
-        
-        with open(diary_path, "w", encoding="utf-8") as f:
-            json.dump(entries, f, indent=2, ensure_ascii=False)
+        # The editor hands them over newest first; the log keeps them oldest first for tail reads
+        self._entry_log("diary").rewrite(sorted(entries, key=lambda x: x['date']))
         return True
 
     def export_character(self, name):
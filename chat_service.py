@@ -0,0 +1,307 @@
+import io
+import os
+import json
+import uuid
+import hashlib
+import queue
+import asyncio
+import threading
+
+from brain import WaifuAI, StreamParser, THOUGHT_TEXT, THOUGHT_END
+from character_manager import CharacterManager, STATE_SNAPSHOT_MAX_BYTES
+from memory_manager import MemoryManager
+from model_pool import ModelPool, model_path_for
+
+def emotion_from_thought(config, thought):
+    """Picks the avatar emotion whose name appears in a thought, else "neutral"."""
+    thought = thought.lower()
+    for emotion_key in config.get("avatar_emotion_map", {}):
+        if emotion_key in thought:
+            return emotion_key
+    return "neutral"
+
+class ChatSession:
+    """One conversation: a character, its WaifuAI and the chat as the user sees it."""
+
+    def __init__(self, session_id, char_mgr, waifu, user_persona, batched=False, messages=None, current_emotion="neutral"):
+        self.id = session_id
+        self.char_mgr = char_mgr
+        self.waifu = waifu
+        self.batched = batched # Replies come from the shared InferenceServer
+        self.user_persona = user_persona
+        self.messages = messages if messages is not None else []
+        self.current_emotion = current_emotion
+        self.lock = threading.Lock() # One reply at a time per session
+
+    def summary(self):
+        return {
+            "session_id": self.id,
+            "character": self.char_mgr.current_character,
+            "user_persona": self.user_persona,
+            "emotion": self.current_emotion,
+            "stats": self.char_mgr.get_stats(),
+            "location": self.char_mgr.get_location(),
+            "messages": self.messages
+        }
+
+class ChatService:
+    """Everything the UI does with the managers, without Streamlit.
+
+    Sessions live in this process and share the loaded models through the pool.
+    api_server exposes it over HTTP/WebSocket; any other frontend can call it directly.
+    The vision, hearing and voice managers are only created when first used.
+    Frontends that keep their own state (the Streamlit app) wrap it in a ChatSession
+    and call run_turn(), save() and load() directly.
+
+    With batch_slots > 0, sessions on the default model are answered by one
+    inference_server.InferenceServer, which batches their turns together instead
+    of queueing them on the model's lock.
+    """
+
+    def __init__(self, default_model_path, pool=None, memory_mgr=None, batch_slots=0, slot_ctx=4096):
+        self.default_model_path = default_model_path
+        self.pool = pool or ModelPool()
+        self.memory_mgr = memory_mgr or MemoryManager()
+        self.batch_slots = batch_slots
+        self.slot_ctx = slot_ctx
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self._voice_mgr = None
+        self._vision_mgr = None
+        self._hearing_mgr = None
+        self._inference_server = None
+        self._server_loop = None
+
+    # --- Managers ---
+
+    @property
+    def voice_mgr(self):
+        if self._voice_mgr is None:
+            from voice_manager import VoiceManager
+            self._voice_mgr = VoiceManager()
+        return self._voice_mgr
+
+    @property
+    def vision_mgr(self):
+        if self._vision_mgr is None:
+            from vision_manager import VisionManager
+            self._vision_mgr = VisionManager()
+        return self._vision_mgr
+
+    @property
+    def hearing_mgr(self):
+        if self._hearing_mgr is None:
+            from hearing_manager import HearingManager
+            self._hearing_mgr = HearingManager()
+        return self._hearing_mgr
+
+    @property
+    def inference_server(self):
+        """The batching server for the default model, running on its own event loop thread."""
+        with self.lock:
+            if self._inference_server is None:
+                from inference_server import create_server
+                server = create_server(self.pool, self.default_model_path, n_slots=self.batch_slots, slot_ctx=self.slot_ctx)
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="inference-server", daemon=True).start()
+                asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+                self._server_loop = loop
+                self._inference_server = server
+            return self._inference_server
+
+    # --- Sessions ---
+
+    def list_characters(self):
+        return CharacterManager().list_characters()
+
+    def _apply_persona(self, session):
+        config = session.char_mgr.character_config
+        session.waifu.set_persona(
+            config["name"],
+            config["description"],
+            config["scenario"],
+            config["example_dialogue"],
+            user_name=session.user_persona["name"],
+            lorebook=config.get("lorebook", {}),
+            past_events=session.char_mgr.get_recent_diary_entries(),
+            stats=session.char_mgr.get_stats(),
+            location=session.char_mgr.get_location(),
+            current_time_str=f"{session.char_mgr.get_time()}:00"
+        )
+
+    def create_session(self, character, user_persona=None):
+        """Loads a character into a new session. Raises FileNotFoundError for unknown characters."""
+        char_mgr = CharacterManager(memory_mgr=self.memory_mgr)
+        config = char_mgr.load_character(character)
+        char_mgr.build_memory_index()
+
+        model_path = model_path_for(config, self.default_model_path)
+        batched = self.batch_slots > 0 and os.path.abspath(model_path) == os.path.abspath(self.default_model_path)
+        if batched:
+            # Start the server first; the session then gets the pool entry it loaded
+            # (same path and load settings), so it tokenizes with the Llama the server decodes on
+            self.inference_server
+            waifu = WaifuAI(model_path, context_size=self.slot_ctx, pool=self.pool)
+            waifu.prefill_enabled = False
+        else:
+            waifu = WaifuAI(model_path, pool=self.pool)
+        session = ChatSession(uuid.uuid4().hex, char_mgr, waifu, user_persona or {"name": "User", "description": ""}, batched)
+        self._apply_persona(session)
+
+        offline_report = char_mgr.process_offline_time()
+        if offline_report:
+            session.messages.append({"role": "system", "content": f"*[System: While the user was away, you {offline_report}]*"})
+
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get_session(self, session_id):
+        """Returns the session or raises KeyError."""
+        with self.lock:
+            return self.sessions[session_id]
+
+    def close_session(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session:
+            session.char_mgr.flush()
+            session.waifu.close()
+        return session is not None
+
+    # --- Chat ---
+
+    def chat(self, session_id, text, memory_k=3, **sampling):
+        """Streams the reply to a user message as (event, text) tuples from brain.StreamParser.
+
+        Stats, emotion and the message list are updated once the reply is complete;
+        the result is available as session.messages[-1].
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            yield from self.run_turn(session, text, memory_k=memory_k, **sampling)
+
+    def run_turn(self, session, text, memory_k=3, add_user_message=True, **sampling):
+        """chat() for a session the caller holds. Pass add_user_message=False if the
+        message that prompts the reply is already in session.messages."""
+        waifu, char_mgr = session.waifu, session.char_mgr
+        if add_user_message:
+            session.messages.append({"role": "user", "content": text})
+
+        # Refresh time, stats and location (cheap, the system prompt stays cached)
+        waifu.update_status(
+            stats=char_mgr.get_stats(),
+            location=char_mgr.get_location(),
+            current_time_str=f"{char_mgr.get_time()}:00"
+        )
+        # Recall older diary entries, dreams and sessions related to this turn
+        memories = []
+        if memory_k > 0 and char_mgr.memory_mgr:
+            memories = char_mgr.memory_mgr.search(char_mgr.current_character, text, k=memory_k)
+
+        if session.batched:
+            events = self._batched_events(waifu, text, memories, sampling)
+        else:
+            events = waifu.generate_response(text, memories=memories, events=True, **sampling)
+        thought = ""
+        for kind, chunk in events:
+            if kind == THOUGHT_TEXT:
+                thought += chunk
+            elif kind == THOUGHT_END:
+                session.current_emotion = emotion_from_thought(char_mgr.character_config, thought)
+            yield kind, chunk
+
+        _, _, mood = waifu.get_last_thought_and_response()
+        aff_delta, en_delta = waifu.analyze_sentiment(text)
+        char_mgr.update_stats(aff_delta, en_delta)
+        if mood and mood != "neutral":
+            session.current_emotion = mood
+        session.messages.append({"role": "assistant", "content": waifu.history[-1]["content"]})
+
+    def _batched_events(self, waifu, text, memories, sampling):
+        """Streams a reply from InferenceServer.chat (which records the turn) as parser events."""
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.inference_server.chat(waifu, text, memories=memories, **sampling):
+                    chunks.put(chunk)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(None)
+
+        asyncio.run_coroutine_threadsafe(pump(), self._server_loop)
+        parser = StreamParser()
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from parser.feed(chunk)
+        yield from parser.close()
+        waifu.last_parse = parser
+
+    def reply(self, session_id, text, memory_k=3, **sampling):
+        """Non-streaming chat(): returns the finished reply split into thought, speech and mood."""
+        for _ in self.chat(session_id, text, memory_k=memory_k, **sampling):
+            pass
+        session = self.get_session(session_id)
+        thought, speech, mood = session.waifu.get_last_thought_and_response()
+        return {"thought": thought, "speech": speech, "mood": mood, "emotion": session.current_emotion}
+
+    def describe_image(self, image_bytes):
+        """Captions an image. Returns the user message that shows it to the character."""
+        from PIL import Image
+        caption = self.vision_mgr.caption_image(Image.open(io.BytesIO(image_bytes)))
+        return f"[User showed an image: {caption}]"
+
+    def transcribe(self, audio_bytes):
+        return self.hearing_mgr.transcribe(io.BytesIO(audio_bytes))
+
+    def speak(self, text, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
+        """Returns MP3 bytes, or None."""
+        return self.voice_mgr.get_audio_bytes(text, voice=voice, pitch=pitch, rate=rate)
+
+    # --- Saving ---
+
+    def _snapshot_tags(self, session):
+        """Ties an AI state snapshot to the chat it was saved with, so a later save without one makes it stale."""
+        transcript = json.dumps(session.messages, sort_keys=True, ensure_ascii=False)
+        return {"messages": hashlib.sha1(transcript.encode("utf-8")).hexdigest()}
+
+    def save_session(self, session_id, session_name=None, save_state=False):
+        session = self.get_session(session_id)
+        with session.lock:
+            return self.save(session, session_name, save_state)
+
+    def load_session(self, session_id, session_name):
+        session = self.get_session(session_id)
+        with session.lock:
+            self.load(session, session_name)
+        return session
+
+    def save(self, session, session_name=None, save_state=False):
+        """Saves the chat, and with save_state the model's context for an instant resume. Returns the file name."""
+        filename = session.char_mgr.save_session(session.messages, session_name, session.user_persona)
+        if save_state and filename:
+            state_path = session.char_mgr.get_session_state_path(filename)
+            if session.waifu.save_state_snapshot(state_path, max_bytes=STATE_SNAPSHOT_MAX_BYTES, tags=self._snapshot_tags(session)):
+                session.char_mgr.prune_session_states(keep=state_path)
+        return filename
+
+    def load(self, session, session_name):
+        """Replaces the session's chat with a saved one. Raises FileNotFoundError for unknown names."""
+        messages, user_persona = session.char_mgr.load_session(session_name)
+        session.messages = messages
+        session.user_persona = user_persona
+        session.waifu.history = list(messages)
+        self._apply_persona(session)
+
+        # Resume from the saved AI state so the next reply skips re-reading the transcript;
+        # it brings back the history as the model saw it, context blocks included
+        state_path = session.char_mgr.get_session_state_path(session_name)
+        if state_path and os.path.exists(state_path):
+            session.waifu.load_state_snapshot(state_path, tags=self._snapshot_tags(session))
+        return session
@@ -0,0 +1,121 @@
+import time
+import base64
+import streamlit as st
+from brain import parse_message
+
+# Messages drawn per page of chat history
+HISTORY_PAGE_SIZE = 20
+
+def rerun_view():
+    """Reruns only the fragment this is called from, or the whole app outside of one."""
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
+        st.rerun()
+
+def record_render(kind, started, keep=50):
+    """Stores how long a render took (ms) for the Brain Scan panel."""
+    times = st.session_state.setdefault("render_times", {})
+    samples = times.setdefault(kind, [])
+    samples.append((time.perf_counter() - started) * 1000)
+    del samples[:-keep]
+
+def reset_history_view():
+    """Back to the newest page with all voice players closed, for a new or loaded chat."""
+    st.session_state.history_pages = 1
+    st.session_state.audio_open = set()
+
+def render_audio(i, message, open_by_default=False):
+    """Shows the voice of a message. Only opened players load and send the audio."""
+    opened = st.session_state.setdefault("audio_open", set())
+    if not open_by_default and i not in opened:
+        if st.button("🔊", key=f"play_{i}", help="Play Voice"):
+            opened.add(i)
+            rerun_view()
+        return
+        
+    if "audio_ref" in message:
+        # Raw MP3 from the character's audio store, read only now
+        audio_bytes = st.session_state.char_mgr.audio_store().get(message["audio_ref"])
+        if audio_bytes:
+            st.audio(audio_bytes, format="audio/mp3")
+        else:
+            st.caption("🔇 Voice clip was cleaned up.")
+        return
+        
+    # Older messages carry the audio inline as base64
+    try:
+        audio_bytes = base64.b64decode(message["audio"])
+        st.audio(audio_bytes, format="audio/mp3")
+    except Exception:
+        # Fallback if it was somehow stored raw or corrupted
+        pass
+
+def render_message(i, message):
+    """Draws one chat message with its edit / regenerate tools."""
+    with st.chat_message(message["role"]):
+        if st.session_state.editing_msg and st.session_state.editing_msg["index"] == i:
+            # Edit Mode
+            new_content = st.text_area("Edit Message", value=st.session_state.editing_msg["content"], key=f"edit_area_{i}")
+            col_save, col_cancel = st.columns([1, 1])
+            if col_save.button("Save", key=f"save_{i}"):
+                st.session_state.messages[i]["content"] = new_content
+                # If it was an AI message, we might want to strip thoughts if editing speech only?
+                # For simplicity, we overwrite the whole content.
+                st.session_state.waifu.edit_message(i, new_content)
+                st.session_state.editing_msg = None
+                rerun_view()
+            if col_cancel.button("Cancel", key=f"cancel_{i}"):
+                st.session_state.editing_msg = None
+                rerun_view()
+        else:
+            # View Mode
+            if message["role"] == "assistant":
+                # Same parser as the stream, so the bubble shows what was shown while generating
+                thought, speech, _ = parse_message(message["content"])
+
+                if thought:
+                    with st.expander("💭 Inner Thoughts"):
+                        st.markdown(f"*{thought}*")
+                st.markdown(speech)
+
+                # Audio Playback (if saved in session state or just generated)
+                if "audio_ref" in message or "audio" in message:
+                    render_audio(i, message, open_by_default=i == len(st.session_state.messages) - 1)
+
+                # Edit / Regenerate Tools
+                col_tools1, col_tools2, col_tools3 = st.columns([1, 1, 8])
+                with col_tools1:
+                    if i == len(st.session_state.messages) - 1: # Only last message
+                        if st.button("🔄", key=f"regen_{i}", help="Regenerate Last Response"):
+                            st.session_state.messages.pop()
+                            st.session_state.waifu.regenerate_last()
+                            st.session_state.should_regenerate = True
+                            rerun_view()
+                with col_tools2:
+                     if st.button("✏️", key=f"edit_btn_{i}", help="Edit Message"):
+                         st.session_state.editing_msg = {"index": i, "content": message["content"]}
+                         rerun_view()
+
+            else:
+                # User Message
+                st.markdown(message["content"])
+                col_user_edit, _ = st.columns([1, 9])
+                with col_user_edit:
+                     if st.button("✏️", key=f"edit_user_{i}", help="Edit Message"):
+                         st.session_state.editing_msg = {"index": i, "content": message["content"]}
+                         rerun_view()
+
+def render_history(messages, page_size=HISTORY_PAGE_SIZE):
+    """Draws the last page_size messages, plus as many older pages as were asked for.
+
+    Keeps the number of widgets per run bounded however long the session gets.
+    """
+    pages = st.session_state.setdefault("history_pages", 1)
+    start = max(len(messages) - pages * page_size, 0)
+    if start > 0:
+        if st.button(f"⬆️ Show older messages ({start} hidden)", key="history_older"):
+            st.session_state.history_pages = pages + 1
+            rerun_view()
+    for i in range(start, len(messages)):
+        render_message(i, messages[i])
@@ -0,0 +1,87 @@
+import os
+import copy
+import json
+import atexit
+import threading
+
+FLUSH_INTERVAL = 2.0 # Seconds a changed config may wait before it is written
+
+def write_json_atomic(path, data, indent=4):
+    """Writes JSON to a temp file next to path and renames it over, so a crash never leaves half a file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class ConfigStore:
+    """Write-behind store for character configs.
+
+    Mutations only mark a config dirty; everything changed within flush_interval is
+    written once by a timer, on flush() (session switch) and at interpreter exit.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.dirty = {} # path -> copy of the config as it was when last marked
+        self.lock = threading.RLock()
+        self.timer = None
+        self.stats = {"marked": 0, "writes": 0}
+        atexit.register(self.flush)
+
+    def mark_dirty(self, path, data):
+        with self.lock:
+            # A snapshot, so the timer thread never serializes a dict the caller is still changing
+            self.dirty[path] = copy.deepcopy(data)
+            self.stats["marked"] += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def write_now(self, path, data):
+        """Writes immediately, replacing whatever was pending for path."""
+        with self.lock:
+            self.dirty.pop(path, None)
+            self._write(path, data)
+
+    def flush(self, path=None):
+        """Writes pending configs, all of them or only path's."""
+        with self.lock:
+            paths = [path] if path else list(self.dirty)
+            for p in paths:
+                data = self.dirty.pop(p, None)
+                if data is None:
+                    continue
+                try:
+                    self._write(p, data)
+                except Exception as e:
+                    # Keep it dirty, the next flush tries again
+                    print(f"Error saving config {p}: {e}")
+                    self.dirty.setdefault(p, data)
+
+    def _on_timer(self):
+        with self.lock:
+            self.timer = None
+            self.flush()
+            if self.dirty and self.timer is None:
+                # Something failed to write, retry later
+                self.timer = threading.Timer(self.flush_interval, self._on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _write(self, path, data):
+        write_json_atomic(path, data)
+        self.stats["writes"] += 1
+
+_default_store = None
+_default_lock = threading.Lock()
+
+def get_config_store():
+    """The process-wide store, so every CharacterManager coalesces into the same writes."""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = ConfigStore()
+        return _default_store
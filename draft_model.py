@@ -0,0 +1,96 @@
+import os
+import numpy as np
+
+# Small model with the Llama 3 tokenizer, used to draft tokens for the main model
+DRAFT_MODEL_PATH = "./models/Llama-3.2-1B-Instruct-Q4_K_M.gguf"
+
+DRAFT_MODES = ["off", "prompt_lookup", "draft_model"]
+
+class GGUFDraftModel:
+    """Drafts tokens greedily with a small GGUF model sharing the main model's vocabulary.
+
+    Works as a llama-cpp-python draft model: it is called with the tokens evaluated so
+    far and returns the tokens it expects next. Its own context keeps the common prefix
+    between calls, so only the newly accepted tokens are evaluated each time.
+    """
+
+    def __init__(self, model_path=DRAFT_MODEL_PATH, num_pred_tokens=4, context_size=8192, n_gpu_layers=0):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Draft model not found at {model_path}.")
+
+        from llama_cpp import Llama
+        print(f"Loading draft model from {model_path}...")
+        self.llm = Llama(model_path=model_path, n_ctx=context_size, n_gpu_layers=n_gpu_layers, verbose=False)
+        self.model_path = model_path
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        llm = self.llm
+        tokens = input_ids.tolist()
+        if not tokens or len(tokens) + self.num_pred_tokens > llm.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Roll back to the common prefix, rejected drafts from last time fall off here
+        # (_input_ids holds the evaluated tokens; input_ids is the whole n_ctx buffer)
+        n = 0
+        for a, b in zip(llm._input_ids.tolist(), tokens):
+            if a != b:
+                break
+            n += 1
+        n = min(n, len(tokens) - 1)
+        llm.n_tokens = n
+        llm.eval(tokens[n:])
+
+        draft = []
+        eos = llm.token_eos()
+        n_vocab = llm.n_vocab()
+        for _ in range(self.num_pred_tokens):
+            # Without logits_all, llm.scores isn't filled in; the context still holds
+            # the logits of the last evaluated token
+            logits = np.ctypeslib.as_array(llm._ctx.get_logits(), shape=(n_vocab,))
+            token = int(np.argmax(logits))
+            if token == eos:
+                break
+            draft.append(token)
+            llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+class DraftStats:
+    """Wraps a draft model and counts what it proposes.
+
+    Every call is one verification step of the main model, which keeps the accepted
+    drafts plus one token of its own. So the accepted count is the generated tokens
+    minus the steps.
+    """
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.draft(input_ids, **kwargs)
+        self.calls += 1
+        self.proposed += len(draft)
+        return draft
+
+    def summary(self, generated_tokens):
+        accepted = max(min(generated_tokens - self.calls, self.proposed), 0)
+        return {
+            "drafted": self.proposed,
+            "accepted": accepted,
+            "acceptance_rate": accepted / self.proposed if self.proposed else 0.0
+        }
+
+def make_draft_model(mode, num_pred_tokens=10, draft_model_path=DRAFT_MODEL_PATH, context_size=8192):
+    """Creates the drafter for a mode from DRAFT_MODES, or None for "off"."""
+    if mode == "prompt_lookup":
+        # Copies n-gram continuations from the prompt, roleplay repeats names and phrases a lot
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+        return DraftStats(LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens))
+    if mode == "draft_model":
+        return DraftStats(GGUFDraftModel(draft_model_path, num_pred_tokens=num_pred_tokens, context_size=context_size))
+    return None
@@ -0,0 +1,163 @@
+import os
+import json
+import array
+import hashlib
+import threading
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(path), threading.RLock())
+
+class EntryLog:
+    """Append-only JSON Lines file with an offset index next to it.
+
+    <path> holds one JSON value per line; <path>.idx holds the byte offset of every
+    line as uint64. Appending writes only the new lines, and tail() seeks straight to
+    the last entries. The index is checked against the log before use and rebuilt if
+    a crash left them out of step. rewrite() replaces everything at once, for edits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.lock = _lock_for(path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def count(self):
+        with self.lock:
+            return self._checked_count()
+
+    def append(self, entries):
+        """Appends one line per entry and returns how many entries the log has now."""
+        lines = [self._encode(entry) for entry in entries]
+        with self.lock:
+            count = self._checked_count()
+            self._append_lines(lines)
+            return count + len(lines)
+
+    def tail(self, limit):
+        """Returns the last `limit` entries, oldest first, reading only those lines."""
+        with self.lock:
+            count = self._checked_count()
+            if limit <= 0 or count == 0:
+                return []
+            start = self._offset_at(max(count - limit, 0))
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                data = f.read()
+        return [json.loads(line) for line in data.splitlines()]
+
+    def read_all(self):
+        with self.lock:
+            if not self._checked_count():
+                return []
+            with open(self.path, "rb") as f:
+                data = f.read()
+        return [json.loads(line) for line in data.splitlines()]
+
+    def rewrite(self, entries):
+        """Replaces the whole log (compaction), atomically for both the log and its index."""
+        lines = [self._encode(entry) for entry in entries]
+        with self.lock:
+            self._rewrite_lines(lines)
+
+    def sync(self, entries, previous=None):
+        """Makes the log hold exactly `entries` and returns digests to pass as `previous` next time.
+
+        When the previous sync's entries are an unchanged prefix of these, only the
+        new ones are appended; any edit in between rewrites the log.
+        """
+        lines = [self._encode(entry) for entry in entries]
+        digests = [hashlib.blake2b(line, digest_size=8).digest() for line in lines]
+        with self.lock:
+            n = len(previous) if previous else 0
+            if n and digests[:n] == previous and self._checked_count() == n:
+                self._append_lines(lines[n:])
+            else:
+                self._rewrite_lines(lines)
+        return digests
+
+    def _append_lines(self, lines):
+        if not lines:
+            return
+        with open(self.path, "ab") as f:
+            start = f.seek(0, os.SEEK_END)
+            offsets = array.array("Q")
+            for line in lines:
+                offsets.append(start)
+                start += len(line)
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, "ab") as f:
+            f.write(offsets.tobytes())
+
+    def _rewrite_lines(self, lines):
+        offsets = array.array("Q")
+        position = 0
+        for line in lines:
+            offsets.append(position)
+            position += len(line)
+
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path + ".tmp", "wb") as f:
+            f.write(offsets.tobytes())
+        # Drop the index first: a crash in between leaves a log whose index gets rebuilt
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.replace(self.path + ".tmp", self.path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _encode(self, entry):
+        return (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _offset_at(self, i):
+        with open(self.index_path, "rb") as f:
+            f.seek(i * 8)
+            return array.array("Q", f.read(8))[0]
+
+    def _checked_count(self):
+        """Number of entries, after making sure the index describes the log exactly."""
+        if not os.path.exists(self.path):
+            return 0
+
+        size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            index_size = os.path.getsize(self.index_path)
+            count = index_size // 8
+            if index_size % 8 == 0:
+                if count == 0 and size == 0:
+                    return 0
+                if count:
+                    last_offset = self._offset_at(count - 1)
+                    if last_offset < size:
+                        with open(self.path, "rb") as f:
+                            f.seek(last_offset)
+                            last = f.readline()
+                        if last_offset + len(last) == size and last.endswith(b"\n"):
+                            return count
+
+        return self._rebuild_index()
+
+    def _rebuild_index(self):
+        offsets = array.array("Q")
+        position = 0
+        with open(self.path, "rb+") as f:
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # Torn last write, drop it
+                    f.truncate(position)
+                    break
+                offsets.append(position)
+                position += len(line)
+        with open(self.index_path, "wb") as f:
+            f.write(offsets.tobytes())
+        return len(offsets)
@@ -0,0 +1,393 @@
+import time
+import codecs
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from brain import STOP_STRINGS, _partial_suffix
+
+# Tokens the repetition penalty looks back over, prompt included (llama-cpp-python's last_n_tokens_size)
+REPEAT_LAST_N = 64
+
+class LlamaBatchBackend:
+    """A second llama.cpp context on an already loaded model, with one sequence per slot.
+
+    The weights are shared with the Llama object (which WaifuAI keeps using for
+    tokenizing), only the KV cache is new: n_slots * slot_ctx tokens. decode() runs
+    one llama_decode over tokens from any number of sequences.
+    """
+
+    def __init__(self, llm, n_slots=4, slot_ctx=4096, n_batch=512, n_threads=None):
+        import llama_cpp
+        self.lib = llama_cpp
+        self.llm = llm
+        self.n_slots = n_slots
+        self.slot_ctx = slot_ctx
+        self.n_batch = n_batch
+        self.n_vocab = llm.n_vocab()
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_slots * slot_ctx
+        params.n_batch = n_batch
+        params.n_seq_max = n_slots
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads
+        new_context = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+        self.ctx = new_context(llm._model.model, params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create the batched llama.cpp context.")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_slots)
+
+        # The KV cache API was renamed across llama.cpp versions
+        self._seq_rm = getattr(llama_cpp, "llama_kv_self_seq_rm", None) or llama_cpp.llama_kv_cache_seq_rm
+
+        self.stop_tokens = {llm.token_eos()}
+        eot = llm.tokenize(b"<|eot_id|>", add_bos=False, special=True)
+        if len(eot) == 1:
+            self.stop_tokens.add(eot[0])
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def detokenize(self, token):
+        return self.llm.detokenize([token])
+
+    def clear(self, seq_id, start=0):
+        """Drops the cached tokens of a sequence from position start on."""
+        self._seq_rm(self.ctx, seq_id, start, -1)
+
+    def decode(self, entries):
+        """Evaluates [(seq_id, tokens, start_pos, want_logits)] in one batch.
+
+        Returns the logits of the last token of every entry that asked for them.
+        """
+        batch = self.batch
+        n = 0
+        rows = []
+        for seq_id, tokens, start, want_logits in entries:
+            for i, token in enumerate(tokens):
+                batch.token[n] = token
+                batch.pos[n] = start + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = seq_id
+                batch.logits[n] = want_logits and i == len(tokens) - 1
+                n += 1
+            rows.append(n - 1 if want_logits else None)
+        batch.n_tokens = n
+
+        result = self.lib.llama_decode(self.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed ({result})")
+
+        logits = []
+        for row in rows:
+            if row is None:
+                logits.append(None)
+            else:
+                ptr = self.lib.llama_get_logits_ith(self.ctx, row)
+                logits.append(np.ctypeslib.as_array(ptr, shape=(self.n_vocab,)).copy())
+        return logits
+
+    def close(self):
+        if self.ctx:
+            self.lib.llama_batch_free(self.batch)
+            self.lib.llama_free(self.ctx)
+            self.ctx = None
+
+def sample_token(logits, last_tokens, rng, temperature=0.9, top_p=0.95, min_p=0.05, repetition_penalty=1.1, top_k=40):
+    """Picks the next token from raw logits like llama-cpp-python's sampler chain.
+
+    last_tokens are the last REPEAT_LAST_N tokens of the sequence, prompt and reply alike.
+    Then, in llama.cpp's order: top-k, top-p and min-p on the untempered
+    distribution, temperature, and a draw.
+    """
+    logits = logits.astype(np.float64)
+    if repetition_penalty != 1.0 and len(last_tokens):
+        ids = np.unique(last_tokens)
+        values = logits[ids]
+        logits[ids] = np.where(values > 0, values / repetition_penalty, values * repetition_penalty)
+    if temperature <= 0:
+        return int(np.argmax(logits))
+
+    if 0 < top_k < len(logits):
+        candidates = np.argpartition(-logits, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(logits))
+    candidates = candidates[np.argsort(-logits[candidates])]
+    candidate_logits = logits[candidates]
+
+    probs = np.exp(candidate_logits - candidate_logits[0])
+    probs /= probs.sum()
+    keep = np.ones(len(candidates), dtype=bool)
+    if top_p < 1.0:
+        # Smallest prefix whose probability reaches top_p
+        keep &= np.concatenate(([True], np.cumsum(probs)[:-1] < top_p))
+    if min_p > 0.0:
+        keep &= probs >= min_p * probs[0]
+    candidates, candidate_logits = candidates[keep], candidate_logits[keep]
+
+    probs = np.exp((candidate_logits - candidate_logits[0]) / temperature)
+    return int(rng.choice(candidates, p=probs / probs.sum()))
+
+class GenerationRequest:
+    """One streamed completion: its sampling settings, output queue and timings."""
+
+    def __init__(self, prompt_tokens, max_tokens, sampling, stop_strings, seed=None):
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.sampling = sampling
+        self.stop_strings = stop_strings
+        self.rng = np.random.default_rng(seed)
+        self.queue = asyncio.Queue()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.generated = []
+        self.text = ""
+        self.sent = 0
+        self.cancelled = False
+        self.finish_reason = None
+        self.submitted = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+
+class Slot:
+    def __init__(self, seq_id):
+        self.seq_id = seq_id
+        self.cached = []   # tokens in this sequence's KV cache
+        self.pending = []  # tokens still to evaluate
+        self.request = None
+
+class InferenceServer:
+    """Serves many concurrent chats from one model with continuous batching.
+
+    Every scheduler step builds a single batch with the next token of each generating
+    request plus prompt chunks of newly admitted ones, so requests join and leave the
+    batch between steps instead of waiting for each other. Each request gets a slot
+    (a llama.cpp sequence); finished slots keep their tokens, and a new request goes
+    to the free slot sharing the longest prefix, so a session's next turn only
+    evaluates what is new.
+    """
+
+    def __init__(self, backend, max_batch_tokens=None):
+        self.backend = backend
+        self.max_batch_tokens = max_batch_tokens or backend.n_batch
+        self.slots = [Slot(i) for i in range(backend.n_slots)]
+        self.waiting = []
+        self.stats = {"steps": 0, "batched_tokens": 0, "generated_tokens": 0, "requests": 0}
+        self._wakeup = None
+        self._task = None
+        # llama.cpp calls block, run them off the event loop on one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._session_locks = weakref.WeakKeyDictionary()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+    def submit(self, prompt_tokens, max_tokens=512, stop_strings=STOP_STRINGS, seed=None, **sampling):
+        """Queues a completion. Read the returned request with stream()."""
+        request = GenerationRequest(prompt_tokens, max_tokens, sampling, stop_strings, seed)
+        self.waiting.append(request)
+        self.stats["requests"] += 1
+        self._wakeup.set()
+        return request
+
+    async def stream(self, request):
+        """Yields the text chunks of a submitted request as they are generated."""
+        try:
+            while True:
+                chunk = await request.queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            if request.finish_reason is None:
+                request.cancelled = True
+                self._wakeup.set()
+
+    async def generate(self, prompt_tokens, **kwargs):
+        request = self.submit(prompt_tokens, **kwargs)
+        async for chunk in self.stream(request):
+            yield chunk
+
+    async def chat(self, waifu, user_input, memories=None, **sampling):
+        """Streams WaifuAI's reply to a message and records the turn in its history.
+
+        The WaifuAI only builds the prompt and keeps the history; the batch backend
+        does the evaluation, so its own prefilling is turned off.
+        """
+        waifu.prefill_enabled = False
+        lock = self._session_locks.setdefault(waifu, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            prompt_tokens, turn = await loop.run_in_executor(None, waifu.prepare_turn, user_input, memories)
+            request = self.submit(prompt_tokens, max_tokens=waifu.max_response_tokens, **sampling)
+            async for chunk in self.stream(request):
+                yield chunk
+            waifu.record_turn(turn, request.text)
+
+    def _admit(self):
+        """Moves waiting requests into free slots, preferring the slot with the longest cached prefix."""
+        while self.waiting:
+            free = [slot for slot in self.slots if slot.request is None]
+            if not free:
+                return
+            request = self.waiting.pop(0)
+            if request.cancelled:
+                continue
+            if len(request.prompt_tokens) + 1 >= self.backend.slot_ctx:
+                self._finish(request, RuntimeError("Prompt does not fit the slot context."))
+                continue
+
+            prompt = request.prompt_tokens
+            best, best_common = free[0], -1
+            for slot in free:
+                common = 0
+                for a, b in zip(slot.cached, prompt):
+                    if a != b:
+                        break
+                    common += 1
+                if common > best_common:
+                    best, best_common = slot, common
+            # The last prompt token is always evaluated again to get its logits
+            common = min(best_common, len(prompt) - 1)
+            if common < len(best.cached):
+                self.backend.clear(best.seq_id, common)
+            best.cached = prompt[:common]
+            best.pending = prompt[common:]
+            best.request = request
+
+    def _plan(self):
+        """Picks this step's tokens: one per generating slot, then prompt chunks in the room left."""
+        budget = self.max_batch_tokens
+        entries = []
+        for slot in self.slots:
+            if slot.request and slot.request.generated and slot.pending:
+                entries.append((slot, slot.pending[:1]))
+                budget -= 1
+        for slot in self.slots:
+            if budget <= 0:
+                break
+            if slot.request and not slot.request.generated and slot.pending:
+                chunk = slot.pending[:budget]
+                entries.append((slot, chunk))
+                budget -= len(chunk)
+        return entries
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for slot in self.slots:
+                if slot.request and slot.request.cancelled:
+                    self._release(slot)
+            self._admit()
+
+            entries = self._plan()
+            if not entries:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            batch = [(slot.seq_id, chunk, len(slot.cached), len(chunk) == len(slot.pending)) for slot, chunk in entries]
+            try:
+                logits = await loop.run_in_executor(self._executor, self.backend.decode, batch)
+            except Exception as e:
+                print(f"Batch decode error: {e}")
+                for slot, _ in entries:
+                    self.backend.clear(slot.seq_id, 0)
+                    slot.cached = []
+                    self._finish(slot.request, e)
+                    self._release(slot)
+                continue
+
+            self.stats["steps"] += 1
+            self.stats["batched_tokens"] += sum(len(chunk) for _, chunk in entries)
+            for (slot, chunk), row in zip(entries, logits):
+                slot.cached.extend(chunk)
+                slot.pending = slot.pending[len(chunk):]
+                if row is not None:
+                    self._sample(slot, row)
+
+    def _sample(self, slot, logits):
+        request = slot.request
+        # The slot's cache holds the prompt and everything generated so far
+        token = sample_token(logits, slot.cached[-REPEAT_LAST_N:], request.rng, **request.sampling)
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+        self.stats["generated_tokens"] += 1
+
+        if token in self.backend.stop_tokens:
+            return self._complete(slot, "stop")
+        request.generated.append(token)
+        request.text += request.decoder.decode(self.backend.detokenize(token))
+
+        # Cut at a stop string, and hold back text that may turn into one
+        for stop in request.stop_strings:
+            index = request.text.find(stop, max(request.sent - len(stop), 0))
+            if index >= 0:
+                request.text = request.text[:index]
+                return self._complete(slot, "stop")
+        hold = max((_partial_suffix(request.text, stop) for stop in request.stop_strings), default=0)
+        if len(request.text) - hold > request.sent:
+            request.queue.put_nowait(request.text[request.sent:len(request.text) - hold])
+            request.sent = len(request.text) - hold
+
+        if len(request.generated) >= request.max_tokens:
+            return self._complete(slot, "length")
+        if len(slot.cached) + 1 >= self.backend.slot_ctx:
+            return self._complete(slot, "length")
+        slot.pending = [token]
+
+    def _complete(self, slot, reason):
+        request = slot.request
+        if len(request.text) > request.sent:
+            request.queue.put_nowait(request.text[request.sent:])
+            request.sent = len(request.text)
+        request.finish_reason = reason
+        self._finish(request)
+        self._release(slot)
+
+    def _finish(self, request, error=None):
+        request.finished = time.perf_counter()
+        if request.finish_reason is None:
+            request.finish_reason = "error" if error else "cancelled"
+        if error:
+            request.queue.put_nowait(error)
+        request.queue.put_nowait(None)
+
+    def _release(self, slot):
+        if slot.request and slot.request.finished is None:
+            self._finish(slot.request)
+        slot.request = None
+        slot.pending = []
+
+    def report(self):
+        steps = self.stats["steps"]
+        return dict(
+            self.stats,
+            active=sum(1 for slot in self.slots if slot.request),
+            waiting=len(self.waiting),
+            avg_batch_tokens=self.stats["batched_tokens"] / steps if steps else 0.0
+        )
+
+def create_server(pool, model_path, n_slots=4, slot_ctx=4096, n_gpu_layers=-1):
+    """Loads (or reuses) a model from the pool and puts a batched context on top of it.
+
+    WaifuAI sessions for this server should be created with the same pool, model_path
+    and context_size=slot_ctx, so they share the Llama used here for tokenizing.
+    """
+    entry = pool.acquire(model_path, n_ctx=slot_ctx, n_gpu_layers=n_gpu_layers, logits_all=False)
+    return InferenceServer(LlamaBatchBackend(entry.llm, n_slots=n_slots, slot_ctx=slot_ctx))
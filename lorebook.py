@@ -0,0 +1,234 @@
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+def lore_patterns(keyword, entry=None):
+    """Returns the lowercase patterns that trigger a lorebook entry.
+
+    A keyword can list aliases separated by commas ("Excalibur, holy sword"), and an
+    entry stored as a dict can add more under "aliases".
+    """
+    names = keyword.split(",")
+    if isinstance(entry, dict):
+        names += entry.get("aliases", [])
+    patterns = []
+    for name in names:
+        name = name.strip().lower()
+        if name and name not in patterns:
+            patterns.append(name)
+    return patterns
+
+class LoreMatcher:
+    """Aho-Corasick automaton over all lorebook keywords and aliases.
+
+    scan() finds every entry mentioned in a text in one pass, no matter how many
+    keywords there are. Keywords only match whole words, so "cat" does not fire on
+    "category". Entries can be added and removed without rebuilding the trie; only
+    the failure links are recomputed, lazily, before the next scan.
+    """
+
+    def __init__(self, lorebook=None):
+        self.goto = [{}]       # node -> {char: node}
+        self.fail = [0]
+        self.out_link = [0]    # node -> nearest suffix node that ends a pattern
+        self.depth = [0]
+        self.out = [set()]     # node -> entry keywords whose pattern ends here
+        self.entries = {}      # entry keyword -> its patterns
+        self._dirty = False
+        self._dead_patterns = 0
+
+        for keyword, entry in (lorebook or {}).items():
+            self.add(keyword, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _insert(self, pattern):
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out_link.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.out.append(set())
+            node = nxt
+        return node
+
+    def _find(self, pattern):
+        node = 0
+        for ch in pattern:
+            node = self.goto[node].get(ch)
+            if node is None:
+                return None
+        return node
+
+    def add(self, keyword, entry=None):
+        """Adds or updates the patterns of a lorebook entry."""
+        if keyword in self.entries:
+            self.remove(keyword)
+
+        patterns = lore_patterns(keyword, entry)
+        for pattern in patterns:
+            self.out[self._insert(pattern)].add(keyword)
+        self.entries[keyword] = patterns
+        self._dirty = True
+
+    def remove(self, keyword):
+        """Removes an entry. Its trie nodes stay until enough dead ones pile up."""
+        patterns = self.entries.pop(keyword, None)
+        if patterns is None:
+            return False
+
+        for pattern in patterns:
+            node = self._find(pattern)
+            if node is not None:
+                self.out[node].discard(keyword)
+                if not self.out[node]:
+                    self._dead_patterns += 1
+        self._dirty = True
+
+        # Compact once most of the trie belongs to deleted keywords
+        if self._dead_patterns > max(64, len(self.entries)):
+            self._rebuild()
+        return True
+
+    def _rebuild(self):
+        entries = self.entries
+        self.__init__()
+        for keyword, patterns in entries.items():
+            for pattern in patterns:
+                self.out[self._insert(pattern)].add(keyword)
+        self.entries = entries
+        self._dirty = True
+
+    def _build_links(self):
+        """Computes failure and output links breadth-first."""
+        queue = []
+        for node in self.goto[0].values():
+            self.fail[node] = 0
+            self.out_link[node] = 0
+            queue.append(node)
+
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[child] = f
+                self.out_link[child] = f if self.out[f] else self.out_link[f]
+                queue.append(child)
+        self._dirty = False
+
+    def scan(self, text):
+        """Returns the keywords of all entries mentioned in text, in order of first mention."""
+        if not self.entries:
+            return []
+        if self._dirty:
+            self._build_links()
+
+        text = text.lower()
+        n = len(text)
+        goto, fail, out, out_link, depth = self.goto, self.fail, self.out, self.out_link, self.depth
+        found = {}
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+
+            hit = node if out[node] else out_link[node]
+            while hit:
+                start = i - depth[hit] + 1
+                # Whole words only (a pattern edge that is punctuation needs no boundary)
+                if (start == 0 or not _is_word_char(text[start - 1]) or not _is_word_char(text[start])) and \
+                   (i + 1 == n or not _is_word_char(text[i + 1]) or not _is_word_char(text[i])):
+                    for keyword in out[hit]:
+                        if keyword not in found:
+                            found[keyword] = start
+                hit = out_link[hit]
+
+        return sorted(found, key=found.get)
+
+def lore_content(entry):
+    """Text of a lorebook entry, which is either a plain string or a dict."""
+    if isinstance(entry, dict):
+        return entry.get("content", "")
+    return entry or ""
+
+def lore_priority(entry):
+    if isinstance(entry, dict):
+        try:
+            return int(entry.get("priority", 0))
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+class LoreInjector:
+    """Picks which matched lorebook entries go into the prompt.
+
+    Matches are ranked by priority, then by how recently they were mentioned, and
+    added until the token budget is used up. Injected entries are scanned again for
+    further keywords up to recursion_depth, and entries the model already saw in the
+    last dedup_turns turns are skipped.
+    """
+
+    def __init__(self, token_budget=800, recursion_depth=1, dedup_turns=4):
+        self.token_budget = token_budget
+        self.recursion_depth = recursion_depth
+        self.dedup_turns = dedup_turns
+        self._token_counts = {}
+
+    def _count(self, text, count_tokens):
+        count = self._token_counts.get(text)
+        if count is None:
+            if len(self._token_counts) > 4096:
+                self._token_counts = {}
+            count = count_tokens(text)
+            self._token_counts[text] = count
+        return count
+
+    def select(self, matcher, lorebook, scan_texts, count_tokens, recent_keys=()):
+        """Returns (keywords, lines, tokens used) for the entries to inject.
+
+        scan_texts are ordered from most to least recent.
+        """
+        frontier = []
+        for text in scan_texts:
+            for keyword in matcher.scan(text):
+                if keyword not in frontier:
+                    frontier.append(keyword)
+
+        seen = set(recent_keys)
+        keywords, lines = [], []
+        used = 0
+        for depth in range(self.recursion_depth + 1):
+            # Stable sort keeps recency order among equal priorities
+            frontier.sort(key=lambda k: -lore_priority(lorebook.get(k)))
+            found = []
+            for keyword in frontier:
+                if keyword in seen or keyword not in lorebook:
+                    continue
+                seen.add(keyword)
+
+                content = lore_content(lorebook[keyword])
+                if not content:
+                    continue
+                line = f"{keyword}: {content}"
+                cost = self._count(line, count_tokens)
+                if used + cost > self.token_budget:
+                    continue # A smaller entry may still fit
+                keywords.append(keyword)
+                lines.append(line)
+                used += cost
+
+                if depth < self.recursion_depth:
+                    found += [k for k in matcher.scan(content) if k not in seen and k not in found]
+            if not found:
+                break
+            frontier = found
+
+        return keywords, lines, used
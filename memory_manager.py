@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import zlib
+import threading
+import numpy as np
+
+CHARACTERS_DIR = "./characters"
+
+# Optional GGUF embedding model (e.g. nomic-embed-text). Without it a hashed
+# bag-of-words embedding is used, which needs no model at all but only matches
+# memories that share words with the query (no synonyms or paraphrases).
+EMBED_MODEL_PATH = "./models/nomic-embed-text-v1.5.Q4_K_M.gguf"
+HASH_DIM = 512
+
+# One lock per memory folder, shared by every MemoryManager in the process (one per browser tab)
+_locks = {}
+_locks_guard = threading.Lock()
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(path), threading.RLock())
+
+def clean_message_text(content):
+    """Strips thoughts and the mood tag so only what was said gets remembered."""
+    if "</thought>" in content:
+        content = content.split("</thought>")[-1]
+    content = re.sub(r'\[Mood:[^\]]*\]', "", content, flags=re.IGNORECASE)
+    return content.strip()
+
+class MemoryManager:
+    """Long-term memory: embeds diary entries, dreams and past session turns per character.
+
+    Each character gets a memory/ folder with the vectors as one flat float32 file
+    and the matching texts as JSON Lines. New memories are appended to both, so the
+    index grows with every save and is never rebuilt. Writes go through a per-character
+    lock and re-read the count from meta.json, so several managers can share a folder.
+    """
+
+    def __init__(self, embed_model_path=EMBED_MODEL_PATH):
+        self.embed_model_path = embed_model_path
+        self.model = None
+        self.embedder = None
+        self.dim = None
+        self._indexes = {} # character -> (vectors, items)
+
+    def load_model(self):
+        """Lazy loads the embedding model, falling back to hashed embeddings."""
+        if self.embedder is not None:
+            return True
+
+        if os.path.exists(self.embed_model_path):
+            print(f"Loading Embedding Model ({os.path.basename(self.embed_model_path)}) on CPU...")
+            try:
+                from llama_cpp import Llama
+                self.model = Llama(model_path=self.embed_model_path, embedding=True, n_ctx=512, n_gpu_layers=0, verbose=False)
+                self.embedder = os.path.basename(self.embed_model_path)
+                self.dim = len(self.model.embed("dim"))
+                print("Embedding Model Loaded.")
+                return True
+            except Exception as e:
+                print(f"Error loading embedding model: {e}")
+                self.model = None
+
+        print(f"Embedding model unavailable ({self.embed_model_path}), using hashed keyword embeddings: memories are only recalled when they share words with the message.")
+        self.embedder = f"hash-{HASH_DIM}"
+        self.dim = HASH_DIM
+        return True
+
+    def _hash_embed(self, text):
+        vec = np.zeros(HASH_DIM, dtype=np.float32)
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vec[h % HASH_DIM] += 1.0 if h & 0x80000000 else -1.0
+        return vec
+
+    def embed(self, texts):
+        """Returns an (n, dim) array of L2-normalized embeddings."""
+        self.load_model()
+        if self.model is not None:
+            vectors = np.array([self.model.embed(t) for t in texts], dtype=np.float32)
+        else:
+            vectors = np.array([self._hash_embed(t) for t in texts], dtype=np.float32)
+        vectors = vectors.reshape(len(texts), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _memory_dir(self, character):
+        return os.path.join(CHARACTERS_DIR, character, "memory")
+
+    def _read_meta(self, character):
+        meta_path = os.path.join(self._memory_dir(character), "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_meta(self, character, meta):
+        meta_path = os.path.join(self._memory_dir(character), "meta.json")
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _open(self, character):
+        """Returns the character's meta, starting a fresh index if none exists or the embedder changed."""
+        self.load_model()
+        meta = self._read_meta(character)
+        if meta and meta.get("embedder") == self.embedder and meta.get("dim") == self.dim:
+            return meta
+
+        memory_dir = self._memory_dir(character)
+        if not os.path.exists(memory_dir):
+            os.makedirs(memory_dir)
+        for name in ("vectors.f32", "items.jsonl"):
+            path = os.path.join(memory_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        meta = {"embedder": self.embedder, "dim": self.dim, "count": 0, "sessions": {}}
+        self._write_meta(character, meta)
+        self._indexes.pop(character, None)
+        return meta
+
+    def indexed_sessions(self, character):
+        """Session name -> number of its messages already indexed."""
+        return dict(self._open(character)["sessions"])
+
+    def is_empty(self, character):
+        meta = self._read_meta(character)
+        self.load_model()
+        return not meta or meta.get("embedder") != self.embedder or meta.get("count", 0) == 0
+
+    def _load_index(self, character):
+        meta = self._open(character)
+        cached = self._indexes.get(character)
+        if cached is not None and len(cached[1]) == meta.get("count", 0):
+            return cached
+
+        # Not loaded yet, or another manager appended since
+        memory_dir = self._memory_dir(character)
+        vectors_path = os.path.join(memory_dir, "vectors.f32")
+        items_path = os.path.join(memory_dir, "items.jsonl")
+
+        vectors = np.zeros((0, self.dim), dtype=np.float32)
+        items = []
+        if os.path.exists(vectors_path) and os.path.exists(items_path):
+            vectors = np.fromfile(vectors_path, dtype=np.float32).reshape(-1, self.dim)
+            with open(items_path, "r", encoding="utf-8") as f:
+                items = [json.loads(line) for line in f if line.strip()]
+            # A crash between the two appends can leave one longer than the other
+            n = min(len(vectors), len(items), meta.get("count", 0))
+            vectors, items = vectors[:n], items[:n]
+
+        self._indexes[character] = (vectors, items)
+        return vectors, items
+
+    def add(self, character, items):
+        """Embeds and appends memories. Each item is a dict with at least "text"."""
+        items = [item for item in items if item.get("text", "").strip()]
+        if not items:
+            return 0
+
+        new_vectors = self.embed([item["text"] for item in items])
+
+        memory_dir = self._memory_dir(character)
+        with _lock_for(memory_dir):
+            # Picks up what other managers appended, so the count written back covers them
+            vectors, old_items = self._load_index(character)
+            meta = self._read_meta(character)
+
+            with open(os.path.join(memory_dir, "vectors.f32"), "ab") as f:
+                f.write(new_vectors.astype(np.float32).tobytes())
+            with open(os.path.join(memory_dir, "items.jsonl"), "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+            meta["count"] = len(old_items) + len(items)
+            self._write_meta(character, meta)
+            self._indexes[character] = (np.vstack([vectors, new_vectors]), old_items + items)
+        return len(items)
+
+    def add_entry(self, character, source, entry):
+        """Indexes a diary entry or dream ({"date", "content"})."""
+        return self.add(character, [{"source": source, "date": entry.get("date", ""), "text": entry["content"]}])
+
+    def add_session(self, character, session_name, history):
+        """Indexes the turns of a saved session that weren't indexed yet."""
+        with _lock_for(self._memory_dir(character)):
+            meta = self._open(character)
+            start = meta["sessions"].get(session_name, 0)
+            if start > len(history):
+                # The session was edited down, keep the old memories and continue from here
+                start = len(history)
+
+            items = []
+            for msg in history[start:]:
+                if msg.get("role") not in ("user", "assistant"):
+                    continue
+                text = clean_message_text(msg.get("content", ""))
+                if text:
+                    items.append({"source": f"session:{session_name}", "role": msg["role"], "text": text})
+
+            added = self.add(character, items)
+            meta = self._read_meta(character)
+            meta["sessions"][session_name] = len(history)
+            self._write_meta(character, meta)
+        return added
+
+    def search(self, character, query, k=5, min_score=0.2):
+        """Returns up to k memories most similar to the query, best first, with a "score"."""
+        if not query.strip():
+            return []
+        vectors, items = self._load_index(character)
+        if not items:
+            return []
+
+        scores = vectors @ self.embed([query])[0]
+        k = min(k, len(items))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(items[i], score=float(scores[i])) for i in top if scores[i] >= min_score]
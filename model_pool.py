@@ -0,0 +1,234 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+MODELS_DIR = "./models"
+
+# Helper models that are never offered as a chat model
+AUXILIARY_MODEL_HINTS = ("embed", "mmproj")
+
+def scan_models(models_dir=MODELS_DIR):
+    """Returns {file name: path} for the chat GGUF files in the models folder."""
+    models = {}
+    if not os.path.exists(models_dir):
+        return models
+    for name in sorted(os.listdir(models_dir)):
+        if name.lower().endswith(".gguf") and not any(hint in name.lower() for hint in AUXILIARY_MODEL_HINTS):
+            models[name] = os.path.join(models_dir, name)
+    return models
+
+def model_path_for(config, default_path):
+    """The model a character pins in its config ("model": file name in ./models), else the default."""
+    pinned = config.get("model")
+    if pinned:
+        models = scan_models()
+        if pinned in models:
+            return models[pinned]
+        print(f"Model {pinned} not found, using the default model.")
+    return default_path
+
+def _load_llama(model_path, **kwargs):
+    from llama_cpp import Llama
+    # Weights are memory mapped, so they live in the page cache once however many use them
+    kwargs.setdefault("use_mmap", True)
+    return Llama(model_path=model_path, verbose=False, **kwargs)
+
+class FairLock:
+    """Reentrant lock that is handed out in arrival order.
+
+    Sessions sharing a model queue up here for the llama.cpp context. Unlike RLock, a
+    session that keeps generating can't starve the others. Also records how long
+    callers waited.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._next_ticket = 0
+        self._serving = 0
+        self.waiting = 0
+        self.acquisitions = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self.waiting += 1
+            started = time.perf_counter()
+            while self._owner is not None or self._serving != ticket:
+                self._cond.wait()
+            waited = time.perf_counter() - started
+
+            self.waiting -= 1
+            self._owner = me
+            self._depth = 1
+            self.acquisitions += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("release of a FairLock not held by this thread")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._serving += 1
+                self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+class PooledModel:
+    """A loaded model plus what the pool needs to know about it."""
+
+    def __init__(self, key, llm, footprint, load_seconds, max_states=4):
+        self.key = key
+        self.llm = llm
+        self.footprint = footprint
+        self.load_seconds = load_seconds
+        self.users = 0
+        # Shared by every WaifuAI using this model, the llama.cpp context isn't thread safe
+        self.lock = FairLock()
+        # Prefilled prompt states, shared too so sessions with the same persona reuse them
+        # and their memory doesn't grow with the number of sessions
+        self.states = OrderedDict()
+        self.max_states = max_states
+        # Set once llm is loaded (or failed to load), others asking for it meanwhile wait here
+        self.ready = threading.Event()
+        if llm is not None:
+            self.ready.set()
+
+class ModelPool:
+    """Loads GGUF models on demand and keeps the most recently used ones resident.
+
+    Models are keyed by path and load settings, so two WaifuAI instances asking for the
+    same model share one Llama. At most max_models stay loaded and their estimated
+    footprint stays under ram_budget_bytes; the least recently used model nobody holds
+    is evicted first.
+    """
+
+    def __init__(self, max_models=2, ram_budget_bytes=None, loader=_load_llama):
+        self.max_models = max_models
+        self.ram_budget_bytes = ram_budget_bytes
+        self.loader = loader
+        self.models = OrderedDict() # key -> PooledModel, least recently used first
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "load_seconds": 0.0}
+
+    def _key(self, model_path, load_kwargs):
+        return (os.path.abspath(model_path), tuple(sorted(load_kwargs.items())))
+
+    def estimate_footprint(self, model_path, n_ctx=8192):
+        """Rough resident size: the weights plus an allowance for the KV cache and buffers."""
+        return os.path.getsize(model_path) + n_ctx * 128 * 1024
+
+    def acquire(self, model_path, **load_kwargs):
+        """Returns the PooledModel for a model, loading it if needed. Pair with release()."""
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model not found at {model_path}.")
+
+        key = self._key(model_path, load_kwargs)
+        loading = False
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is not None:
+                self.stats["hits"] += 1
+                self.models.move_to_end(key)
+                entry.users += 1
+            else:
+                # Reserve the slot, then load without holding the pool lock, so sessions
+                # using other models (or releasing theirs) aren't blocked for seconds
+                self.stats["misses"] += 1
+                footprint = self.estimate_footprint(model_path, load_kwargs.get("n_ctx", 8192))
+                self._make_room(footprint)
+                entry = PooledModel(key, None, footprint, 0.0)
+                entry.users = 1
+                self.models[key] = entry
+                loading = True
+        if loading:
+            return self._load(entry, model_path, load_kwargs)
+
+        # Someone else may still be loading it
+        entry.ready.wait()
+        if entry.llm is None:
+            self.release(entry)
+            raise RuntimeError(f"Model {model_path} failed to load.")
+        return entry
+
+    def _load(self, entry, model_path, load_kwargs):
+        """Loads the model of a reserved entry, dropping the reservation if that fails."""
+        print(f"Loading model from {model_path}...")
+        started = time.perf_counter()
+        try:
+            entry.llm = self.loader(model_path, **load_kwargs)
+        except Exception:
+            with self.lock:
+                if self.models.get(entry.key) is entry:
+                    del self.models[entry.key]
+            raise
+        finally:
+            entry.ready.set()
+
+        entry.load_seconds = time.perf_counter() - started
+        with self.lock:
+            self.stats["load_seconds"] += entry.load_seconds
+        return entry
+
+    def release(self, entry):
+        """Marks a model as no longer used by the caller. It stays cached until evicted."""
+        with self.lock:
+            entry.users = max(entry.users - 1, 0)
+
+    def _resident_bytes(self):
+        return sum(entry.footprint for entry in self.models.values())
+
+    def _over_budget(self, extra):
+        if len(self.models) + 1 > self.max_models:
+            return True
+        return bool(self.ram_budget_bytes) and self._resident_bytes() + extra > self.ram_budget_bytes
+
+    def _make_room(self, extra):
+        """Evicts unused models, oldest first, until one more of the given size fits."""
+        for key in list(self.models):
+            if not self._over_budget(extra):
+                return
+            entry = self.models[key]
+            if entry.users:
+                continue
+            print(f"Unloading model {os.path.basename(key[0])}...")
+            del self.models[key]
+            if hasattr(entry.llm, "close"):
+                entry.llm.close()
+            entry.llm = None
+            self.stats["evictions"] += 1
+        if self._over_budget(extra):
+            print("Model pool is over budget, all loaded models are in use.")
+
+    def report(self):
+        """Load counts, hit rate and what is resident, for the UI."""
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_rate=self.stats["hits"] / lookups if lookups else 0.0,
+                resident_bytes=self._resident_bytes(),
+                resident=[
+                    {"model": os.path.basename(entry.key[0]), "users": entry.users,
+                     "footprint": entry.footprint, "load_seconds": entry.load_seconds,
+                     "queued": entry.lock.waiting, "max_wait_seconds": entry.lock.max_wait_seconds}
+                    for entry in reversed(self.models.values())
+                ]
+            )
@@ -0,0 +1,277 @@
+import os
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+STATE_MAGIC = b"WAIFUKV1"
+
+def model_fingerprint(model_path, chunk_size=1024 * 1024):
+    """Cheap identity hash for a model file: its size plus the first and last megabyte."""
+    size = os.path.getsize(model_path)
+    h = hashlib.sha1(str(size).encode())
+    with open(model_path, "rb") as f:
+        h.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            h.update(f.read(chunk_size))
+    return h.hexdigest()
+
+def write_state_file(path, state, tags, extra=None):
+    """Writes a llama.cpp state to disk with a JSON header carrying the given tags (and extra data)."""
+    import numpy as np
+    
+    input_ids = np.ascontiguousarray(state.input_ids)
+    scores = np.ascontiguousarray(state.scores)
+    header = dict(extra or {})
+    header.update(tags)
+    header.update({
+        "n_tokens": int(state.n_tokens),
+        "seed": int(state.seed),
+        "llama_state_size": int(state.llama_state_size),
+        "input_ids": [input_ids.dtype.str, list(input_ids.shape)],
+        "scores": [scores.dtype.str, list(scores.shape)]
+    })
+    header_bytes = json.dumps(header).encode("utf-8")
+    
+    # Write to a temp file first so a crash never leaves a half-written snapshot
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(STATE_MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(input_ids.tobytes())
+        f.write(scores.tobytes())
+        f.write(state.llama_state)
+    os.replace(temp_path, path)
+    return os.path.getsize(path)
+
+def read_state_file(path, tags):
+    """Reads a state written by write_state_file.
+
+    Returns (state, header), or (None, None) if it is missing, corrupt or the tags differ.
+    """
+    import numpy as np
+    from llama_cpp.llama import LlamaState
+    
+    if not os.path.exists(path):
+        return None, None
+        
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(STATE_MAGIC)) != STATE_MAGIC:
+                return None, None
+            (header_len,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            
+            for key, value in tags.items():
+                if header.get(key) != value:
+                    print(f"State snapshot {os.path.basename(path)} is stale ({key} changed), ignoring it.")
+                    return None, None
+                    
+            arrays = []
+            for field in ("input_ids", "scores"):
+                dtype, shape = header[field]
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape))
+                data = f.read(count * dtype.itemsize)
+                if len(data) != count * dtype.itemsize:
+                    return None, None
+                arrays.append(np.frombuffer(data, dtype=dtype).reshape(shape).copy())
+                
+            llama_state = f.read(header["llama_state_size"])
+            if len(llama_state) != header["llama_state_size"]:
+                return None, None
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f"Error reading state snapshot: {e}")
+        return None, None
+        
+    return LlamaState(
+        input_ids=arrays[0],
+        scores=arrays[1],
+        n_tokens=header["n_tokens"],
+        llama_state=llama_state,
+        llama_state_size=header["llama_state_size"],
+        seed=header["seed"]
+    ), header
+
+class PromptCache:
+    """Keeps track of which prompt tokens are already evaluated in the llama.cpp context.
+
+    The prompt is built from segments (system prompt, one per history message, then the
+    new turn). Each segment is tokenized once and the concatenated tokens are compared
+    with what the context already holds, so only the new tail has to be evaluated.
+    """
+
+    def __init__(self, llm, max_states=2, lock=None, states=None):
+        self.llm = llm
+        self.token_cache = {}  # segment text -> token ids
+        self.layout = []       # token length of each segment from the last build
+        self.last_stats = {"prompt_tokens": 0, "cached_tokens": 0, "evaluated_tokens": 0}
+        
+        # Every use of the llama.cpp context goes through this lock, the warm-up
+        # worker evaluates prompts in the background. Pass the model's lock when the
+        # Llama is shared.
+        self.lock = lock or threading.RLock()
+        
+        # Saved context states of prefilled system prompts (LRU). Each one holds a
+        # copy of the KV cache, so keep only a few.
+        self.states = OrderedDict() if states is None else states # prefix hash -> LlamaState
+        self.max_states = max_states
+        self._pending_prefill = None
+
+    def tokenize(self, text):
+        """Tokenizes a prompt segment, reusing the cached ids when the text is unchanged."""
+        tokens = self.token_cache.get(text)
+        if tokens is None:
+            # Segments carry their own <|begin_of_text|> / header tokens
+            tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+            self.token_cache[text] = tokens
+        return tokens
+
+    def build(self, segments):
+        """Concatenates the tokens of all segments and records the prefix reuse for this prompt."""
+        tokens = []
+        layout = []
+        used = {}
+        for segment in segments:
+            seg_tokens = self.tokenize(segment)
+            used[segment] = seg_tokens
+            layout.append(len(seg_tokens))
+            tokens.extend(seg_tokens)
+
+        # Only keep what the current prompt uses, old turns fall out with trimming
+        self.token_cache = used
+        self.layout = layout
+
+        with self.lock:
+            cached = self.cached_prefix_length(tokens)
+            if segments and cached < layout[0] and self.restore(segments[0]):
+                cached = self.cached_prefix_length(tokens)
+        self.last_stats = {
+            "prompt_tokens": len(tokens),
+            "cached_tokens": cached,
+            "evaluated_tokens": len(tokens) - cached
+        }
+        return tokens
+
+    def cached_prefix_length(self, tokens):
+        """Returns how many leading tokens are already evaluated in the context."""
+        # input_ids is the whole n_ctx buffer; only the first n_tokens are in the KV cache
+        evaluated = self.llm._input_ids.tolist()
+        n = 0
+        for a, b in zip(evaluated, tokens):
+            if a != b:
+                break
+            n += 1
+        # llama.cpp always re-evaluates the last prompt token to get fresh logits
+        return min(n, max(len(tokens) - 1, 0))
+
+    def segment_offset(self, segment_index):
+        """Token position where the given segment started in the last built prompt."""
+        return sum(self.layout[:segment_index])
+
+    def invalidate(self, segment_index=0):
+        """Drops the evaluated state from the given segment onwards.
+
+        Called when an earlier part of the prompt changes (persona, edited or trimmed
+        history) so the stale tail of the KV cache is never matched again.
+        """
+        position = self.segment_offset(segment_index)
+        with self.lock:
+            if self.llm.n_tokens > position:
+                self.llm.n_tokens = position
+        self.layout = self.layout[:segment_index]
+
+    def reset(self):
+        """Forgets all evaluated state and cached tokens."""
+        with self.lock:
+            self.llm.reset()
+        self.token_cache = {}
+        self.layout = []
+
+    def _state_key(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def restore(self, text):
+        """Makes sure the context starts with the given prefix, loading a saved state if there is one.
+
+        Returns False when the prefix is neither evaluated nor saved.
+        """
+        tokens = self.tokenize(text)
+        with self.lock:
+            if self.cached_prefix_length(tokens) >= len(tokens) - 1:
+                return True
+                
+            key = self._state_key(text)
+            state = self.states.get(key)
+            if state is None:
+                return False
+            self.llm.load_state(state)
+            self.states.move_to_end(key)
+            return True
+
+    def prefill(self, text):
+        """Evaluates a prompt prefix and saves the resulting state for later turns."""
+        tokens = self.tokenize(text)
+        with self.lock:
+            if self.restore(text):
+                return
+                
+            cached = self.cached_prefix_length(tokens)
+            self.llm.n_tokens = cached
+            self.llm.eval(tokens[cached:])
+            
+            key = self._state_key(text)
+            self.states[key] = self.llm.save_state()
+            self.states.move_to_end(key)
+            while len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+
+    def prefill_async(self, text):
+        """Runs prefill() on a background thread."""
+        self._pending_prefill = text
+        worker = threading.Thread(target=self._prefill_worker, args=(text,), daemon=True)
+        worker.start()
+        return worker
+
+    def _prefill_worker(self, text):
+        # Skip warm-ups that were superseded while waiting for the lock
+        with self.lock:
+            if text != self._pending_prefill:
+                return
+            try:
+                self.prefill(text)
+            except Exception as e:
+                print(f"Prefill Error: {e}")
+
+    def save_snapshot(self, segments, path, tags, max_bytes=None, extra=None):
+        """Saves the evaluated part of the given prompt prefix to disk. Returns the file size or None."""
+        tokens = []
+        for segment in segments:
+            tokens.extend(self.tokenize(segment))
+            
+        with self.lock:
+            cached = self.cached_prefix_length(tokens)
+            if cached == 0:
+                return None
+            # Drop whatever was generated past the prefix, it is re-evaluated anyway
+            self.llm.n_tokens = cached
+            state = self.llm.save_state()
+            
+        size = state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+        if max_bytes and size > max_bytes:
+            print(f"State snapshot too large ({size // (1024 * 1024)} MB), not saving it.")
+            return None
+        return write_state_file(path, state, tags, extra)
+
+    def load_snapshot(self, path, tags):
+        """Restores a state saved by save_snapshot. Returns its header if it was loaded, else None."""
+        state, header = read_state_file(path, tags)
+        if state is None or state.n_tokens > self.llm.n_ctx():
+            return None
+            
+        with self.lock:
+            self.llm.load_state(state)
+        return header
@@ -0,0 +1,107 @@
+import os
+import re
+import time
+import sqlite3
+import contextlib
+import threading
+
+PREVIEW_CHARS = 80
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+def session_preview(history):
+    """One line from the end of a chat to recognise it by, without thoughts or mood tags."""
+    for msg in reversed(history):
+        text = re.sub(r"<thought>.*?(</thought>|$)", "", msg.get("content", ""), flags=re.DOTALL)
+        text = re.sub(r"\[Mood:.*?\]", "", text)
+        text = " ".join(text.split())
+        if text:
+            return text[:PREVIEW_CHARS]
+    return ""
+
+class SessionIndex:
+    """SQLite index of a character's saved sessions, in history/sessions.db.
+
+    One row per session with its times, message count, file size and a preview, so
+    listing, searching and paging never open the session files themselves.
+    """
+
+    def __init__(self, history_dir):
+        self.path = os.path.join(history_dir, "sessions.db")
+        with _locks_guard:
+            self.lock = _locks.setdefault(os.path.abspath(self.path), threading.Lock())
+        self.created = not os.path.exists(self.path)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                name TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                modified REAL NOT NULL,
+                message_count INTEGER NOT NULL,
+                byte_size INTEGER NOT NULL,
+                preview TEXT NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_modified ON sessions (modified DESC)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """A connection whose statements commit together, or roll back on error."""
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def upsert(self, name, message_count, byte_size, preview, modified=None, created=None):
+        modified = modified or time.time()
+        with self.lock, self._connect() as conn: # One transaction
+            conn.execute(
+                """INSERT INTO sessions (name, created, modified, message_count, byte_size, preview)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET
+                       modified = excluded.modified,
+                       message_count = excluded.message_count,
+                       byte_size = excluded.byte_size,
+                       preview = excluded.preview""",
+                (name, created or modified, modified, message_count, byte_size, preview)
+            )
+
+    def replace_all(self, rows):
+        """Replaces every row in one transaction, for rebuilding from the session files."""
+        with self.lock, self._connect() as conn:
+            conn.execute("DELETE FROM sessions")
+            conn.executemany(
+                """INSERT INTO sessions (name, created, modified, message_count, byte_size, preview)
+                   VALUES (:name, :created, :modified, :message_count, :byte_size, :preview)""",
+                rows
+            )
+
+    def remove(self, name):
+        with self.lock, self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE name = ?", (name,))
+
+    def get(self, name):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM sessions WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def _where(self, query):
+        if not query:
+            return "", ()
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return " WHERE name LIKE ? ESCAPE '\\' OR preview LIKE ? ESCAPE '\\'", (pattern, pattern)
+
+    def list(self, limit=None, offset=0, query=None):
+        """Sessions as dicts, newest first. `query` matches the name or the preview."""
+        where, args = self._where(query)
+        sql = f"SELECT * FROM sessions{where} ORDER BY modified DESC LIMIT ? OFFSET ?"
+        with self._connect() as conn:
+            rows = conn.execute(sql, args + (-1 if limit is None else limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, query=None):
+        where, args = self._where(query)
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM sessions{where}", args).fetchone()[0]
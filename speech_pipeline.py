@@ -0,0 +1,130 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# edge-tts speaks 24 kHz mono MP3 at 48 kbit/s
+MP3_BYTES_PER_SECOND = 6000
+
+# End of a sentence: punctuation, closing quotes/asterisks/brackets, then whitespace; or a line break
+SENTENCE_END = re.compile(r'[.!?…]+["\'”’)*\]]*\s+|\n+')
+
+class SentenceSegmenter:
+    """Cuts streamed speech text into sentences as soon as each one is complete.
+
+    Pieces shorter than min_chars ("Oh.") are joined with the next sentence, so
+    TTS isn't asked for clips that are mostly silence.
+    """
+
+    def __init__(self, min_chars=24):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        """Adds text, returns the sentences it completed."""
+        self.buffer += text
+        sentences = []
+        search_from = 0
+        while True:
+            match = SENTENCE_END.search(self.buffer, search_from)
+            if not match:
+                break
+            sentence = self.buffer[:match.end()].strip()
+            if len(sentence) < self.min_chars:
+                search_from = match.end()
+                continue
+            sentences.append(sentence)
+            self.buffer = self.buffer[match.end():]
+            search_from = 0
+        return sentences
+
+    def close(self):
+        """Returns what is left at the end of the reply."""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+class SpeechPipeline:
+    """Speaks a reply while it is still being generated.
+
+    Speech text goes in through feed(). Every finished sentence is started right away,
+    with submit(sentence) -> Future of MP3 bytes (VoiceManager.submit_audio), or else
+    synthesize(sentence) in a worker thread. due() hands the clips out in order, each
+    one once the previous clip has (by its length) finished playing, so the caller can
+    play them back to back.
+    """
+
+    def __init__(self, synthesize=None, submit=None, max_workers=2, bytes_per_second=MP3_BYTES_PER_SECOND, clock=time.perf_counter):
+        self.executor = None
+        if submit is None:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+            submit = lambda sentence: self.executor.submit(synthesize, sentence)
+        self.submit = submit
+        self.bytes_per_second = bytes_per_second
+        self.clock = clock
+        self.segmenter = SentenceSegmenter()
+        self.sentences = []
+        self.futures = []
+        self.clips = []
+        self.play_at = None # When the next clip may start
+        self.started = clock()
+        self.first_audio = None # Seconds from start to the first playable clip
+
+    def _submit(self, sentence):
+        self.sentences.append(sentence)
+        self.futures.append(self.submit(sentence))
+
+    def feed(self, text):
+        for sentence in self.segmenter.feed(text):
+            self._submit(sentence)
+
+    def close(self):
+        """No more text is coming; synthesizes the last sentence."""
+        for sentence in self.segmenter.close():
+            self._submit(sentence)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def due(self):
+        """Clips that are ready and whose turn has come, in order. Never blocks."""
+        due = []
+        now = self.clock()
+        while len(self.clips) < len(self.futures) and self.futures[len(self.clips)].done():
+            if self.play_at is not None and now < self.play_at:
+                break
+            try:
+                clip = self.futures[len(self.clips)].result() or b""
+            except Exception as e:
+                print(f"TTS Error: {e}")
+                clip = b""
+            if self.first_audio is None and clip:
+                self.first_audio = now - self.started
+            self.clips.append(clip)
+            start = max(now, self.play_at or now)
+            self.play_at = start + len(clip) / self.bytes_per_second
+            if clip:
+                due.append(clip)
+        return due
+
+    def finished(self):
+        """True once every clip was handed out and has played."""
+        return len(self.clips) == len(self.futures) and (self.play_at is None or self.clock() >= self.play_at)
+
+    def play_remaining(self, play, poll_seconds=0.05):
+        """Blocks, passing each remaining clip to play() when due, until the last one has played."""
+        while True:
+            for clip in self.due():
+                play(clip)
+            if self.finished():
+                return
+            time.sleep(poll_seconds)
+
+    def audio(self):
+        """The whole reply as one MP3 (the clips are plain MP3 frames, so they concatenate)."""
+        return b"".join(self.clips)
+
+    def stats(self):
+        return {
+            "sentences": len(self.sentences),
+            "first_audio": self.first_audio,
+            "audio_seconds": len(self.audio()) / self.bytes_per_second
+        }
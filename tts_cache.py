@@ -0,0 +1,108 @@
+import os
+import threading
+from collections import OrderedDict
+
+from audio_store import clip_key
+
+TTS_CACHE_DIR = "./tts_cache"
+TTS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def normalize_text(text):
+    """Lines that only differ in whitespace sound the same."""
+    return " ".join(text.split())
+
+class TTSCache:
+    """Persistent LRU cache of synthesized speech, one MP3 file per (text, voice, pitch, rate).
+
+    Recency is kept in the file mtimes, so the LRU order survives restarts. When the
+    total size passes max_bytes the least recently used clips are deleted.
+    """
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> size, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext == ".mp3":
+                path = os.path.join(cache_dir, name)
+                files.append((os.path.getmtime(path), key, os.path.getsize(path)))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def key(self, text, voice, pitch, rate):
+        return clip_key(normalize_text(text), voice, pitch, rate)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".mp3")
+
+    def get(self, text, voice, pitch, rate):
+        """Returns the cached audio bytes or None."""
+        key = self.key(text, voice, pitch, rate)
+        with self.lock:
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                # Deleted behind our back
+                self.total_bytes -= self.entries.pop(key)
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return data
+
+    def put(self, text, voice, pitch, rate, data):
+        key = self.key(text, voice, pitch, rate)
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def report(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                clips=len(self.entries),
+                bytes=self.total_bytes,
+                hit_rate=self.stats["hits"] / lookups if lookups else 0.0
+            )
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_tts_cache():
+    """The process-wide cache, shared by every VoiceManager."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = TTSCache()
+        return _default_cache
@@ -1,11 +1,59 @@
-import edge_tts
+import io
 import asyncio
-import os
-import tempfile
+import concurrent.futures
+import threading
+from tts_cache import get_tts_cache
+
+try:
+    import edge_tts
+except ImportError:
+    edge_tts = None
+
+class EdgeTTSBackend:
+    """Microsoft Edge online voices."""
+
+    async def stream(self, text, voice, pitch, rate):
+        """Yields MP3 bytes as the service sends them."""
+        if edge_tts is None:
+            raise RuntimeError("edge-tts is not installed. Run: pip install edge-tts")
+        communicate = edge_tts.Communicate(text, voice, pitch=pitch, rate=rate)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+class AudioLoop:
+    """An asyncio event loop running for the life of the process in a daemon thread.
+
+    Synthesis coroutines from any thread (Streamlit's script threads, API workers) are
+    scheduled on it with submit(), instead of every call making and running a loop.
+    """
 
-class VoiceManager:
     def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="tts-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        """Returns a concurrent.futures.Future with the coroutine's result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+_audio_loop = None
+_audio_loop_lock = threading.Lock()
+
+def get_audio_loop():
+    global _audio_loop
+    with _audio_loop_lock:
+        if _audio_loop is None:
+            _audio_loop = AudioLoop()
+        return _audio_loop
+
+class VoiceManager:
+    def __init__(self, cache=None, backend=None, max_concurrent=4):
         self.output_file = "temp_audio.mp3"
+        self.cache = cache or get_tts_cache() # Repeated lines skip synthesis
+        self.backend = backend or EdgeTTSBackend()
+        self.max_concurrent = max_concurrent # Synthesis requests in flight at once
+        self._semaphore = None
         # Pre-defined list of high quality voices
         self.VOICES = {
             "Aria (Female)": "en-US-AriaNeural",
@@ -17,41 +65,57 @@ class VoiceManager:
             "Michelle (Female)": "en-US-MichelleNeural",
             "Roger (Male)": "en-US-RogerNeural",
         }
-        
-    async def generate_audio(self, text, output_path, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
-        """Generates audio from text using edge-tts."""
+
+    async def synthesize(self, text, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
+        """Generates MP3 bytes in memory (None on failure). Runs on the audio loop."""
         if not text:
-            return False
-            
+            return None
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
         try:
-            communicate = edge_tts.Communicate(text, voice, pitch=pitch, rate=rate)
-            await communicate.save(output_path)
-            return True
+            async with self._semaphore:
+                buffer = io.BytesIO()
+                async for data in self.backend.stream(text, voice, pitch, rate):
+                    buffer.write(data)
         except Exception as e:
             print(f"TTS Error: {e}")
-            return False
+            return None
+
+        audio = buffer.getvalue()
+        if not audio:
+            return None
+        self.cache.put(text, voice, pitch, rate, audio)
+        return audio
+
+    def submit_audio(self, text, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
+        """Starts synthesis on the background loop and returns a Future of the MP3 bytes (or None).
+
+        Cached lines come back as an already finished Future.
+        """
+        cached = self.cache.get(text, voice, pitch, rate)
+        if cached:
+            future = concurrent.futures.Future()
+            future.set_result(cached)
+            return future
+        return get_audio_loop().submit(self.synthesize(text, voice, pitch, rate))
+
+    def get_audio_bytes(self, text, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
+        """Blocking: raw MP3 bytes of text, or None."""
+        return self.submit_audio(text, voice=voice, pitch=pitch, rate=rate).result()
 
     def get_audio_base64(self, text, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
-        """Synchronous wrapper to get base64 audio for Streamlit."""
+        """Like get_audio_bytes, base64 encoded for consumers that need text."""
         import base64
-        
-        # Streamlit runs in a loop, so we need a new loop for async if not present
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-        # Use a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
-            temp_path = fp.name
-            
-        success = loop.run_until_complete(self.generate_audio(text, temp_path, voice, pitch, rate))
-        
-        if success and os.path.exists(temp_path):
-            with open(temp_path, "rb") as f:
-                data = f.read()
-            os.remove(temp_path)
-            return base64.b64encode(data).decode()
-        
-        return None
+
+        audio = self.get_audio_bytes(text, voice=voice, pitch=pitch, rate=rate)
+        return base64.b64encode(audio).decode() if audio else None
+
+    async def generate_audio(self, text, output_path, voice="en-US-AriaNeural", pitch="+0Hz", rate="+0%"):
+        """Generates audio from text into output_path."""
+        audio = await self.synthesize(text, voice, pitch, rate)
+        if not audio:
+            return False
+        with open(output_path, "wb") as f:
+            f.write(audio)
+        return True